@@ -8,10 +8,23 @@ from flask_cors import CORS
 import os
 import tempfile
 import uuid
-from datetime import datetime
 import json
 import logging
 
+from audio_index import AudioIndex
+from audio_io import decode_stream, save_buffer, load_buffer, DecodeError, SAMPLE_RATE
+from comparison import compare_recordings, compare_word, compare_batch, render_plot
+from group_audio import GroupAudioCache, ConcatError, group_names
+from job_queue import create_job_queue, job_status, QueueFull, DONE
+from memo_cache import MemoizedSpeechToText, MemoizedPhonetics, register_cache_gauges
+from metrics import metrics, register_job_gauges, sample_stacks, PROFILER_ENABLED
+from model_pool import create_model_manager
+from reference_cache import ReferenceCache
+from results_store import create_results_store, TempFileSweeper
+from streaming_pitch import register_stream_endpoint
+from torah_text import TorahText, AmbiguousVerse, register_torah_endpoints
+from warmup import create_warmup
+
 app = Flask(__name__)
 CORS(app)  # Enable CORS for React frontend
 
@@ -19,30 +32,64 @@ CORS(app)  # Enable CORS for React frontend
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Store for temporary files and results
-temp_dir = tempfile.mkdtemp()
-results_store = {}
+# UPLOAD_DIR shared by all worker processes on the node; a private temp dir otherwise
+temp_dir = os.environ.get("UPLOAD_DIR") or tempfile.mkdtemp()
+os.makedirs(temp_dir, exist_ok=True)
+# Bounded by count and age (RESULTS_MAX, RESULTS_TTL); RESULTS_BACKEND=sqlite keeps them across restarts
+results_store = create_results_store()
+
+# Rabbi recordings never change - analyze each one once and reuse it
+reference_cache = ReferenceCache()
+
+# Canonical verse text, the phonetic reference in "text" scoring mode.
+# SCORING_REFERENCE=audio (default) transcribes the rabbi instead; a request may pass "reference".
+torah_text = TorahText()
+SCORING_REFERENCE = os.environ.get("SCORING_REFERENCE", "audio")
+
+# Longest group of psukim scored from a single recording
+MAX_BATCH_PSUKIM = int(os.environ.get("MAX_BATCH_PSUKIM", 12))
+
+def store_results(session_id, results):
+    """Keep a finished comparison's results; a plot of an earlier comparison in the session is stale"""
+    results_store.put(session_id, results)
+    plot_path = os.path.join(temp_dir, f"comparison_{session_id}.png")
+    if os.path.exists(plot_path):
+        os.remove(plot_path)
+    logging.info(f"Results stored for session: {session_id}")
+
+# Comparisons run on a bounded worker pool; clients poll /api/results/<session_id>
+compare_jobs = create_job_queue(on_result=store_results)
+
+# Rabbi recordings served to the player, indexed once at startup
+audio_index = AudioIndex(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'audio'))
+
+# Concatenated rabbi recordings for grouped psukim, built once per group
+group_audio = GroupAudioCache()
 
-# Initialize models lazily to speed up startup
-stt = None
-phonetics = None
+# Old uploads and plots are deleted in the background (TEMP_FILE_TTL, SWEEP_INTERVAL)
+temp_sweeper = TempFileSweeper(temp_dir, stores=(results_store, compare_jobs))
+
+# Models load lazily on first use, exactly once per slot; each call borrows a slot
+models = create_model_manager()
+
+# Libraries and models load on a background thread at boot (WARMUP=1, the default);
+# /api/ready answers 200 only once they have, /api/health as soon as the process is up
+warmup = create_warmup(models)
+
+# Queue depth and model slots, read when /api/metrics is scraped
+register_job_gauges(metrics, compare_jobs, models)
+register_cache_gauges(metrics)
+
+# Resubmitted audio and repeated words skip the models: transcripts, phonemes (per word) and pitch
+# are memoized by content, in memory (MEMO_CACHE_ENTRIES) and optionally on disk (MEMO_CACHE_DIR)
+stt_model = MemoizedSpeechToText(models.get("stt"))
+phonetics_model = MemoizedPhonetics(models.get("phonetics"))
 
 def get_stt():
-    global stt
-    if stt is None:
-        from speech_to_text import SpeechToText
-        print("Loading Whisper model...")
-        stt = SpeechToText()
-        print("Whisper model loaded!")
-    return stt
+    return stt_model
 
 def get_phonetics():
-    global phonetics
-    if phonetics is None:
-        from phonetics import Phonetics
-        print("Loading phonetics analyzer...")
-        phonetics = Phonetics()
-        print("Phonetics analyzer loaded!")
-    return phonetics
+    return phonetics_model
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
@@ -50,6 +97,31 @@ def health_check():
     """Health check endpoint"""
     return jsonify({"status": "healthy", "message": "Bar Mitzvah API is running"})
 
+@app.route('/api/ready', methods=['GET'])
+def readiness_check():
+    """Readiness: 503 until libraries and models are loaded, with per-step timings"""
+    report = warmup.report()
+    return jsonify(report), 200 if report["ready"] else 503
+
+@app.route('/api/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Stage latency histograms, queue depth and model slots, in the Prometheus text format"""
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route('/api/profile', methods=['GET'])
+def sampling_profile():
+    """Collapsed stacks of every thread, sampled for ?seconds= (PROFILER_ENABLED=1 only)"""
+    if not PROFILER_ENABLED:
+        return jsonify({"error": "Profiler disabled (PROFILER_ENABLED=1)"}), 404
+    seconds = request.args.get('seconds', 10, type=float)
+    return sample_stacks(seconds), 200, {"Content-Type": "text/plain; charset=utf-8"}
+
+@app.route('/api/models', methods=['GET'])
+def model_slots():
+    """Model slot usage, for sizing worker concurrency"""
+    return jsonify({"models": models.stats(), "pending_comparisons": compare_jobs.pending(),
+                    "stages": metrics.snapshot()})
+
 @app.route('/api/rabbi-audio', methods=['GET'])
 def get_rabbi_audio():
     logging.debug("Rabbi audio endpoint called")
@@ -65,23 +137,29 @@ def upload_recording():
     logging.debug("Upload recording endpoint called")
     """Receive and process user's recording"""
     try:
-        if 'audio' not in request.files:
-            logging.warning("No audio file provided in request")
-            return jsonify({"error": "No audio file provided"}), 400
+        if request.mimetype.startswith('audio/') or request.mimetype == 'application/octet-stream':
+            # Raw audio body - decoded while it streams in
+            upload_stream = request.stream
+        else:
+            if 'audio' not in request.files:
+                logging.warning("No audio file provided in request")
+                return jsonify({"error": "No audio file provided"}), 400
 
-        audio_file = request.files['audio']
-        if audio_file.filename == '':
-            logging.warning("No file selected for upload")
-            return jsonify({"error": "No file selected"}), 400
+            audio_file = request.files['audio']
+            if audio_file.filename == '':
+                logging.warning("No file selected for upload")
+                return jsonify({"error": "No file selected"}), 400
+            upload_stream = audio_file.stream
 
         # Generate unique filename
         session_id = str(uuid.uuid4())
-        filename = f"user_recording_{session_id}.wav"
+        filename = f"user_recording_{session_id}.npy"
         filepath = os.path.join(temp_dir, filename)
 
-        # Save the uploaded file
-        audio_file.save(filepath)
-        logging.info(f"Recording uploaded successfully: {filename}")
+        # Decode once to 16 kHz mono; ASR and pitch both read this buffer
+        samples = decode_stream(upload_stream)
+        save_buffer(filepath, samples)
+        logging.info(f"Recording uploaded successfully: {filename} ({len(samples) / SAMPLE_RATE:.1f}s)")
 
         return jsonify({
             "success": True,
@@ -89,14 +167,56 @@ def upload_recording():
             "message": "Recording uploaded successfully"
         })
 
+    except DecodeError as e:
+        logging.warning(f"Upload could not be decoded: {e}")
+        return jsonify({"error": "Could not decode audio"}), 400
     except Exception as e:
         logging.error(f"Upload failed: {str(e)}")
         return jsonify({"error": f"Upload failed: {str(e)}"}), 500
 
+def run_comparison(user_file, rabbi_file, session_id, verse, progress):
+    """Job body: runs on a compare worker thread, not in the request"""
+    verse_text = verse_phonemes = verse_words = None
+    if verse is not None:
+        verse_text = torah_text.plain_text(verse)
+        verse_phonemes = torah_text.phonemes(verse, get_phonetics())
+        verse_words = torah_text.words(verse)
+    results = compare_recordings(load_buffer(user_file), rabbi_file, session_id, get_stt(), get_phonetics(),
+                                 reference_cache, verse_text=verse_text,
+                                 verse_phonemes=verse_phonemes, verse_words=verse_words, progress=progress)
+    return results
+
+def run_batch_comparison(user_file, psukim, session_id, progress):
+    """Job body for one recording of several psukim"""
+    references = []
+    for pasuk in psukim:
+        reference = {"pasuk_id": pasuk["pasuk_id"], "rabbi_file": pasuk["rabbi_file"]}
+        if pasuk["verse"] is not None:
+            reference["verse_text"] = torah_text.plain_text(pasuk["verse"])
+            reference["verse_phonemes"] = torah_text.phonemes(pasuk["verse"], get_phonetics())
+            reference["verse_words"] = torah_text.words(pasuk["verse"])
+        references.append(reference)
+    results = compare_batch(load_buffer(user_file), references, session_id, get_stt(), get_phonetics(),
+                            reference_cache, progress=progress)
+    return results
+
+def run_word_comparison(user_file, rabbi_file, word_index, session_id, verse, progress):
+    """Job body for a retry of one word"""
+    verse_words = torah_text.words(verse) if verse is not None else None
+    results = compare_word(load_buffer(user_file), rabbi_file, word_index, session_id, get_stt(), get_phonetics(),
+                           reference_cache, verse_words=verse_words, progress=progress)
+    return results
+
+def find_rabbi_file(pasuk_id):
+    """The rabbi's recording of a pasuk, by <chapter>_<pasuk> or by torah.json id (as the verse cards send), or None"""
+    name = torah_text.recording_name(pasuk_id)
+    rabbi_file = os.path.join("../bar-mitzva-1/audio", f"{name}.m4a") if name else None
+    return rabbi_file if rabbi_file and os.path.exists(rabbi_file) else None
+
 @app.route('/api/compare-audio', methods=['POST'])
 def compare_audio():
     logging.debug("Compare audio endpoint called")
-    """Compare user's recording with rabbi's recording"""
+    """Queue a comparison of user's recording with rabbi's recording"""
     try:
         data = request.get_json()
         session_id = data.get('session_id')
@@ -107,7 +227,7 @@ def compare_audio():
             return jsonify({"error": "Session ID required"}), 400
 
         # File paths
-        user_file = os.path.join(temp_dir, f"user_recording_{session_id}.wav")
+        user_file = os.path.join(temp_dir, f"user_recording_{session_id}.npy")
         if not os.path.exists(user_file):
             logging.error("User recording not found")
             return jsonify({"error": "User recording not found"}), 404
@@ -119,73 +239,135 @@ def compare_audio():
             logging.warning("Pasuk ID not provided in request")
             return jsonify({"error": "Pasuk ID required"}), 400
 
-        rabbi_file = f"../bar-mitzva-1/audio/{pasuk_id}.m4a"
-        if not os.path.exists(rabbi_file):
+        rabbi_file = find_rabbi_file(pasuk_id)
+        if rabbi_file is None:
             logging.error("Rabbi recording not found")
             return jsonify({"error": "Rabbi recording not found"}), 404
 
-        # Import prosody functions
-        from prosody import extract_pitch_contour, compare_pitch, plot_pitch
-        from rapidfuzz import fuzz
-
-        # Initialize models when needed
-        stt_model = get_stt()
-        phonetics_model = get_phonetics()
-
-        logging.debug("Transcribing rabbi's audio")
-        rabbi_text = stt_model.transcribe(rabbi_file, language="he")
-        logging.debug(f"Rabbi transcription: {rabbi_text}")
-
-        logging.debug("Transcribing user's audio")
-        user_text = stt_model.transcribe(user_file, language="he")
-        logging.debug(f"User transcription: {user_text}")
-
-        # Phonetic comparison
-        try:
-            rabbi_phones = phonetics_model.text_to_phones(rabbi_text)
-            user_phones = phonetics_model.text_to_phones(user_text)
-            phonetic_score = fuzz.ratio(rabbi_phones, user_phones)
-            logging.debug(f"Phonetic score: {phonetic_score}")
-        except Exception as e:
-            logging.warning(f"Phonetic analysis warning: {e}")
-            # Fallback to simple text comparison
-            phonetic_score = fuzz.ratio(rabbi_text, user_text)
-
-        logging.debug("Extracting pitch contours")
-        rabbi_pitch = extract_pitch_contour(rabbi_file)
-        user_pitch = extract_pitch_contour(user_file)
-        prosody_score = compare_pitch(rabbi_pitch, user_pitch)
-        logging.debug(f"Prosody score: {prosody_score}")
-
-        # Calculate overall score (weighted average)
-        overall_score = (phonetic_score * 0.6) + (prosody_score * 0.4)
-        logging.info(f"Overall score: {overall_score}")
-
-        # Generate comparison plot
-        plot_filename = f"comparison_{session_id}.png"
-        plot_path = os.path.join(temp_dir, plot_filename)
-        plot_pitch(rabbi_pitch, user_pitch, save_path=plot_path)
-        logging.debug(f"Comparison plot saved: {plot_path}")
-
-        # Store results
-        results = {
-            "session_id": session_id,
-            "timestamp": datetime.now().isoformat(),
-            "rabbi_text": rabbi_text,
-            "user_text": user_text,
-            "phonetic_score": round(phonetic_score, 2),
-            "prosody_score": round(prosody_score, 2),
-            "overall_score": round(overall_score, 2),
-            "plot_available": True
-        }
+        verse = None
+        if data.get('reference', SCORING_REFERENCE) == 'text':
+            verse = torah_text.lookup(pasuk_id, data.get('book'))
+            if verse is None:
+                logging.warning(f"No verse text for pasuk {pasuk_id}, scoring against the rabbi's transcription")
+
+        # A retry of the same request while it is still being processed just gets its status back;
+        # anything else (another pasuk, reference mode, a finished job) is compared again
+        job = compare_jobs.submit_request(
+            session_id, {"endpoint": "compare-audio", "pasuk_id": pasuk_id, "book": data.get('book'),
+                         "reference": data.get('reference', SCORING_REFERENCE)},
+            run_comparison, user_file, rabbi_file, session_id, verse)
+        logging.debug(f"Comparison job {job['status']} for session: {session_id}")
+
+        return jsonify(job_status(job)), 202
+
+    except AmbiguousVerse as e:
+        logging.warning(f"Ambiguous pasuk: {e}")
+        return jsonify({"error": f"Ambiguous pasuk: {e}", "books": e.books}), 400
+    except QueueFull as e:
+        logging.warning(f"Comparison queue full: {e}")
+        return jsonify({"error": "Server busy, try again later"}), 503, {"Retry-After": "5"}
+    except Exception as e:
+        logging.error(f"Comparison failed: {str(e)}")
+        return jsonify({"error": f"Comparison failed: {str(e)}"}), 500
+
+@app.route('/api/compare-audio/batch', methods=['POST'])
+def compare_audio_batch():
+    logging.debug("Batch compare endpoint called")
+    """Queue a comparison of one recording spanning several psukim (e.g. a GroupedVerseCard)"""
+    try:
+        data = request.get_json()
+        session_id = data.get('session_id')
+        pasuk_ids = data.get('pasuk_ids') or []
+
+        if not session_id:
+            logging.warning("Session ID not provided in request")
+            return jsonify({"error": "Session ID required"}), 400
+        if not isinstance(pasuk_ids, list) or not pasuk_ids or len(pasuk_ids) > MAX_BATCH_PSUKIM:
+            logging.warning(f"Invalid pasuk list: {pasuk_ids}")
+            return jsonify({"error": f"1 to {MAX_BATCH_PSUKIM} pasuk IDs required"}), 400
+
+        user_file = os.path.join(temp_dir, f"user_recording_{session_id}.npy")
+        if not os.path.exists(user_file):
+            logging.error("User recording not found")
+            return jsonify({"error": "User recording not found"}), 404
 
-        results_store[session_id] = results
-        logging.info(f"Results stored for session: {session_id}")
+        text_reference = data.get('reference', SCORING_REFERENCE) == 'text'
+        psukim = []
+        for pasuk_id in pasuk_ids:
+            rabbi_file = find_rabbi_file(pasuk_id)
+            if rabbi_file is None:
+                logging.error(f"Rabbi recording not found for pasuk {pasuk_id}")
+                return jsonify({"error": f"Rabbi recording not found for pasuk {pasuk_id}"}), 404
+            verse = torah_text.lookup(pasuk_id, data.get('book')) if text_reference else None
+            psukim.append({"pasuk_id": pasuk_id, "rabbi_file": rabbi_file, "verse": verse})
+
+        job = compare_jobs.submit_request(
+            session_id, {"endpoint": "batch", "pasuk_ids": pasuk_ids, "book": data.get('book'),
+                         "reference": data.get('reference', SCORING_REFERENCE)},
+            run_batch_comparison, user_file, psukim, session_id)
+        logging.debug(f"Batch comparison of {len(psukim)} psukim job {job['status']} for session: {session_id}")
+
+        return jsonify(job_status(job)), 202
+
+    except AmbiguousVerse as e:
+        logging.warning(f"Ambiguous pasuk: {e}")
+        return jsonify({"error": f"Ambiguous pasuk: {e}", "books": e.books}), 400
+    except QueueFull as e:
+        logging.warning(f"Comparison queue full: {e}")
+        return jsonify({"error": "Server busy, try again later"}), 503, {"Retry-After": "5"}
+    except Exception as e:
+        logging.error(f"Batch comparison failed: {str(e)}")
+        return jsonify({"error": f"Comparison failed: {str(e)}"}), 500
 
-        return jsonify(results)
+@app.route('/api/compare-word', methods=['POST'])
+def compare_word_audio():
+    logging.debug("Compare word endpoint called")
+    """Queue scoring of a recording of a single word - word_index as in the "words" of a comparison"""
+    try:
+        data = request.get_json()
+        session_id = data.get('session_id')
+        pasuk_id = data.get('pasuk_id')
+        word_index = data.get('word_index')
+
+        if not session_id or not pasuk_id:
+            logging.warning("Session ID or pasuk ID not provided in request")
+            return jsonify({"error": "Session ID and pasuk ID required"}), 400
+        if not isinstance(word_index, int) or word_index < 0:
+            logging.warning(f"Invalid word index: {word_index}")
+            return jsonify({"error": "Word index required"}), 400
+
+        user_file = os.path.join(temp_dir, f"user_recording_{session_id}.npy")
+        if not os.path.exists(user_file):
+            logging.error("User recording not found")
+            return jsonify({"error": "User recording not found"}), 404
+
+        rabbi_file = find_rabbi_file(pasuk_id)
+        if rabbi_file is None:
+            logging.error("Rabbi recording not found")
+            return jsonify({"error": "Rabbi recording not found"}), 404
 
+        verse = None
+        if data.get('reference', SCORING_REFERENCE) == 'text':
+            verse = torah_text.lookup(pasuk_id, data.get('book'))
+            if verse is not None and word_index >= len(torah_text.words(verse)):
+                return jsonify({"error": "Word index out of range"}), 400
+
+        job = compare_jobs.submit_request(
+            session_id, {"endpoint": "compare-word", "pasuk_id": pasuk_id, "word_index": word_index,
+                         "book": data.get('book'), "reference": data.get('reference', SCORING_REFERENCE)},
+            run_word_comparison, user_file, rabbi_file, word_index, session_id, verse)
+        logging.debug(f"Word comparison job {job['status']} for session: {session_id}")
+
+        return jsonify(job_status(job)), 202
+
+    except AmbiguousVerse as e:
+        logging.warning(f"Ambiguous pasuk: {e}")
+        return jsonify({"error": f"Ambiguous pasuk: {e}", "books": e.books}), 400
+    except QueueFull as e:
+        logging.warning(f"Comparison queue full: {e}")
+        return jsonify({"error": "Server busy, try again later"}), 503, {"Retry-After": "5"}
     except Exception as e:
-        logging.error(f"Comparison failed: {str(e)}")
+        logging.error(f"Word comparison failed: {str(e)}")
         return jsonify({"error": f"Comparison failed: {str(e)}"}), 500
 
 @app.route('/api/comparison-plot/<session_id>', methods=['GET'])
@@ -193,35 +375,33 @@ def get_comparison_plot(session_id):
     """Serve the comparison plot image"""
     try:
         plot_path = os.path.join(temp_dir, f"comparison_{session_id}.png")
-        if os.path.exists(plot_path):
-            return send_file(plot_path, mimetype='image/png')
-        else:
-            return jsonify({"error": "Plot not found"}), 404
+        if not os.path.exists(plot_path):
+            # Rendered on first request from the stored contours, then served from temp_dir
+            results = results_store.get(session_id)
+            if results is None or "contours" not in results:
+                return jsonify({"error": "Plot not found"}), 404
+            render_plot(results, plot_path)
+        return send_file(plot_path, mimetype='image/png')
     except Exception as e:
         return jsonify({"error": f"Failed to serve plot: {str(e)}"}), 500
 
 @app.route('/api/results/<session_id>', methods=['GET'])
 def get_results(session_id):
-    """Get stored results for a session"""
-    if session_id in results_store:
-        return jsonify(results_store[session_id])
+    """Get the status of a session's comparison, and its results once done"""
+    job = compare_jobs.get(session_id)
+    if job is not None:
+        return jsonify(job_status(job))
+    results = results_store.get(session_id)
+    if results is not None:
+        return jsonify({**results, "status": DONE})
     else:
         return jsonify({"error": "Results not found"}), 404
 
-@app.route('/api/pasuk-info', methods=['GET'])
-def get_pasuk_info():
-    """Get information about the current pasuk (Genesis 1:1)"""
-    pasuk_info = {
-        "id": 1,
-        "book": "בראשית",
-        "chapter": 1,
-        "verse": 1,
-        "hebrew": "בְּרֵאשִׁית בָּרָא אֱלֹהִים אֵת הַשָּׁמַיִם וְאֵת הָאָרֶץ",
-        "transliteration": "B'reishit bara Elohim et hashamayim v'et ha'aretz",
-        "translation": "In the beginning God created the heavens and the earth",
-        "reference": "Genesis 1:1"
-    }
-    return jsonify(pasuk_info)
+# Live pitch feedback while the student sings (WebSocket, needs flask-sock)
+register_stream_endpoint(app, reference_cache, find_rabbi_file)
+
+# Verse text by chapter/pasuk and by parasha, paginated and cacheable (ETag)
+register_torah_endpoints(app, torah_text)
 
 
 @app.route('/api/ok', methods=['GET'])
@@ -231,62 +411,48 @@ def get_OK():
 
 @app.route('/api/audio/<int:chapter>_<int:pasuk>', methods=['GET'])
 def get_audio_file(chapter, pasuk):
-    """Serve the audio file for the given chapter and pasuk."""
-    logging.debug(f"Audio file request for chapter {chapter}, pasuk {pasuk}")
-    print(f"Audio file request for chapter {chapter}, pasuk {pasuk}", flush=True)
-
-    # Ensure the audio folder path is correct
-    audio_folder = os.path.abspath(os.path.join(os.path.dirname(__file__), 'audio'))
-    logging.debug(f"Resolved audio folder path: {audio_folder}")
-    print(f"Resolved audio folder path: {audio_folder}", flush=True)
-
-    filename = f"{chapter}_{pasuk}.m4a"
-    filepath = os.path.join(audio_folder, filename)
-
-    logging.debug(f"Looking for audio file at: {filepath}")
-    print(f"Looking for audio file at: {filepath}", flush=True)
-
-    if os.path.exists(filepath):
-        logging.info(f"Serving audio file: {filepath}")
-        print(f"Serving audio file: {filepath}", flush=True)
-        return send_file(filepath, as_attachment=False, mimetype='audio/mpeg')
-    else:
-        logging.warning(f"Audio file not found: {filepath}")
-        print(f"Audio file not found: {filepath}", flush=True)
+    """Serve the audio file for the given chapter and pasuk (ETag, Range, Opus when the client accepts it)."""
+    response = audio_index.send(f"{chapter}_{pasuk}", request.accept_mimetypes)
+    if response is None:
         return jsonify({"error": "Audio file not found"}), 404
+    return response
 
-@app.route('/api/audio/group', methods=['POST'])
+@app.route('/api/audio/group', methods=['GET', 'POST'])
 def get_group_audio():
-    """Serve concatenated audio for a group of psukim."""
-    data = request.get_json()
-    psukim = data.get('psukim', [])  # List of {chapter, pasuk}
+    """Serve concatenated audio for a group of psukim: ?ids=25_19,25_20, or POST {"psukim": [{chapter, pasuk}]}."""
+    if request.method == 'POST':
+        names = group_names(psukim=(request.get_json() or {}).get('psukim', []))
+    else:
+        names = group_names(ids=request.args.get('ids', ''))
+    if names is None:
+        logging.warning("Invalid group of psukim requested")
+        return jsonify({"error": "A list of <chapter>_<pasuk> ids is required"}), 400
 
-    audio_folder = os.path.abspath(os.path.join(os.path.dirname(__file__), 'audio'))
     audio_files = []
-
-    for pasuk in psukim:
-        chapter = pasuk.get('chapter')
-        pasuk_num = pasuk.get('pasuk')
-        filename = f"{chapter}_{pasuk_num}.m4a"
-        filepath = os.path.join(audio_folder, filename)
-        if os.path.exists(filepath):
-            audio_files.append(filepath)
-        else:
+    for name in names:
+        filepath = audio_index.path(name)
+        if filepath is None:
+            chapter, pasuk_num = name.split('_')
             return jsonify({"error": f"Audio file not found for chapter {chapter}, pasuk {pasuk_num}"}), 404
+        audio_files.append(filepath)
 
-    # Concatenate audio files (placeholder logic, actual implementation may vary)
-    concatenated_audio_path = os.path.join(audio_folder, 'group_audio.m4a')
-    with open(concatenated_audio_path, 'wb') as outfile:
-        for audio_file in audio_files:
-            with open(audio_file, 'rb') as infile:
-                outfile.write(infile.read())
-
-    return send_file(concatenated_audio_path, as_attachment=False, mimetype='audio/mpeg')
+    try:
+        path, key = group_audio.get(audio_files)
+    except ConcatError as e:
+        logging.error(f"Group audio concatenation failed: {e}")
+        return jsonify({"error": "Could not build group audio"}), 500
 
+    # Content-addressed: the ETag changes only if a recording in the group does; Range is handled by send_file
+    return send_file(path, mimetype='audio/mp4', conditional=True, etag=key, max_age=86400)
 
 if __name__ == '__main__':
     print(f"Temporary files will be stored in: {temp_dir}")
     print("Starting Bar Mitzvah API server...")
-    print("Note: AI models will be loaded on first use to speed up startup")
+    print("Note: AI models load in the background (WARMUP=0: on first use); see /api/ready")
+    # With debug=True the reloader re-runs this file in a child process that does the serving;
+    # the watching parent must not load the models too
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        temp_sweeper.start()
+        warmup.start()
     app.run(debug=True, host='0.0.0.0', port=5001)
 
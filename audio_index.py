@@ -0,0 +1,137 @@
+"""
+audio_index.py
+הגשת הקלטות הרב לנגן: אינדקס בזיכרון של תיקיית audio/ (נבנה בעלייה), ETag חזק לפי תוכן,
+Cache-Control ארוך ו-Range. אם קיימת גרסת Opus מקודדת מראש (audio_index.py --opus) היא מוגשת
+לדפדפנים שמבקשים אותה ב-Accept - בערך רבע מהגודל.
+"""
+
+import argparse
+import os
+import subprocess
+import threading
+import time
+
+from flask import send_file
+
+from reference_cache import file_sha256
+
+AUDIO_MAX_AGE = int(os.environ.get("AUDIO_MAX_AGE", 30 * 24 * 3600))
+# A name that is not in the index triggers a rescan at most this often (new recordings)
+RESCAN_INTERVAL = 60
+
+VARIANTS = {".m4a": "audio/mp4", ".opus": "audio/ogg"}
+
+
+class AudioIndex:
+    def __init__(self, audio_dir: str):
+        self.audio_dir = audio_dir
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._scanned_at = 0.0
+        self.scan()
+
+    def scan(self):
+        """Index every recording and its variants: name -> {extension: (path, size, mtime_ns)}."""
+        entries = {}
+        if os.path.isdir(self.audio_dir):
+            with os.scandir(self.audio_dir) as listing:
+                for entry in listing:
+                    name, extension = os.path.splitext(entry.name)
+                    if extension in VARIANTS and entry.is_file():
+                        stat = entry.stat()
+                        entries.setdefault(name, {})[extension] = (entry.path, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            # Keep the content hashes already computed for files that did not change
+            for name, variants in entries.items():
+                old = self._entries.get(name, {})
+                for extension, record in variants.items():
+                    if extension in old and old[extension][:3] == record:
+                        variants[extension] = old[extension]
+            self._entries = entries
+            self._scanned_at = time.monotonic()
+        return len(entries)
+
+    def _variants(self, name: str):
+        variants = self._entries.get(name)
+        if variants is None and time.monotonic() - self._scanned_at > RESCAN_INTERVAL:
+            self.scan()
+            variants = self._entries.get(name)
+        return variants
+
+    def path(self, name: str):
+        """Path of the m4a recording "<chapter>_<pasuk>", or None."""
+        variants = self._variants(name)
+        return variants[".m4a"][0] if variants and ".m4a" in variants else None
+
+    def _etag(self, name: str, extension: str) -> str:
+        with self._lock:
+            record = self._entries[name][extension]
+        if len(record) == 3:
+            # Strong ETag: the content hash, computed on first request and kept with the entry
+            record = (*record, file_sha256(record[0]))
+            with self._lock:
+                if name in self._entries and self._entries[name].get(extension, ())[:3] == record[:3]:
+                    self._entries[name][extension] = record
+        return record[3]
+
+    def send(self, name: str, accept_mimetypes):
+        """A conditional, range-capable response for a recording, or None if there is none."""
+        variants = self._variants(name)
+        if not variants:
+            return None
+        offered = [extension for extension in (".m4a", ".opus") if extension in variants]
+        # Opus only for clients that name it - Safari sends */* and cannot play it
+        extension = offered[0]
+        if ".opus" in offered and accept_mimetypes.quality("audio/ogg") > accept_mimetypes.quality("audio/mp4"):
+            extension = ".opus"
+        elif ".m4a" not in offered:
+            return None
+
+        path = variants[extension][0]
+        response = send_file(path, mimetype=VARIANTS[extension], conditional=True,
+                             etag=self._etag(name, extension), max_age=AUDIO_MAX_AGE)
+        if len(offered) > 1:
+            response.vary.add("Accept")
+        return response
+
+
+def transcode_opus(audio_dir: str, bitrate: str = "48k") -> int:
+    """Write <name>.opus next to every <name>.m4a that has none (or an older one)."""
+    count = 0
+    for entry in sorted(os.listdir(audio_dir)):
+        name, extension = os.path.splitext(entry)
+        if extension != ".m4a":
+            continue
+        source = os.path.join(audio_dir, entry)
+        target = os.path.join(audio_dir, f"{name}.opus")
+        if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source):
+            continue
+        result = subprocess.run(
+            ["ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y", "-i", source,
+             "-vn", "-c:a", "libopus", "-b:a", bitrate, "-f", "ogg", target + ".tmp"],
+            capture_output=True,
+        )
+        if result.returncode != 0:
+            print(f"Skipping {entry}: {result.stderr.decode('utf-8', 'replace').strip()}")
+            if os.path.exists(target + ".tmp"):
+                os.unlink(target + ".tmp")
+            continue
+        os.replace(target + ".tmp", target)
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prepare the rabbi recordings for serving")
+    parser.add_argument("audio_dir", nargs="?", default="audio", help="תיקיית הקלטות הרב")
+    parser.add_argument("--opus", action="store_true", help="קידוד מראש של גרסת Opus לכל הקלטה")
+    parser.add_argument("--bitrate", default="48k")
+    args = parser.parse_args()
+
+    if args.opus:
+        print(f"{transcode_opus(args.audio_dir, args.bitrate)} recordings transcoded to Opus")
+    print(f"{AudioIndex(args.audio_dir).scan()} recordings indexed in {args.audio_dir}")
+
+
+if __name__ == "__main__":
+    main()
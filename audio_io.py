@@ -0,0 +1,148 @@
+"""
+audio_io.py
+פענוח אודיו פעם אחת לבאפר float32 מונו ב-16kHz - הפורמט שגם Whisper וגם ניתוח המלודיה מקבלים.
+העלאות מפוענחות תוך כדי קבלה (ffmpeg דרך pipe) ונשמרות כ-.npy שנטען ב-mmap.
+הקלטות הרב המפוענחות נשמרות במטמון LRU מוגבל בגודל כולל.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+CHUNK_SIZE = 64 * 1024
+
+
+class DecodeError(Exception):
+    pass
+
+
+def _ffmpeg_command(source: str) -> list:
+    return [
+        "ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error",
+        "-i", source,
+        "-f", "f32le", "-acodec", "pcm_f32le", "-ac", "1", "-ar", str(SAMPLE_RATE),
+        "pipe:1",
+    ]
+
+
+def decode_file(path: str) -> np.ndarray:
+    """Any audio file ffmpeg can read -> 16 kHz mono float32."""
+    result = subprocess.run(_ffmpeg_command(path), capture_output=True)
+    if result.returncode != 0:
+        raise DecodeError(result.stderr.decode("utf-8", "replace").strip() or f"ffmpeg failed on {path}")
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
+
+def decode_stream(stream, chunk_size: int = CHUNK_SIZE) -> np.ndarray:
+    """
+    Decode an upload while it is still being received.
+
+    Chunks are piped straight into ffmpeg. They are also spooled aside, because some
+    containers (mp4/m4a with the index at the end) cannot be decoded from a pipe -
+    those are decoded again from the spooled copy.
+    """
+    process = subprocess.Popen(_ffmpeg_command("pipe:0"), stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = []
+    errors = []
+    readers = [
+        threading.Thread(target=lambda: output.append(process.stdout.read()), daemon=True),
+        threading.Thread(target=lambda: errors.append(process.stderr.read()), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as spool:
+        pipe_open = True
+        for chunk in iter(lambda: stream.read(chunk_size), b""):
+            spool.write(chunk)
+            if pipe_open:
+                try:
+                    process.stdin.write(chunk)
+                except BrokenPipeError:
+                    # ffmpeg gave up on the pipe - keep receiving, decode from the spool
+                    pipe_open = False
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        process.wait()
+        for reader in readers:
+            reader.join()
+
+        if process.returncode == 0 and output and output[0]:
+            return np.frombuffer(output[0], dtype=np.float32)
+
+        if spool.tell() == 0:
+            raise DecodeError("Empty upload")
+        spool.seek(0)
+        with tempfile.NamedTemporaryFile(suffix=".upload") as seekable:
+            shutil.copyfileobj(spool, seekable)
+            seekable.flush()
+            return decode_file(seekable.name)
+
+
+def save_buffer(path: str, samples: np.ndarray):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, np.asarray(samples, dtype=np.float32))
+    os.replace(tmp_path, path)
+
+
+def load_buffer(path: str) -> np.ndarray:
+    """A saved buffer, memory-mapped rather than read."""
+    return np.load(path, mmap_mode="r")
+
+
+class DecodedAudioCache:
+    """Decoded clips by file, least recently used evicted first once max_bytes is exceeded."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._clips = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path: str) -> np.ndarray:
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            samples = self._clips.get(key)
+            if samples is not None:
+                self._clips.move_to_end(key)
+                self.hits += 1
+                return samples
+            self.misses += 1
+
+        samples = decode_file(path)
+        # Shared between callers and stages - nobody gets to modify it in place
+        samples.flags.writeable = False
+        with self._lock:
+            if key not in self._clips:
+                self._clips[key] = samples
+                self._bytes += samples.nbytes
+            while self._bytes > self.max_bytes and len(self._clips) > 1:
+                _, evicted = self._clips.popitem(last=False)
+                self._bytes -= evicted.nbytes
+        return samples
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"clips": len(self._clips), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+
+reference_audio = DecodedAudioCache(int(os.environ.get("AUDIO_CACHE_MB", 256)) * 1024 * 1024)
+
+
+def load_audio(path: str) -> np.ndarray:
+    """Decode a reference clip, or return it from the shared decoded-audio cache."""
+    return reference_audio.load(path)
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+benchmark.py
+מדידת זמנים לצינור ההשוואה, שלב אחרי שלב: זמן קיר, זמן CPU והשינוי בזיכרון (RSS) לכל שלב ולכל קטע,
+על הקלטות audio/ ו-old/ ועל קטעים סינתטיים באורכים שונים. התוצאות נכתבות ל-JSON להשוואה בין commits
+ובין גדלי מודל (--compare).
+"""
+
+import argparse
+import glob
+import importlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+
+from audio_io import SAMPLE_RATE, decode_file
+
+DEFAULT_OUTPUT_DIR = os.path.join("cache", "benchmarks")
+DEFAULT_SYNTHETIC = "5,15,30"
+STAGES = ("decode", "vad", "transcribe", "phonemes", "pitch", "scoring", "words", "plot")
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _rss_mb():
+    """Current resident set size, or None where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * resource.getpagesize() / (1024 * 1024)
+
+
+class StageTimer:
+    """
+    Wall time, CPU time (all threads of the process) and memory per named stage: the change in RSS
+    over the stage, and how far the stage pushed the process's peak RSS (0 when it stayed below an earlier peak).
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        wall, cpu = time.perf_counter(), time.process_time()
+        rss, peak = _rss_mb(), _peak_rss_mb()
+        try:
+            yield
+        finally:
+            rss_after = _rss_mb()
+            self.stages[name] = {
+                "wall": round(time.perf_counter() - wall, 4),
+                "cpu": round(time.process_time() - cpu, 4),
+                "rss_delta_mb": round(rss_after - rss, 1) if rss is not None and rss_after is not None else None,
+                "peak_rss_increase_mb": round(_peak_rss_mb() - peak, 1),
+            }
+
+
+def synthetic_clip(seconds: float, seed: int = 0) -> np.ndarray:
+    """A chanted-like tone: a gliding fundamental with two harmonics, syllable-rate gaps and a little noise."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    f0 = 140 + 25 * np.sin(2 * np.pi * 0.4 * t) + 10 * np.sin(2 * np.pi * 1.3 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / SAMPLE_RATE
+    voice = np.sin(phase) + 0.5 * np.sin(2 * phase) + 0.25 * np.sin(3 * phase)
+    envelope = (np.sin(2 * np.pi * 2.5 * t) > -0.6).astype(np.float64)
+    return (0.2 * voice * envelope + 0.005 * rng.standard_normal(len(t))).astype(np.float32)
+
+
+def write_synthetic(lengths: list, directory: str) -> list:
+    import soundfile as sf
+
+    paths = []
+    for seconds in lengths:
+        path = os.path.join(directory, f"synthetic_{seconds:g}s.wav")
+        sf.write(path, synthetic_clip(seconds), SAMPLE_RATE)
+        paths.append(path)
+    return paths
+
+
+def _clip_name(path: str, work_dir: str) -> str:
+    # Synthetic clips live in a temporary directory: report them by name only
+    return os.path.basename(path) if path.startswith(work_dir) else os.path.relpath(path)
+
+
+def pick_reference(paths: list, work_dir: str) -> str:
+    """The first recording that decodes, as the rabbi's; a synthetic one if none does (placeholder audio/)."""
+    import soundfile as sf
+
+    for path in paths:
+        try:
+            if len(decode_file(path)):
+                return path
+        except Exception:
+            continue
+    path = os.path.join(work_dir, "reference_synthetic.wav")
+    sf.write(path, synthetic_clip(10, seed=1), SAMPLE_RATE)
+    return path
+
+
+def run_clip(path: str, stt, phonetics, plot_dir: str, reference_file: str, reference_cache) -> dict:
+    """
+    Every pipeline stage for one clip. "scoring" is the whole comparison against the rabbi's
+    recording as a request runs it (compare_recordings; only the DTW without ASR), with the
+    reference already analyzed.
+    """
+    from comparison import compare_recordings
+    from prosody import pitch_track, resample_contour, compare_pitch_dtw, plot_pitch
+    from word_scoring import frame_slice, normalize_word, score_words, word_spans
+    from vad import trim
+
+    timer = StageTimer()
+    with timer.stage("decode"):
+        audio = decode_file(path)
+    with timer.stage("vad"):
+        trimmed = trim(audio)
+    audio = trimmed.audio
+
+    words = []
+    text = ""
+    if stt is not None:
+        with timer.stage("transcribe"):
+            transcription = stt.transcribe_words(audio, language="he")
+        text, words = transcription["text"], transcription["words"]
+        with timer.stage("phonemes"):
+            phonetics.text_to_phones(text)
+
+    with timer.stage("pitch"):
+        f0, voiced = pitch_track(audio)
+        frames = np.where(voiced, f0, np.nan)
+        contour = resample_contour(f0)
+
+    with timer.stage("scoring"):
+        if stt is not None:
+            prosody_score = compare_recordings(audio, reference_file, "benchmark", stt, phonetics,
+                                               reference_cache)["prosody_score"]
+        else:
+            prosody_score, _path = compare_pitch_dtw(reference_cache.pitch_frames(reference_file), frames)
+
+    if stt is not None:
+        with timer.stage("words"):
+            reference_words = [{"word": w, "trope": []} for w in (normalize_word(w["word"]) for w in words) if w]
+            segments = [
+                None if span is None else {"span": span, "frames": frame_slice(frames, span)}
+                for span in word_spans([w["word"] for w in reference_words], words)
+            ]
+            score_words(reference_words, segments, words, frames, phonetics)
+
+    with timer.stage("plot"):
+        plot_pitch(contour, contour, save_path=os.path.join(plot_dir, "benchmark_plot.png"))
+
+    return {
+        "clip": _clip_name(path, plot_dir),
+        "audio_seconds": trimmed.report()["original_seconds"],
+        "speech_seconds": trimmed.report()["kept_seconds"],
+        "words": len(words),
+        "prosody_score": round(prosody_score, 2),
+        "stages": timer.stages,
+    }
+
+
+def summarize(clips: list) -> dict:
+    """Per stage over all clips: total and mean wall/CPU seconds, and wall seconds per audio second."""
+    summary = {}
+    audio_seconds = sum(clip["audio_seconds"] for clip in clips)
+    for stage in STAGES:
+        timings = [clip["stages"][stage] for clip in clips if stage in clip.get("stages", {})]
+        if not timings:
+            continue
+        wall = [t["wall"] for t in timings]
+        summary[stage] = {
+            "clips": len(timings),
+            "wall_total": round(sum(wall), 4),
+            "wall_mean": round(float(np.mean(wall)), 4),
+            "wall_max": round(max(wall), 4),
+            "cpu_total": round(sum(t["cpu"] for t in timings), 4),
+            "wall_per_audio_second": round(sum(wall) / audio_seconds, 5) if audio_seconds else None,
+        }
+    return summary
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def compare_reports(base: dict, current: dict):
+    """Print the change in mean wall time per stage (and load) between two benchmark reports."""
+    print(f"{'stage':<12}{'base':>10}{'current':>10}{'change':>10}   ({base['meta']['commit']}/{base['meta']['model']}"
+          f" -> {current['meta']['commit']}/{current['meta']['model']})")
+    rows = [("load", base["load"].get("wall"), current["load"].get("wall"))]
+    rows += [(stage, base["summary"].get(stage, {}).get("wall_mean"), current["summary"].get(stage, {}).get("wall_mean"))
+             for stage in STAGES]
+    for stage, before, after in rows:
+        if before is None or after is None:
+            continue
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "-"
+        print(f"{stage:<12}{before:>10.3f}{after:>10.3f}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every stage of the comparison pipeline")
+    parser.add_argument("--model", default="medium", help="Whisper model (tiny, base, small, medium, large)")
+    parser.add_argument("--backend", default=None, help="ASR backend (whisper, faster-whisper); default: ASR_BACKEND")
+    parser.add_argument("--audio-dir", action="append", default=None,
+                        help="תיקיית הקלטות (אפשר כמה פעמים; ברירת מחדל: audio ו-old)")
+    parser.add_argument("--synthetic", default=DEFAULT_SYNTHETIC, help="אורכי קטעים סינתטיים בשניות, מופרדים בפסיק")
+    parser.add_argument("--skip-asr", action="store_true", help="בלי טעינת מודל, תמלול ופונמות - רק פענוח, מלודיה וגרף")
+    parser.add_argument("--output", default=None, help="קובץ JSON לתוצאות (ברירת מחדל: cache/benchmarks/<commit>-<model>.json)")
+    parser.add_argument("--compare", default=None, help="דוח JSON קודם להשוואה")
+    parser.add_argument("--reference", default=None,
+                        help="הקלטת הרב שכל קטע מושווה אליה (ברירת מחדל: ההקלטה הראשונה שמתפענחת)")
+    args = parser.parse_args()
+
+    audio_dirs = args.audio_dir or ["audio", "old"]
+    paths = sorted(p for d in audio_dirs for ext in ("*.m4a", "*.mp3", "*.wav") for p in glob.glob(os.path.join(d, ext)))
+    lengths = [float(s) for s in args.synthetic.split(",") if s.strip()]
+
+    load = StageTimer()
+    with load.stage("imports"):
+        # The imports themselves are what is timed
+        for module in ("librosa", "matplotlib.figure", "prosody"):
+            importlib.import_module(module)
+    # JIT compilation (numba, librosa's first YIN) once up front, so it does not land on the first clip
+    with load.stage("kernels"):
+        from warmup import warm_kernels
+        warm_kernels()
+    stt = phonetics = None
+    if not args.skip_asr:
+        with load.stage("load"):
+            from speech_to_text import SpeechToText
+            from phonetics import Phonetics
+            stt = SpeechToText(model_name=args.model, backend=args.backend)
+            phonetics = Phonetics(lang_code="heb-Hebr")
+
+    clips = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        # Analyzed once up front, as the reference bundle is in production
+        with load.stage("reference"):
+            from reference_cache import ReferenceCache
+            reference_file = args.reference or pick_reference(paths, work_dir)
+            reference_cache = ReferenceCache(cache_dir=os.path.join(work_dir, "references"), bundle_path=None)
+            if stt is not None:
+                reference_cache.get_or_compute(reference_file, stt, phonetics, language="he")
+            reference_cache.pitch_frames(reference_file)
+        reference_name = _clip_name(reference_file, work_dir)
+        print(f"Scoring against {reference_name}")
+        for path in paths + write_synthetic(lengths, work_dir):
+            try:
+                clip = run_clip(path, stt, phonetics, work_dir, reference_file, reference_cache)
+            except Exception as e:
+                # The recordings in the repository may be placeholders - record the failure and go on
+                clip = {"clip": _clip_name(path, work_dir),
+                        "error": str(e).splitlines()[-1] if str(e) else type(e).__name__}
+                print(f"{clip['clip']}: failed ({clip['error']})")
+                clips.append(clip)
+                continue
+            stages = ", ".join(f"{name} {t['wall']:.3f}s" for name, t in clip["stages"].items())
+            print(f"{clip['clip']} ({clip['audio_seconds']}s): {stages}")
+            clips.append(clip)
+
+    measured = [clip for clip in clips if "stages" in clip]
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": datetime.now().isoformat(),
+            "model": None if args.skip_asr else args.model,
+            "backend": None if args.skip_asr else (args.backend or os.environ.get("ASR_BACKEND", "whisper")),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "reference": reference_name,
+        },
+        "load": {**load.stages.get("load", {}), "imports": load.stages["imports"], "kernels": load.stages["kernels"],
+                 "reference": load.stages["reference"]},
+        "clips": clips,
+        "summary": summarize(measured),
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+    output = args.output or os.path.join(DEFAULT_OUTPUT_DIR, f"{report['meta']['commit']}-{report['meta']['model'] or 'no-asr'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+    print(f"\n{len(measured)}/{len(clips)} clips measured, peak RSS {report['peak_rss_mb']} MB; wrote {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare_reports(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,47 @@
-import React, { useState } from 'react';
+import React, { useEffect, useState } from 'react';
 import { VerseCard } from './components/VerseCard';
 import { GroupedVerseCard } from './components/GroupedVerseCard';
-import tora from './data/torah.json';
 import './App.css';
 import BarMitzvahParashaPage from "./components/BarMitzvahStart";
 import parashaMap from "./parasha_map.json";
 import { Pasuk } from './data/psukim';
 
+const API_BASE = process.env.NODE_ENV === 'production'
+    ? '/api'  // Use relative path in production
+    : 'http://localhost:5001/api';  // Use localhost in development
+
+// The verses of a parasha, page by page from the server (the corpus is no longer bundled)
+async function fetchParasha(name: string): Promise<Pasuk[]> {
+    const verses: Pasuk[] = [];
+    let page = 1;
+    let pages = 1;
+    do {
+        const response = await fetch(`${API_BASE}/parasha/${encodeURIComponent(name)}?page=${page}&per_page=200`);
+        if (!response.ok) throw new Error(`Failed to load parasha ${name}: ${response.status}`);
+        const data = await response.json();
+        verses.push(...data.verses);
+        pages = data.pages;
+        page++;
+    } while (page <= pages);
+    return verses;
+}
+
 function App() {
     const [selectedParasha, setSelectedParasha] = React.useState<any>(
         JSON.parse(localStorage.getItem("selectedParasha") || "null")
     );
     const [showGrouped, setShowGrouped] = useState(false); // State to toggle between views
+    const [psukim, setPsukim] = useState<Pasuk[]>([]);
+
+    useEffect(() => {
+        if (!selectedParasha) return;
+        let cancelled = false;
+        setPsukim([]);
+        fetchParasha(selectedParasha.english)
+            .then((verses) => { if (!cancelled) setPsukim(verses); })
+            .catch((error) => console.error(error));
+        return () => { cancelled = true; };
+    }, [selectedParasha]);
 
     const onParashaSelected = (data: any) => {
         console.log("onParashaSelected", data);
@@ -27,8 +57,7 @@ function App() {
         }
     };
 
-    const groupedPsukim = selectedParasha && tora && tora.filter(a => a.parasha.toLowerCase().replace("'", "") === selectedParasha.english.toLowerCase().replace("'", ""))
-        .reduce((groups: Pasuk[][], pasuk, index) => {
+    const groupedPsukim = psukim.reduce((groups: Pasuk[][], pasuk, index) => {
             if (index % 3 === 0) groups.push([]);
             groups[groups.length - 1].push(pasuk);
             return groups;
@@ -51,9 +80,7 @@ function App() {
                             ? groupedPsukim.map((group:any, index:number) => (
                                 <GroupedVerseCard key={index} psukim={group} />
                               ))
-                            : tora
-                                .filter(a => a.parasha.toLowerCase().replace("'", "") === selectedParasha.english.toLowerCase().replace("'", ""))
-                                .map((pasuk) => (
+                            : psukim.map((pasuk) => (
                                     <VerseCard key={pasuk.id} pasuk={pasuk} />
                                 ))}
                     </main>
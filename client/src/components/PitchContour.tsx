@@ -0,0 +1,30 @@
+import React from 'react';
+
+interface PitchContourProps {
+  rabbi: number[];
+  user: number[];
+  width?: number;
+  height?: number;
+}
+
+// Rabbi's and student's pitch contours (Hz) as two lines, drawn from the comparison result
+export const PitchContour: React.FC<PitchContourProps> = ({ rabbi, user, width = 600, height = 240 }) => {
+  const values = [...rabbi, ...user].filter(v => v > 0);
+  if (values.length === 0) return null;
+  const min = Math.min(...values);
+  const max = Math.max(...values);
+  const range = max - min || 1;
+
+  const points = (contour: number[]) => contour
+    .map((v, i) => `${(i / Math.max(contour.length - 1, 1)) * width},${height - ((v - min) / range) * height}`)
+    .join(' ');
+
+  return (
+    <svg viewBox={`0 0 ${width} ${height}`} className="comparison-plot" role="img" aria-label="Pitch comparison">
+      <polyline points={points(rabbi)} fill="none" stroke="blue" strokeWidth={2} />
+      <polyline points={points(user)} fill="none" stroke="orange" strokeWidth={2} />
+      <text x={8} y={16} fontSize={12} fill="blue">רב (Reference)</text>
+      <text x={8} y={32} fontSize={12} fill="orange">ילד (Child)</text>
+    </svg>
+  );
+};
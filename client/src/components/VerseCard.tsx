@@ -1,7 +1,7 @@
 import React, { useState, useRef, useEffect } from 'react';
-import tora from '../data/torah.json';
 import './VerseCard.css';
 import {Pasuk} from "../data/psukim";
+import {PitchContour} from "./PitchContour";
 
 interface VerseCardProps {
   pasuk?: Pasuk;
@@ -14,6 +14,7 @@ interface ComparisonResult {
   phonetic_score: number;
   prosody_score: number;
   overall_score: number;
+  contours?: { rabbi: number[]; user: number[] };
   plot_available: boolean;
 }
 
@@ -133,6 +134,22 @@ export const VerseCard: React.FC<VerseCardProps> = ({ pasuk }) => {
     }
   };
 
+  // The comparison runs as a background job on the server - poll until it finishes
+  const waitForResult = async (job: any): Promise<ComparisonResult> => {
+    while (job.status === 'queued' || job.status === 'running') {
+      await new Promise(resolve => setTimeout(resolve, 1000));
+      const response = await fetch(`${API_BASE}/results/${job.session_id}`);
+      if (!response.ok) {
+        throw new Error('Results not found');
+      }
+      job = await response.json();
+    }
+    if (job.status === 'failed') {
+      throw new Error(job.error || 'Comparison failed');
+    }
+    return job;
+  };
+
   const compareWithRabbi = async () => {
     if (!sessionId) {
       setError('אין הקלטה להשוואה / No recording to compare');
@@ -150,11 +167,11 @@ export const VerseCard: React.FC<VerseCardProps> = ({ pasuk }) => {
         headers: {
           'Content-Type': 'application/json',
         },
-        body: JSON.stringify({ session_id: sessionId, pasuk_id: pasukId }),
+        body: JSON.stringify({ session_id: sessionId, pasuk_id: pasukId, book: pasuk?.book }),
       });
 
       if (response.ok) {
-        const result = await response.json();
+        const result = await waitForResult(await response.json());
         setComparisonResult(result);
       } else {
         const errorData = await response.json();
@@ -301,11 +318,15 @@ export const VerseCard: React.FC<VerseCardProps> = ({ pasuk }) => {
               {comparisonResult.plot_available && (
                 <div className="pitch-analysis">
                   <h5>ניתוח מלודיה / Pitch Analysis:</h5>
-                  <img
-                    src={`${API_BASE}/comparison-plot/${comparisonResult.session_id}`}
-                    alt="Pitch comparison"
-                    className="comparison-plot"
-                  />
+                  {comparisonResult.contours ? (
+                    <PitchContour rabbi={comparisonResult.contours.rabbi} user={comparisonResult.contours.user} />
+                  ) : (
+                    <img
+                      src={`${API_BASE}/comparison-plot/${comparisonResult.session_id}`}
+                      alt="Pitch comparison"
+                      className="comparison-plot"
+                    />
+                  )}
                 </div>
               )}
             </div>
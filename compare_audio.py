@@ -8,6 +8,7 @@ import argparse
 import os
 import sys
 
+from audio_io import decode_file
 from speech_to_text import SpeechToText
 from phonetics import Phonetics
 from prosody import extract_pitch_contour, compare_pitch, plot_pitch
@@ -18,6 +19,7 @@ from rapidfuzz import fuzz
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--model", default="small", help="Whisper model (tiny, base, small, medium, large)")
+    parser.add_argument("--backend", default=None, help="ASR backend (whisper, faster-whisper); default: ASR_BACKEND")
     parser.add_argument("--lang", default="he", help="שפה (ברירת מחדל: עברית)")
     args = parser.parse_args()
     args.ref = 'b1.mp3'
@@ -26,10 +28,14 @@ def main():
         print("קבצי קול לא קיימים.")
         sys.exit(1)
 
+    # --- פענוח פעם אחת לכל קובץ, משותף לטרנסקריפציה ולמלודיה ---
+    ref_audio = decode_file(args.ref)
+    child_audio = decode_file(args.child)
+
     # --- שלב 1: טרנסקריפציה ---
-    stt = SpeechToText(model_name=args.model)
-    ref_text = stt.transcribe(args.ref, language=args.lang)
-    child_text = stt.transcribe(args.child, language=args.lang)
+    stt = SpeechToText(model_name=args.model, backend=args.backend)
+    ref_text = stt.transcribe(ref_audio, language=args.lang)
+    child_text = stt.transcribe(child_audio, language=args.lang)
 
     print("טקסט הרב:", ref_text)
     print("טקסט הילד:", child_text)
@@ -41,8 +47,8 @@ def main():
     phon_score = fuzz.ratio(ref_ph, child_ph)
 
     # --- שלב 3: השוואת מלודיה (pitch contour) ---
-    pitch_ref = extract_pitch_contour(args.ref)
-    pitch_child = extract_pitch_contour(args.child)
+    pitch_ref = extract_pitch_contour(ref_audio)
+    pitch_child = extract_pitch_contour(child_audio)
     prosody_score = compare_pitch(pitch_ref, pitch_child)
     plot_pitch(pitch_ref, pitch_child, "pitch_comparison.png")
 
@@ -0,0 +1,319 @@
+"""
+comparison.py
+צינור ההשוואה המשותף לשני השרתים: הקלטת התלמיד מול ניתוח הרב השמור במטמון.
+"""
+
+import logging
+import os
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from metrics import metrics
+
+
+def _no_progress(stage: str, fraction: float):
+    pass
+
+
+def _trim_silence(user_audio):
+    """
+    The student's recording with the silence around it and its long pauses cut (vad.py), so
+    ASR and pitch tracking run on speech only. Returns (audio, TrimmedAudio or None when VAD is off).
+    """
+    from vad import VAD_ENABLED, trim
+
+    if not VAD_ENABLED:
+        return user_audio, None
+    if not isinstance(user_audio, np.ndarray):
+        from audio_io import decode_file
+        user_audio = decode_file(user_audio)
+    with metrics.span("vad"):
+        trimmed = trim(user_audio)
+    logging.debug(f"Speech spans: {trimmed.report()}")
+    return trimmed.audio, trimmed
+
+
+def _upload_times(words: list, trimmed) -> list:
+    """Word entries with their start/end moved from the trimmed audio back to the upload's time."""
+    if trimmed is not None:
+        for word in words:
+            for field in ("start", "end"):
+                if word.get(field) is not None:
+                    word[field] = round(trimmed.original_time(word[field]), 2)
+    return words
+
+
+@metrics.timed("compare_recordings")
+def compare_recordings(user_audio, rabbi_file: str, session_id: str,
+                       stt_model, phonetics_model, reference_cache,
+                       verse_text: str = None, verse_phonemes: str = None, verse_words: list = None,
+                       progress=_no_progress) -> dict:
+    """
+    Score the user's recording against the rabbi's; progress(stage, fraction) is called between stages.
+
+    user_audio is a file path or an already decoded 16 kHz buffer; its speech (see
+    _trim_silence) is handed to both the ASR and the pitch stage.
+
+    With verse_text (the canonical verse from torah.json) the phonetic reference is
+    the text itself and the rabbi's recording is only used for its melody; verse_words
+    (TorahText.words) are then the words scored one by one, with their trope.
+    """
+    from prosody import resample_contour, compare_pitch_dtw
+    from memo_cache import pitch_track
+    from rapidfuzz import fuzz
+    from word_scoring import score_words
+
+    progress("reference", 0.05)
+    if verse_text is not None:
+        logging.debug("Using the verse text as phonetic reference")
+        reference = {"text": verse_text, "phonemes": verse_phonemes, "pitch": reference_cache.pitch(rabbi_file),
+                     "pitch_frames": reference_cache.pitch_frames(rabbi_file)}
+    else:
+        logging.debug("Loading rabbi's reference analysis")
+        reference = reference_cache.get_or_compute(rabbi_file, stt_model, phonetics_model, language="he")
+    rabbi_text = reference["text"]
+    logging.debug(f"Rabbi transcription: {rabbi_text}")
+
+    user_audio, trimmed = _trim_silence(user_audio)
+
+    progress("transcribe", 0.2)
+    logging.debug("Transcribing user's audio")
+    with metrics.span("transcribe"):
+        transcription = stt_model.transcribe_words(user_audio, language="he")
+    user_text = transcription["text"]
+    logging.debug(f"User transcription: {user_text}")
+
+    # Phonetic comparison
+    progress("phonetics", 0.6)
+    try:
+        with metrics.span("text_to_phones"):
+            rabbi_phones = reference["phonemes"] or phonetics_model.text_to_phones(rabbi_text)
+            user_phones = phonetics_model.text_to_phones(user_text)
+        phonetic_score = fuzz.ratio(rabbi_phones, user_phones)
+        logging.debug(f"Phonetic score: {phonetic_score}")
+    except Exception as e:
+        logging.warning(f"Phonetic analysis warning: {e}")
+        # Fallback to simple text comparison
+        phonetic_score = fuzz.ratio(rabbi_text, user_text)
+
+    progress("prosody", 0.7)
+    logging.debug("Extracting pitch contours")
+    rabbi_pitch = reference["pitch"]
+    with metrics.span("extract_pitch_contour"):
+        user_f0, user_voiced = pitch_track(user_audio)
+        user_pitch = resample_contour(user_f0)
+        user_frames = np.where(user_voiced, user_f0, np.nan)
+    # Time-aligned over voiced frames, so a slower or faster reading is not penalized
+    with metrics.span("compare_pitch"):
+        prosody_score, _alignment = compare_pitch_dtw(reference["pitch_frames"], user_frames)
+    logging.debug(f"Prosody score: {prosody_score}")
+
+    progress("words", 0.8)
+    reference_words = _reference_words(rabbi_file, stt_model, phonetics_model, reference_cache, verse_words)
+    segments = reference_cache.word_segments(rabbi_file, reference_words, stt_model)
+    with metrics.span("score_words"):
+        words = _upload_times(score_words(reference_words, segments, transcription["words"], user_frames,
+                                          phonetics_model), trimmed)
+
+    # Calculate overall score (weighted average)
+    overall_score = (phonetic_score * 0.6) + (prosody_score * 0.4)
+    logging.info(f"Overall score: {overall_score}")
+
+    return {
+        "session_id": session_id,
+        "timestamp": datetime.now().isoformat(),
+        "rabbi_text": rabbi_text,
+        "user_text": user_text,
+        "phonetic_score": round(phonetic_score, 2),
+        "prosody_score": round(prosody_score, 2),
+        "overall_score": round(overall_score, 2),
+        "reference": "text" if verse_text is not None else "audio",
+        "words": words,
+        "contours": {"rabbi": contour_list(rabbi_pitch), "user": contour_list(user_pitch)},
+        "speech": trimmed.report() if trimmed else None,
+        "plot_available": True
+    }
+
+
+def contour_list(contour) -> list:
+    """A pitch contour as a JSON list, in Hz to 0.1 - the client draws it; the PNG is rendered only on request."""
+    return np.round(np.asarray(contour, dtype=np.float64), 1).tolist()
+
+
+def render_plot(results: dict, plot_path: str):
+    """Draw the contours of a comparison's results to plot_path, the first time the plot is asked for."""
+    from prosody import plot_pitch
+
+    tmp_path = f"{plot_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with metrics.span("plot_pitch"):
+            plot_pitch(results["contours"]["rabbi"], results["contours"]["user"], save_path=tmp_path)
+        os.replace(tmp_path, plot_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def _reference_words(rabbi_file: str, stt_model, phonetics_model, reference_cache, verse_words: list = None) -> list:
+    if verse_words is not None:
+        return verse_words
+    from word_scoring import normalize_word
+
+    timed_words = reference_cache.transcript(rabbi_file, stt_model, phonetics_model, language="he")["words"]
+    return [{"word": word, "trope": []} for word in (normalize_word(w["word"]) for w in timed_words) if word]
+
+
+@metrics.timed("compare_word")
+def compare_word(user_audio, rabbi_file: str, word_index: int, session_id: str,
+                 stt_model, phonetics_model, reference_cache, verse_words: list = None,
+                 progress=_no_progress) -> dict:
+    """
+    Score a retry of a single word (user_audio holds just that word) against the
+    rabbi's segment for it. word_index counts the words as in compare_recordings' "words".
+    """
+    from memo_cache import pitch_track
+    from word_scoring import score_word
+
+    progress("reference", 0.05)
+    reference_words = _reference_words(rabbi_file, stt_model, phonetics_model, reference_cache, verse_words)
+    if not 0 <= word_index < len(reference_words):
+        raise ValueError(f"Word index {word_index} out of range (pasuk has {len(reference_words)} words)")
+    segment = reference_cache.word_segments(rabbi_file, reference_words, stt_model)[word_index]
+
+    user_audio, trimmed = _trim_silence(user_audio)
+
+    progress("transcribe", 0.2)
+    with metrics.span("transcribe"):
+        heard = stt_model.transcribe(user_audio, language="he")
+    logging.debug(f"User word transcription: {heard}")
+
+    progress("prosody", 0.7)
+    user_f0, user_voiced = pitch_track(user_audio)
+    entry = score_word(reference_words[word_index], segment["frames"] if segment is not None else None,
+                       heard, np.where(user_voiced, user_f0, np.nan), phonetics_model)
+    if entry["prosody_score"] is None:
+        overall_score = entry["phonetic_score"]
+    else:
+        overall_score = (entry["phonetic_score"] * 0.6) + (entry["prosody_score"] * 0.4)
+
+    return {
+        "session_id": session_id,
+        "timestamp": datetime.now().isoformat(),
+        "index": word_index,
+        **entry,
+        "overall_score": round(overall_score, 2),
+        "speech": trimmed.report() if trimmed else None,
+    }
+
+
+@metrics.timed("compare_batch")
+def compare_batch(user_audio, references: list, session_id: str,
+                  stt_model, phonetics_model, reference_cache,
+                  progress=_no_progress) -> dict:
+    """
+    Score one recording that spans several psukim, in order.
+
+    references: one dict per pasuk - {"pasuk_id", "rabbi_file"} plus "verse_text",
+    "verse_phonemes" and "verse_words" in text mode. ASR and pitch tracking run once
+    over the whole recording; the student's pitch is aligned (DTW) against the rabbi's
+    recordings back to back, which splits the recording into one span per pasuk.
+    """
+    from prosody import YIN_HOP_LENGTH, resample_contour, compare_pitch_dtw
+    from memo_cache import pitch_track
+    from rapidfuzz import fuzz
+    from audio_io import SAMPLE_RATE
+    from word_scoring import score_words
+
+    progress("reference", 0.05)
+    loaded = []
+    for ref in references:
+        if ref.get("verse_text") is not None:
+            reference = {"text": ref["verse_text"], "phonemes": ref.get("verse_phonemes"),
+                         "pitch": reference_cache.pitch(ref["rabbi_file"])}
+        else:
+            reference = reference_cache.get_or_compute(ref["rabbi_file"], stt_model, phonetics_model, language="he")
+        reference["pitch_frames"] = reference_cache.pitch_frames(ref["rabbi_file"])
+        loaded.append(reference)
+
+    user_audio, trimmed = _trim_silence(user_audio)
+
+    progress("transcribe", 0.2)
+    with metrics.span("transcribe"):
+        transcription = stt_model.transcribe_words(user_audio, language="he")
+    logging.debug(f"User transcription: {transcription['text']}")
+
+    progress("prosody", 0.6)
+    with metrics.span("extract_pitch_contour"):
+        user_f0, user_voiced = pitch_track(user_audio)
+        user_frames = np.where(user_voiced, user_f0, np.nan)
+    boundaries = np.cumsum([0] + [len(reference["pitch_frames"]) for reference in loaded])
+    with metrics.span("compare_pitch"):
+        _score, path = compare_pitch_dtw(np.concatenate([reference["pitch_frames"] for reference in loaded]),
+                                         user_frames)
+
+    progress("words", 0.8)
+    frame_seconds = YIN_HOP_LENGTH / SAMPLE_RATE
+    psukim = []
+    for k, (ref, reference) in enumerate(zip(references, loaded)):
+        # The student's frames aligned to this pasuk's stretch of the reference
+        first = np.searchsorted(path[:, 0], boundaries[k], side="left")
+        last = np.searchsorted(path[:, 0], boundaries[k + 1], side="left")
+        user_start, user_end = (int(path[first, 1]), int(path[last - 1, 1]) + 1) if last > first else (0, 0)
+        start, end = user_start * frame_seconds, user_end * frame_seconds
+
+        # Words belong to the pasuk their midpoint falls in; the first and last pasuk take the edges
+        words = [
+            w for w in transcription["words"]
+            if (k == 0 or (w["start"] + w["end"]) / 2 >= start)
+            and (k == len(references) - 1 or (w["start"] + w["end"]) / 2 < end)
+        ]
+        user_text = " ".join(w["word"] for w in words)
+        try:
+            rabbi_phones = reference["phonemes"] or phonetics_model.text_to_phones(reference["text"])
+            phonetic_score = fuzz.ratio(rabbi_phones, phonetics_model.text_to_phones(user_text))
+        except Exception as e:
+            logging.warning(f"Phonetic analysis warning: {e}")
+            phonetic_score = fuzz.ratio(reference["text"], user_text)
+        prosody_score = compare_pitch_dtw(reference["pitch_frames"], user_frames[user_start:user_end])[0]
+
+        reference_words = _reference_words(ref["rabbi_file"], stt_model, phonetics_model, reference_cache,
+                                           ref.get("verse_words"))
+        segments = reference_cache.word_segments(ref["rabbi_file"], reference_words, stt_model)
+        psukim.append({
+            "pasuk_id": ref["pasuk_id"],
+            # In the upload's own time, so the client can seek its recording
+            "start": round(trimmed.original_time(start) if trimmed else start, 2),
+            "end": round(trimmed.original_time(end) if trimmed else end, 2),
+            "rabbi_text": reference["text"],
+            "user_text": user_text,
+            "phonetic_score": round(phonetic_score, 2),
+            "prosody_score": round(prosody_score, 2),
+            "overall_score": round((phonetic_score * 0.6) + (prosody_score * 0.4), 2),
+            "words": _upload_times(score_words(reference_words, segments, words, user_frames, phonetics_model),
+                                   trimmed),
+        })
+
+    phonetic_score = float(np.mean([p["phonetic_score"] for p in psukim]))
+    prosody_score = float(np.mean([p["prosody_score"] for p in psukim]))
+    overall_score = (phonetic_score * 0.6) + (prosody_score * 0.4)
+    logging.info(f"Overall score ({len(psukim)} psukim): {overall_score}")
+
+    rabbi_pitch = np.concatenate([reference["pitch"] for reference in loaded])
+
+    return {
+        "session_id": session_id,
+        "timestamp": datetime.now().isoformat(),
+        "rabbi_text": " ".join(p["rabbi_text"] for p in psukim),
+        "user_text": transcription["text"],
+        "phonetic_score": round(phonetic_score, 2),
+        "prosody_score": round(prosody_score, 2),
+        "overall_score": round(overall_score, 2),
+        "reference": "text" if all(ref.get("verse_text") is not None for ref in references) else "audio",
+        "psukim": psukim,
+        "contours": {"rabbi": contour_list(rabbi_pitch),
+                     "user": contour_list(resample_contour(user_f0, len(rabbi_pitch)))},
+        "speech": trimmed.report() if trimmed else None,
+        "plot_available": True
+    }
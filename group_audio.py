@@ -0,0 +1,140 @@
+"""
+group_audio.py
+השמעת קבוצת פסוקים ברצף: חיבור הקלטות הרב לקובץ m4a אחד תקין (ffmpeg concat, בלי קידוד מחדש כשאפשר),
+שנשמר במטמון על הדיסק לפי תוכן הקבצים וסדרם, עם פינוי LRU לפי גודל כולל.
+"""
+
+import hashlib
+import os
+import re
+import subprocess
+import tempfile
+import threading
+
+from reference_cache import file_sha256
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "GROUP_AUDIO_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "group_audio"),
+)
+DEFAULT_MAX_BYTES = int(os.environ.get("GROUP_AUDIO_CACHE_MB", 512)) * 1024 * 1024
+MAX_GROUP_PSUKIM = 60
+
+# Rabbi recordings are named <chapter>_<pasuk>.m4a
+PASUK_NAME_RE = re.compile(r"\d+_\d+")
+
+
+class ConcatError(Exception):
+    pass
+
+
+def group_names(ids: str = None, psukim: list = None) -> list:
+    """
+    "<chapter>_<pasuk>" names of a group, from "25_19,25_20" (GET) or [{"chapter", "pasuk"}] (POST).
+    Returns None when the group is empty, too long or malformed.
+    """
+    if ids is not None:
+        names = [name.strip() for name in ids.split(",") if name.strip()]
+    else:
+        names = [f"{pasuk.get('chapter')}_{pasuk.get('pasuk')}" for pasuk in psukim or []]
+    if not names or len(names) > MAX_GROUP_PSUKIM or not all(PASUK_NAME_RE.fullmatch(n) for n in names):
+        return None
+    return names
+
+
+def _run_ffmpeg(args: list):
+    result = subprocess.run(["ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y", *args],
+                            capture_output=True)
+    if result.returncode != 0:
+        raise ConcatError(result.stderr.decode("utf-8", "replace").strip() or "ffmpeg failed")
+
+
+def concat_audio(audio_files: list, output_path: str):
+    """
+    Join recordings into one m4a. The streams are copied as they are when they share
+    codec parameters (the rabbi's recordings do); otherwise they are re-encoded to AAC.
+    """
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="utf-8") as listing:
+        for audio_file in audio_files:
+            escaped = os.path.abspath(audio_file).replace("'", "'\\''")
+            listing.write(f"file '{escaped}'\n")
+    try:
+        concat_input = ["-f", "concat", "-safe", "0", "-i", listing.name, "-vn"]
+        try:
+            _run_ffmpeg([*concat_input, "-c", "copy", "-movflags", "+faststart", "-f", "mp4", output_path])
+        except ConcatError:
+            _run_ffmpeg([*concat_input, "-c:a", "aac", "-b:a", "128k", "-movflags", "+faststart",
+                         "-f", "mp4", output_path])
+    finally:
+        os.unlink(listing.name)
+
+
+class GroupAudioCache:
+    """Concatenated recordings keyed by the content hashes of their parts, in order."""
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _digest(self, audio_file: str) -> str:
+        stat = os.stat(audio_file)
+        stamp = (os.path.abspath(audio_file), stat.st_size, stat.st_mtime_ns)
+        digest = self._hashes.get(stamp)
+        if digest is None:
+            digest = file_sha256(audio_file)
+            self._hashes[stamp] = digest
+        return digest
+
+    def key(self, audio_files: list) -> str:
+        return hashlib.sha256("\n".join(self._digest(f) for f in audio_files).encode()).hexdigest()
+
+    def get(self, audio_files: list):
+        """(path, key) of the concatenation of audio_files, built on first request."""
+        key = self.key(audio_files)
+        path = os.path.join(self.cache_dir, f"{key}.m4a")
+        if os.path.exists(path):
+            # mtime is the LRU clock
+            os.utime(path)
+            return path, key
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if not os.path.exists(path):
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                try:
+                    concat_audio(audio_files, tmp_path)
+                    os.replace(tmp_path, path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.unlink(tmp_path)
+                self.evict(keep=path)
+        return path, key
+
+    def evict(self, keep: str = None):
+        """Remove the least recently served files until the cache fits in max_bytes."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".m4a"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+                total -= size
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,46 @@
+"""
+gunicorn.conf.py
+הרצת production_server בכמה תהליכי worker: המודלים נטענים פעם אחת בתהליך הראשי לפני ה-fork,
+כך שמשקלי Whisper משותפים בין ה-workers (copy-on-write) במקום להיטען בכל אחד מהם.
+
+    gunicorn --config gunicorn.conf.py production_server:app
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+# Requests mostly wait on the comparison queue and on I/O, so each worker serves them from a thread pool
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+# Import the app - and with PRELOAD_MODELS the models - once in the master, then fork
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+# On SIGTERM a worker stops accepting, finishes its requests and its queued comparisons within this
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 60))
+keepalive = 5
+accesslog = "-"
+
+if workers > 1:
+    # Jobs and results must be visible to whichever worker the client polls next
+    os.environ.setdefault("JOB_QUEUE_BACKEND", "sqlite")
+    os.environ.setdefault("RESULTS_BACKEND", "sqlite")
+    os.environ.setdefault("UPLOAD_DIR", os.path.join("cache", "uploads"))
+
+
+def when_ready(server):
+    if preload_app and os.environ.get("PRELOAD_MODELS", "1") == "1":
+        import production_server
+        server.log.info("Loading libraries and models before forking workers")
+        # The workers inherit the finished warm-up steps and are ready as soon as they start
+        production_server.warmup.run()
+
+
+def post_fork(server, worker):
+    import production_server
+    production_server.start_background_threads()
+
+
+def worker_exit(server, worker):
+    import production_server
+    production_server.shutdown(graceful_timeout)
@@ -0,0 +1,266 @@
+"""
+job_queue.py
+תור עבודות בתוך התהליך עבור השוואות אודיו: מאגר עובדים מוגבל, סטטוס והתקדמות לכל עבודה.
+"""
+
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class QueueFull(Exception):
+    pass
+
+
+class MemoryJobBackend:
+    """Job records in a dict - the default, single-process backend."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, job_id: str, record: dict):
+        with self._lock:
+            self._jobs[job_id] = dict(record)
+
+    def update(self, job_id: str, token: str = None, **fields) -> bool:
+        """Update a job's record; with a token, only if the record still belongs to that submission."""
+        with self._lock:
+            record = self._jobs.get(job_id)
+            if record is None or (token is not None and record.get("token") != token):
+                return False
+            record.update(fields)
+            return True
+
+    def get(self, job_id: str):
+        with self._lock:
+            record = self._jobs.get(job_id)
+            return dict(record) if record is not None else None
+
+    def purge(self, before: float) -> int:
+        """Forget finished jobs last updated before `before`."""
+        with self._lock:
+            old = [job_id for job_id, record in self._jobs.items()
+                   if record["status"] in (DONE, FAILED) and record["updated"] < before]
+            for job_id in old:
+                del self._jobs[job_id]
+        return len(old)
+
+
+class SQLiteJobBackend:
+    """Job records in a local SQLite file, readable by every process on the node."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT, stage TEXT, progress REAL, "
+                "result TEXT, error TEXT, created REAL, updated REAL, request TEXT, token TEXT)"
+            )
+            # Databases created before jobs were tied to their request parameters
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column in ("request", "token"):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} TEXT")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def create(self, job_id: str, record: dict):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, status, stage, progress, result, error, created, updated, request, token) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, record["status"], record["stage"], record["progress"],
+                 json.dumps(record["result"]), record["error"], record["created"], record["updated"],
+                 record["request"], record["token"]),
+            )
+
+    def update(self, job_id: str, token: str = None, **fields) -> bool:
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"])
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        where, params = ("id = ? AND token = ?", (job_id, token)) if token is not None else ("id = ?", (job_id,))
+        with self._connect() as conn:
+            return conn.execute(f"UPDATE jobs SET {columns} WHERE {where}", (*fields.values(), *params)).rowcount > 0
+
+    def get(self, job_id: str):
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        record = dict(row)
+        record["job_id"] = record.pop("id")
+        record["result"] = json.loads(record["result"]) if record["result"] else None
+        return record
+
+    def purge(self, before: float) -> int:
+        with self._connect() as conn:
+            return conn.execute("DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?",
+                                (DONE, FAILED, before)).rowcount
+
+
+class JobQueue:
+    """
+    Bounded pool of worker threads fed from a bounded queue.
+
+    submit() returns immediately; the job function receives a progress(stage, fraction)
+    callback and its return value becomes the job's result, also handed to
+    on_result(job_id, result) when given. Finished jobs are kept for `ttl` seconds,
+    until purge() drops them.
+
+    A job id can be submitted again; the new submission replaces the record, and a
+    replaced job that is still running no longer updates it.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 32, backend=None, ttl: float = 6 * 3600,
+                 on_result=None):
+        self.backend = backend if backend is not None else MemoryJobBackend()
+        self.on_result = on_result
+        self.workers = workers
+        self.ttl = ttl
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._threads = []
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._closing = False
+
+    def start(self):
+        """Start the worker threads in this process - again after a fork, since threads do not survive one."""
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"compare-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def shutdown(self, timeout: float) -> bool:
+        """Stop taking jobs and wait up to `timeout` seconds for the queued and running ones to finish."""
+        self._closing = True
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.2)
+        return not self._queue.unfinished_tasks
+
+    def submit(self, job_id: str, fn, *args, **kwargs) -> dict:
+        return self._submit(job_id, None, fn, args, kwargs)
+
+    def submit_request(self, job_id: str, request: dict, fn, *args, **kwargs) -> dict:
+        """
+        Submit fn under job_id unless the identical request (endpoint and parameters) is already
+        queued or running there - a retried POST then just gets that job's status back.
+        A finished job, or one for other parameters, is replaced.
+        """
+        key = json.dumps(request, sort_keys=True, default=str)
+        job = self.get(job_id)
+        if job is not None and job["status"] in (QUEUED, RUNNING) and job.get("request") == key:
+            return job
+        return self._submit(job_id, key, fn, args, kwargs)
+
+    def _submit(self, job_id: str, key: str, fn, args: tuple, kwargs: dict) -> dict:
+        if self._closing:
+            raise QueueFull("Shutting down")
+        self.start()
+        now = time.time()
+        token = uuid.uuid4().hex
+        record = {
+            "job_id": job_id,
+            "status": QUEUED,
+            "stage": "queued",
+            "progress": 0.0,
+            "result": None,
+            "error": None,
+            "created": now,
+            "updated": now,
+            "request": key,
+            "token": token,
+        }
+        self.backend.create(job_id, record)
+        try:
+            self._queue.put_nowait((job_id, token, fn, args, kwargs))
+        except queue.Full:
+            self.backend.update(job_id, token=token, status=FAILED, error="Server busy, try again later",
+                                updated=time.time())
+            raise QueueFull(f"{self._queue.maxsize} comparisons already pending")
+        return record
+
+    def get(self, job_id: str):
+        return self.backend.get(job_id)
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def purge(self) -> int:
+        return self.backend.purge(time.time() - self.ttl)
+
+    def _work(self):
+        while True:
+            job_id, token, fn, args, kwargs = self._queue.get()
+            self.backend.update(job_id, token=token, status=RUNNING, stage="started", updated=time.time())
+
+            def progress(stage: str, fraction: float, job_id=job_id, token=token):
+                self.backend.update(job_id, token=token, stage=stage, progress=round(fraction, 2), updated=time.time())
+
+            try:
+                result = fn(*args, progress=progress, **kwargs)
+                current = self.backend.update(job_id, token=token, status=DONE, stage="done", progress=1.0,
+                                              result=result, updated=time.time())
+                # A result of a replaced submission is dropped
+                if current and self.on_result is not None:
+                    self.on_result(job_id, result)
+            except Exception as e:
+                traceback.print_exc()
+                self.backend.update(job_id, token=token, status=FAILED, error=str(e), updated=time.time())
+            finally:
+                self._queue.task_done()
+
+
+def job_status(record: dict) -> dict:
+    """Client-facing view of a job: its status, and the result fields once done."""
+    status = {
+        "session_id": record["job_id"],
+        "job_id": record["job_id"],
+        "status": record["status"],
+        "stage": record["stage"],
+        "progress": record["progress"],
+    }
+    if record["status"] == DONE and record["result"]:
+        status.update(record["result"])
+    if record["status"] == FAILED:
+        status["error"] = record["error"]
+    return status
+
+
+def create_job_queue(on_result=None) -> JobQueue:
+    """Build the queue from COMPARE_WORKERS, COMPARE_MAX_PENDING, JOB_QUEUE_BACKEND, JOB_QUEUE_DB and JOB_TTL."""
+    backend = None
+    if os.environ.get("JOB_QUEUE_BACKEND", "memory") == "sqlite":
+        backend = SQLiteJobBackend(os.environ.get("JOB_QUEUE_DB", os.path.join("cache", "jobs.sqlite3")))
+    return JobQueue(
+        workers=int(os.environ.get("COMPARE_WORKERS", 2)),
+        max_pending=int(os.environ.get("COMPARE_MAX_PENDING", 32)),
+        backend=backend,
+        ttl=float(os.environ.get("JOB_TTL", 6 * 3600)),
+        on_result=on_result,
+    )
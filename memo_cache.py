@@ -0,0 +1,241 @@
+"""
+memo_cache.py
+זיכרון תוצאות לפי תוכן: תמלול, פונמות (לכל מילה) ומלודיה של הקלטות התלמיד, לפי hash של האודיו
+או הטקסט יחד עם המודל והפרמטרים - כך שהקלטה שנשלחה שוב (retry, ציון מחדש) לא עוברת שוב את השלבים היקרים.
+שכבת LRU מוגבלת בזיכרון, ושכבת דיסק אופציונלית (MEMO_CACHE_DIR) המשותפת לכל ה-workers.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_MAX_ENTRIES = int(os.environ.get("MEMO_CACHE_ENTRIES", 256))
+# Unset: memory only
+DEFAULT_DISK_DIR = os.environ.get("MEMO_CACHE_DIR") or None
+DEFAULT_MAX_DISK_BYTES = int(os.environ.get("MEMO_CACHE_DISK_MB", 256)) * 1024 * 1024
+# Disk usage is checked every this many writes
+EVICT_EVERY = 64
+LOCK_STRIPES = 64
+
+
+def content_key(*parts) -> str:
+    """sha256 of the JSON of the parts - the model, its parameters and the input's digest."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def audio_digest(audio) -> str:
+    """Content hash of a decoded buffer (its samples) or of an audio file (its bytes)."""
+    if isinstance(audio, np.ndarray):
+        digest = hashlib.sha256(str((audio.dtype, audio.shape)).encode())
+        digest.update(np.ascontiguousarray(audio).data)
+        return digest.hexdigest()
+    from reference_cache import file_sha256
+
+    return file_sha256(audio)
+
+
+class ContentCache:
+    """
+    Values by content key: an LRU of `max_entries` in memory, then `disk_dir` if given.
+
+    Values are JSON-serializable, or tuples of arrays when `arrays` is set (stored as .npz).
+    Concurrent misses on one key compute it once.
+    """
+
+    def __init__(self, name: str, max_entries: int = DEFAULT_MAX_ENTRIES, disk_dir: str = DEFAULT_DISK_DIR,
+                 max_disk_bytes: int = DEFAULT_MAX_DISK_BYTES, arrays: bool = False):
+        self.name = name
+        self.max_entries = max_entries
+        self.disk_dir = os.path.join(disk_dir, name) if disk_dir else None
+        self.max_disk_bytes = max_disk_bytes
+        self.arrays = arrays
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Striped, so the locks do not grow with the number of keys
+        self._key_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._writes = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.npz" if self.arrays else f"{key}.json")
+
+    def _get(self, key: str):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        if not self.disk_dir:
+            return None
+        path = self._path(key)
+        try:
+            if self.arrays:
+                with np.load(path) as data:
+                    value = tuple(data[f"arr_{i}"] for i in range(len(data.files)))
+            else:
+                with open(path, "r", encoding="utf-8") as f:
+                    value = json.load(f)
+            # mtime is the disk tier's LRU clock
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        self._remember(key, value)
+        return value
+
+    def _remember(self, key: str, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _store(self, key: str, value):
+        self._remember(key, value)
+        if not self.disk_dir:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            if self.arrays:
+                np.savez(f, *value)
+            else:
+                f.write(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def get_or_compute(self, key: str, compute):
+        value = self._get(key)
+        if value is None:
+            with self._key_locks[int(key[:8], 16) % LOCK_STRIPES]:
+                value = self._get(key)
+                if value is None:
+                    value = compute()
+                    self._store(key, value)
+                    self.misses += 1
+                    return value
+        self.hits += 1
+        return value
+
+    def evict(self):
+        """Remove the least recently used files until the disk tier fits in max_disk_bytes."""
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(self.disk_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+# Shared by every session, model slot and request thread of the process
+transcripts = ContentCache("transcripts")
+word_phonemes = ContentCache("phonemes", max_entries=DEFAULT_MAX_ENTRIES * 40)
+pitch_tracks = ContentCache("pitch", arrays=True)
+
+
+class MemoizedSpeechToText:
+    """
+    SpeechToText (or a pooled one) behind the transcripts cache: keyed by the audio's content,
+    the model id, the language and the method. A hit does not wait for a model slot.
+    """
+
+    def __init__(self, stt, cache: ContentCache = transcripts):
+        self._stt = stt
+        self._cache = cache
+        self._model_id = None
+
+    @property
+    def model_id(self) -> str:
+        if self._model_id is None:
+            self._model_id = self._stt.model_id
+        return self._model_id
+
+    def __getattr__(self, name):
+        return getattr(self._stt, name)
+
+    def transcribe(self, audio, language: str = "he") -> str:
+        key = content_key("transcribe", self.model_id, language, audio_digest(audio))
+        return self._cache.get_or_compute(key, lambda: self._stt.transcribe(audio, language=language))
+
+    def transcribe_words(self, audio, language: str = "he") -> dict:
+        key = content_key("transcribe_words", self.model_id, language, audio_digest(audio))
+        return self._cache.get_or_compute(key, lambda: self._stt.transcribe_words(audio, language=language))
+
+
+class MemoizedPhonetics:
+    """
+    Phonetics (or a pooled one) converting text word by word through the phonemes cache,
+    so a transcript that differs from an earlier one in a word converts only that word.
+    """
+
+    def __init__(self, phonetics, cache: ContentCache = word_phonemes):
+        self._phonetics = phonetics
+        self._cache = cache
+        self._config = None
+
+    def _settings(self):
+        if self._config is None:
+            lang_code = getattr(self._phonetics, "lang_code", None)
+            # Epitran keeps the spaces between words; the fallback drops them
+            separator = " " if getattr(self._phonetics, "epi", None) is not None else ""
+            self._config = (lang_code, separator)
+        return self._config
+
+    def __getattr__(self, name):
+        return getattr(self._phonetics, name)
+
+    def to_phonemes(self, text: str) -> str:
+        lang_code, separator = self._settings()
+        return separator.join(
+            self._cache.get_or_compute(content_key("to_phonemes", lang_code, separator, word),
+                                       lambda word=word: self._phonetics.to_phonemes(word))
+            for word in text.split()
+        )
+
+    def text_to_phones(self, text: str) -> str:
+        return self.to_phonemes(text)
+
+
+def pitch_track(audio):
+    """prosody.pitch_track through the pitch cache, keyed by the audio's content and the YIN settings."""
+    import prosody
+
+    key = content_key("pitch_track", prosody.YIN_FMIN, prosody.YIN_FMAX, prosody.YIN_FRAME_LENGTH,
+                      prosody.YIN_HOP_LENGTH, prosody.VOICING_RMS_RATIO, prosody.PITCH_FRAMES_VERSION,
+                      audio_digest(audio))
+    return pitch_tracks.get_or_compute(key, lambda: prosody.pitch_track(audio))
+
+
+def register_cache_gauges(metrics):
+    caches = (transcripts, word_phonemes, pitch_tracks)
+    metrics.gauge("memo_hits_total", "Lookups answered by the content cache.",
+                  lambda: {f'cache="{cache.name}"': cache.hits for cache in caches}, kind="counter")
+    metrics.gauge("memo_misses_total", "Lookups that ran the stage.",
+                  lambda: {f'cache="{cache.name}"': cache.misses for cache in caches}, kind="counter")
+    metrics.gauge("memo_entries", "Entries in the in-memory tier.",
+                  lambda: {f'cache="{cache.name}"': len(cache._entries) for cache in caches})
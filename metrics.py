@@ -0,0 +1,177 @@
+"""
+metrics.py
+מדידת זמנים בנתיב ההשוואה: spans לכל שלב (תמלול, פונמות, מלודיה, ציון, גרף) בהיסטוגרמות,
+מדדי תור ומשבצות מודל, ופלט בפורמט הטקסט של Prometheus (/api/metrics). וגם profiler דוגם אופציונלי.
+"""
+
+import collections
+import functools
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; the pipeline stages range from milliseconds (scoring) to a minute (Whisper medium on CPU)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+PREFIX = "barmitzva"
+
+PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "0") == "1"
+MAX_PROFILE_SECONDS = 60
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """
+    Stage histograms and gauges of one process. Under gunicorn every worker keeps its own -
+    series carry a pid label, so sum them by stage (and le) when querying.
+    """
+
+    def __init__(self):
+        self._histograms = collections.OrderedDict()
+        self._gauges = []
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def timed(self, stage: str):
+        """Decorator: one span per call of the function."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def gauge(self, name: str, help_text: str, read, kind: str = "gauge"):
+        """A value read at scrape time: read() returns a number, or {'name="value"' labels: number}."""
+        self._gauges.append((name, help_text, read, kind))
+
+    def snapshot(self) -> dict:
+        """Per stage: count, mean and the p50/p99 estimated from the buckets."""
+        with self._lock:
+            histograms = {stage: (list(h.counts), h.count, h.sum) for stage, h in self._histograms.items()}
+        return {
+            stage: {
+                "count": count,
+                "mean": round(total / count, 4) if count else None,
+                "p50": _quantile(counts, count, 0.5),
+                "p99": _quantile(counts, count, 0.99),
+            }
+            for stage, (counts, count, total) in histograms.items()
+        }
+
+    def render(self) -> str:
+        """Prometheus text exposition format, version 0.0.4."""
+        pid = os.getpid()
+        name = f"{PREFIX}_stage_seconds"
+        lines = [f"# HELP {name} Duration of comparison pipeline stages.", f"# TYPE {name} histogram"]
+        with self._lock:
+            histograms = [(stage, list(h.buckets), list(h.counts), h.count, h.sum)
+                          for stage, h in self._histograms.items()]
+        for stage, buckets, counts, count, total in histograms:
+            labels = f'stage="{stage}",pid="{pid}"'
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{{labels},le="{bound:g}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"{name}_sum{{{labels}}} {total:.6f}")
+            lines.append(f"{name}_count{{{labels}}} {count}")
+
+        for gauge_name, help_text, read, kind in self._gauges:
+            full_name = f"{PREFIX}_{gauge_name}"
+            lines += [f"# HELP {full_name} {help_text}", f"# TYPE {full_name} {kind}"]
+            value = read()
+            if isinstance(value, dict):
+                for label, item in value.items():
+                    lines.append(f'{full_name}{{{label},pid="{pid}"}} {item}')
+            else:
+                lines.append(f'{full_name}{{pid="{pid}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+def _quantile(counts: list, count: int, q: float):
+    """Upper bound of the bucket holding the q-th observation - what histogram_quantile would interpolate within."""
+    if not count:
+        return None
+    rank = q * count
+    cumulative = 0
+    for bound, bucket_count in zip(BUCKETS, counts):
+        cumulative += bucket_count
+        if cumulative >= rank:
+            return bound
+    return float("inf")
+
+
+def register_job_gauges(metrics: Metrics, job_queue, models):
+    """Queue depth and per-model slot usage, read from the JobQueue and the ModelManager at scrape time."""
+    metrics.gauge("pending_comparisons", "Comparisons queued and not yet started.", job_queue.pending)
+    for field, metric, help_text, kind in (
+        ("slots", "model_slots", "Model slots configured.", "gauge"),
+        ("loaded", "model_loaded", "Model instances loaded.", "gauge"),
+        ("in_use", "model_slots_in_use", "Model slots busy with an inference call.", "gauge"),
+        ("waiting", "model_waiting", "Callers waiting for a model slot.", "gauge"),
+        ("rejected", "model_rejected_total", "Calls turned away because every slot stayed busy.", "counter"),
+        ("wait_seconds_total", "model_wait_seconds_total", "Seconds spent waiting for a model slot.", "counter"),
+    ):
+        metrics.gauge(metric, help_text,
+                      lambda field=field: {f'model="{name}"': stats[field] for name, stats in models.stats().items()},
+                      kind=kind)
+
+
+def sample_stacks(seconds: float, interval: float = 0.01) -> str:
+    """
+    Sample the stacks of every other thread for `seconds`, every `interval` seconds.
+    Returns collapsed stacks ("outer;inner count" per line), the input of flamegraph.pl and speedscope.
+    """
+    seconds = min(seconds, MAX_PROFILE_SECONDS)
+    me = threading.get_ident()
+    stacks = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            calls = []
+            while frame is not None:
+                code = frame.f_code
+                calls.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            stacks[";".join([names.get(ident, str(ident))] + calls[::-1])] += 1
+        time.sleep(interval)
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+# The process-wide instance the pipeline records into
+metrics = Metrics()
@@ -0,0 +1,212 @@
+"""
+model_pool.py
+ניהול מודלים בטוח לריבוי threads: מספר מוגבל של "משבצות" להרצה במקביל, וכל משבצת טוענת עותק משלה של המודל
+(פעם אחת, בשימוש הראשון) - מודל לא משמש שני threads בבת אחת.
+"""
+
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolBusy(Exception):
+    pass
+
+
+class ModelPool:
+    """
+    Up to `slots` instances of one model, each loaded once on first demand - N slots
+    are N copies of the model in memory, since inference is not safe to share
+    (Whisper's decoder keeps per-call state on the model).
+
+    A caller borrows an instance for the length of one inference call, so an
+    instance is never used by two threads at once. Callers beyond the free
+    slots wait up to `timeout` seconds; beyond `max_waiting` they are turned
+    away at once with PoolBusy.
+
+    `describe` (optional) returns attributes known without loading an instance,
+    such as the model id cache keys are built from.
+    """
+
+    def __init__(self, name: str, factory, slots: int = 1, timeout: float = 120.0, max_waiting: int = 16,
+                 describe=None):
+        self.name = name
+        self._describe = describe
+        self._description = None
+        self.slots = max(1, slots)
+        self.timeout = timeout
+        self.max_waiting = max_waiting
+        self._factory = factory
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._instances = []
+        self._created = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._acquired = 0
+        self._rejected = 0
+        self._wait_seconds = 0.0
+
+    def _acquire(self, timeout: float):
+        with self._lock:
+            create = self._idle.empty() and self._created < self.slots
+            if create:
+                # Reserve the slot under the lock, load outside it
+                self._created += 1
+            elif self._idle.empty() and self._waiting >= self.max_waiting:
+                self._rejected += 1
+                raise PoolBusy(f"{self.name}: all {self.slots} slots busy and {self._waiting} callers waiting")
+            else:
+                self._waiting += 1
+
+        if create:
+            try:
+                instance = self._factory()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+            with self._lock:
+                self._instances.append(instance)
+        else:
+            started = time.time()
+            try:
+                instance = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                with self._lock:
+                    self._waiting -= 1
+                    self._rejected += 1
+                raise PoolBusy(f"{self.name}: no free slot within {timeout:.0f}s")
+            with self._lock:
+                self._waiting -= 1
+                self._wait_seconds += time.time() - started
+
+        with self._lock:
+            self._in_use += 1
+            self._acquired += 1
+        return instance
+
+    def _release(self, instance):
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put(instance)
+
+    @contextmanager
+    def slot(self, timeout: float = None):
+        instance = self._acquire(self.timeout if timeout is None else timeout)
+        try:
+            yield instance
+        finally:
+            self._release(instance)
+
+    def preload(self):
+        """Load one instance now instead of on first demand."""
+        with self.slot():
+            pass
+
+    def describe(self) -> dict:
+        """Attributes of the model read without loading it (empty without a describe function)."""
+        if self._description is None:
+            self._description = self._describe() if self._describe is not None else {}
+        return self._description
+
+    def peek(self):
+        """
+        A loaded instance without reserving its slot - only for reading plain attributes.
+        Loads the first instance if there is none yet.
+        """
+        with self._lock:
+            if self._instances:
+                return self._instances[0]
+        self.preload()
+        return self._instances[0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "slots": self.slots,
+                "loaded": self._created,
+                "in_use": self._in_use,
+                "waiting": self._waiting,
+                "acquired": self._acquired,
+                "rejected": self._rejected,
+                "wait_seconds_total": round(self._wait_seconds, 3),
+            }
+
+
+class PooledModel:
+    """Stand-in for a model instance that borrows a pool slot for every method call."""
+
+    def __init__(self, pool: ModelPool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        description = self._pool.describe()
+        if name in description:
+            return description[name]
+        instance = self._pool.peek()
+        # Methods are found on the class; a slot is taken only for the call itself
+        if not callable(getattr(type(instance), name, None)):
+            return getattr(instance, name)
+
+        def call(*args, **kwargs):
+            with self._pool.slot() as instance:
+                return getattr(instance, name)(*args, **kwargs)
+
+        return call
+
+
+class ModelManager:
+    def __init__(self):
+        self._pools = {}
+
+    def register(self, name: str, factory, slots: int = 1, **pool_options) -> ModelPool:
+        self._pools[name] = ModelPool(name, factory, slots=slots, **pool_options)
+        return self._pools[name]
+
+    def pool(self, name: str) -> ModelPool:
+        return self._pools[name]
+
+    def get(self, name: str) -> PooledModel:
+        return PooledModel(self._pools[name])
+
+    def preload(self, names: list = None):
+        for name in names or list(self._pools):
+            self._pools[name].preload()
+
+    def stats(self) -> dict:
+        return {name: pool.stats() for name, pool in self._pools.items()}
+
+
+def _load_stt():
+    from speech_to_text import SpeechToText
+    print("Loading a speech-to-text model copy (one per STT slot)...")
+    stt = SpeechToText(model_name=os.environ.get("WHISPER_MODEL", "medium"))
+    print("Speech-to-text model loaded!")
+    return stt
+
+
+def _describe_stt() -> dict:
+    from speech_to_text import SpeechToText
+    return SpeechToText.describe(model_name=os.environ.get("WHISPER_MODEL", "medium"))
+
+
+def _load_phonetics():
+    from phonetics import Phonetics
+    print("Loading a phonetics analyzer copy (one per phonetics slot)...")
+    phonetics = Phonetics()
+    print("Phonetics analyzer loaded!")
+    return phonetics
+
+
+def create_model_manager() -> ModelManager:
+    """Build the servers' models from STT_SLOTS, PHONETICS_SLOTS and MODEL_SLOT_TIMEOUT."""
+    timeout = float(os.environ.get("MODEL_SLOT_TIMEOUT", 120))
+    manager = ModelManager()
+    # Each Whisper slot is a full copy of the model in memory - size it to the cores, not the requests
+    manager.register("stt", _load_stt, slots=int(os.environ.get("STT_SLOTS", 1)), timeout=timeout,
+                     describe=_describe_stt)
+    manager.register("phonetics", _load_phonetics, slots=int(os.environ.get("PHONETICS_SLOTS", 2)), timeout=timeout)
+    return manager
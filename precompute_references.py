@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+precompute_references.py
+חישוב מראש של ניתוח כל הקלטות הרב בתיקיית audio/ (לפני דיפלוי), במקביל על כמה תהליכים.
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from audio_io import decode_file
+from reference_cache import DEFAULT_BUNDLE_PATH, file_sha256
+
+# Recordings whose pitch is tracked together, as one padded array
+PITCH_BATCH = 32
+
+# Per-worker models, loaded once by _init_worker
+_stt = None
+_phon = None
+_language = "he"
+
+
+def _init_worker(model_name: str, backend: str, lang_code: str, language: str):
+    global _stt, _phon, _language
+    from speech_to_text import SpeechToText
+    from phonetics import Phonetics
+
+    _stt = SpeechToText(model_name=model_name, backend=backend)
+    _phon = Phonetics(lang_code=lang_code)
+    _language = language
+
+
+def _analyze(audio_file: str) -> dict:
+    """One recording's analysis, or {"source", "error"} if it could not be analyzed."""
+    try:
+        return _analyze_file(audio_file)
+    except Exception as e:
+        # ffmpeg's last line says what is wrong with the file
+        return {"source": os.path.basename(audio_file), "error": f"{type(e).__name__}: {(str(e).splitlines() or [''])[-1]}"}
+
+
+def _analyze_file(audio_file: str) -> dict:
+    started = time.time()
+    # One decode per recording, shared by ASR and pitch; the pitch runs batched in the parent (add_pitch)
+    audio = decode_file(audio_file)
+    if not len(audio):
+        raise ValueError("no audio")
+    transcription = _stt.transcribe_words(audio, language=_language)
+    text = transcription["text"]
+    phonemes = _phon.to_phonemes(text)
+    return {
+        "source": os.path.basename(audio_file),
+        "sha256": file_sha256(audio_file),
+        "model": _stt.model_id,
+        "text": text,
+        "phonemes": phonemes,
+        "words": transcription["words"],
+        "audio": audio,
+        "seconds": round(time.time() - started, 2),
+    }
+
+
+def add_pitch(rows: list, workers: int = 1):
+    """
+    Replace each row's decoded audio by its pitch: the contour and the frame-level f0 (NaN where
+    unvoiced, what the comparison aligns with DTW), all rows in one batched YIN pass.
+    """
+    from prosody import pitch_track_batch, resample_contours
+
+    tracks = pitch_track_batch([row.pop("audio") for row in rows], workers=workers)
+    contours = resample_contours([f0 for f0, _voiced in tracks])
+    for row, (f0, voiced), contour in zip(rows, tracks, contours):
+        row["pitch"] = contour.astype(np.float32)
+        row["pitch_frames"] = np.where(voiced, f0, np.nan).astype(np.float32)
+
+
+def write_bundle(rows: list, bundle_path: str):
+    """
+    One .npz with the stacked contours and the frame-level f0 of every row back to back
+    (row i is pitch_frames[pitch_frame_offsets[i]:pitch_frame_offsets[i + 1]]),
+    and a JSON index with one record per row.
+    """
+    from prosody import PITCH_FRAMES_VERSION
+
+    os.makedirs(os.path.dirname(os.path.abspath(bundle_path)), exist_ok=True)
+    pitch = np.stack([row["pitch"] for row in rows]) if rows else np.zeros((0, 0), dtype=np.float32)
+    frames = [row["pitch_frames"] for row in rows]
+    offsets = np.cumsum([0] + [len(f) for f in frames]).astype(np.int64)
+    pitch_frames = np.concatenate(frames) if frames else np.zeros(0, dtype=np.float32)
+    with open(bundle_path + ".npz.tmp", "wb") as f:
+        np.savez_compressed(f, pitch=pitch, pitch_frames=pitch_frames, pitch_frame_offsets=offsets,
+                            pitch_frames_version=PITCH_FRAMES_VERSION)
+    os.replace(bundle_path + ".npz.tmp", bundle_path + ".npz")
+
+    index = [
+        {key: row[key] for key in ("source", "sha256", "model", "text", "phonemes", "words")}
+        for row in rows
+    ]
+    with open(bundle_path + ".json.tmp", "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, indent=1)
+    os.replace(bundle_path + ".json.tmp", bundle_path + ".json")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute reference analysis for every pasuk recording")
+    parser.add_argument("--audio-dir", default="audio", help="תיקיית הקלטות הרב")
+    parser.add_argument("--output", default=DEFAULT_BUNDLE_PATH, help="נתיב הקובץ (בלי סיומת) ל-.npz ול-.json")
+    parser.add_argument("--model", default="medium", help="Whisper model (tiny, base, small, medium, large)")
+    parser.add_argument("--backend", default=None, help="ASR backend (whisper, faster-whisper); default: ASR_BACKEND")
+    parser.add_argument("--lang", default="he", help="שפה (ברירת מחדל: עברית)")
+    parser.add_argument("--lang-code", default="heb-Hebr", help="Epitran language code")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="מספר תהליכים (כל אחד טוען מודל משלו)")
+    args = parser.parse_args()
+
+    audio_files = sorted(glob.glob(os.path.join(args.audio_dir, "*.m4a")))
+    if not audio_files:
+        print(f"No .m4a files found in {args.audio_dir}")
+        return
+
+    print(f"Analyzing {len(audio_files)} recordings with {args.workers} workers...")
+    started = time.time()
+    with Pool(args.workers, initializer=_init_worker, initargs=(args.model, args.backend, args.lang_code, args.lang)) as pool:
+        rows = []
+        pending = []
+        failed = []
+        for row in pool.imap(_analyze, audio_files):
+            # A broken recording (e.g. an empty placeholder) is left out; it is analyzed on demand if requested
+            if "error" in row:
+                print(f"{row['source']}: skipped ({row['error']})")
+                failed.append(row["source"])
+                continue
+            print(f"{row['source']}: {row['seconds']}s")
+            rows.append(row)
+            pending.append(row)
+            # Pitch for a batch of recordings at a time, so only that many decoded clips are held
+            if len(pending) == PITCH_BATCH:
+                add_pitch(pending)
+                pending = []
+        add_pitch(pending)
+
+    write_bundle(rows, args.output)
+    print(f"Wrote {args.output}.npz and {args.output}.json in {time.time() - started:.1f}s")
+    if failed:
+        print(f"Skipped {len(failed)} of {len(audio_files)} recordings: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
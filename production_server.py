@@ -5,65 +5,119 @@ Serves both React frontend and API endpoints
 """
 
 import os
-from flask import Flask, request, jsonify, send_file, send_from_directory
+from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
 import tempfile
 import uuid
-from datetime import datetime
 
-app = Flask(__name__)
+from audio_index import AudioIndex
+from audio_io import decode_stream, save_buffer, load_buffer, DecodeError
+from comparison import compare_recordings, compare_word, compare_batch, render_plot
+from group_audio import GroupAudioCache, ConcatError, group_names
+from job_queue import create_job_queue, job_status, QueueFull, DONE
+from memo_cache import MemoizedSpeechToText, MemoizedPhonetics, register_cache_gauges
+from metrics import metrics, register_job_gauges, sample_stacks, PROFILER_ENABLED
+from model_pool import create_model_manager
+from reference_cache import ReferenceCache
+from results_store import create_results_store, TempFileSweeper
+from static_files import StaticFiles
+from streaming_pitch import register_stream_endpoint
+from torah_text import TorahText, AmbiguousVerse, register_torah_endpoints
+from warmup import create_warmup
+
+# static/ is served by static_files (precompressed, cache headers), not by Flask's default static route
+app = Flask(__name__, static_folder=None)
 CORS(app)
 
 # Store for temporary files and results
-temp_dir = tempfile.mkdtemp()
-results_store = {}
-
-# Initialize models lazily to speed up startup
-stt = None
-phonetics = None
+# UPLOAD_DIR shared by all worker processes on the node; a private temp dir otherwise
+temp_dir = os.environ.get("UPLOAD_DIR") or tempfile.mkdtemp()
+os.makedirs(temp_dir, exist_ok=True)
+# Bounded by count and age (RESULTS_MAX, RESULTS_TTL); RESULTS_BACKEND=sqlite keeps them across restarts
+results_store = create_results_store()
+
+# Rabbi recordings never change - analyze each one once and reuse it
+reference_cache = ReferenceCache()
+
+# Canonical verse text, the phonetic reference in "text" scoring mode.
+# SCORING_REFERENCE=audio (default) transcribes the rabbi instead; a request may pass "reference".
+torah_text = TorahText()
+SCORING_REFERENCE = os.environ.get("SCORING_REFERENCE", "audio")
+
+# Longest group of psukim scored from a single recording
+MAX_BATCH_PSUKIM = int(os.environ.get("MAX_BATCH_PSUKIM", 12))
+
+# A finished comparison's results are kept; a plot of an earlier comparison in the session is stale
+def store_results(session_id, results):
+    results_store.put(session_id, results)
+    plot_path = os.path.join(temp_dir, f"comparison_{session_id}.png")
+    if os.path.exists(plot_path):
+        os.remove(plot_path)
+
+# Comparisons run on a bounded worker pool; clients poll /api/results/<session_id>
+compare_jobs = create_job_queue(on_result=store_results)
+
+# Rabbi recordings served to the player, indexed once at startup
+audio_index = AudioIndex(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'audio'))
+
+# Concatenated rabbi recordings for grouped psukim, built once per group
+group_audio = GroupAudioCache()
+
+# Old uploads and plots are deleted in the background (TEMP_FILE_TTL, SWEEP_INTERVAL)
+temp_sweeper = TempFileSweeper(temp_dir, stores=(results_store, compare_jobs))
+
+# Built React app, indexed once at startup with its precompressed copies
+static_files = StaticFiles(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+
+# Models load lazily on first use, exactly once per slot; each call borrows a slot.
+# Under gunicorn they are loaded in the master before forking (gunicorn.conf.py), so workers share them.
+models = create_model_manager()
+
+# Libraries and models load on a background thread at boot (WARMUP=1, the default);
+# /api/ready answers 200 only once they have, /api/health as soon as the process is up
+warmup = create_warmup(models)
+
+# Queue depth and model slots, read when /api/metrics is scraped
+register_job_gauges(metrics, compare_jobs, models)
+register_cache_gauges(metrics)
+
+def start_background_threads():
+    """Per process - gunicorn's post_fork calls it in every worker, since threads do not survive a fork."""
+    temp_sweeper.start()
+    compare_jobs.start()
+    warmup.start()
+
+def shutdown(timeout):
+    """Stop taking comparisons and let the queued ones finish, for up to `timeout` seconds."""
+    temp_sweeper.stop()
+    if not compare_jobs.shutdown(timeout):
+        print(f"Shutting down with {compare_jobs.pending()} comparisons still pending")
+
+# Resubmitted audio and repeated words skip the models: transcripts, phonemes (per word) and pitch
+# are memoized by content, in memory (MEMO_CACHE_ENTRIES) and optionally on disk (MEMO_CACHE_DIR)
+stt_model = MemoizedSpeechToText(models.get("stt"))
+phonetics_model = MemoizedPhonetics(models.get("phonetics"))
 
 def get_stt():
-    global stt
-    if stt is None:
-        from speech_to_text import SpeechToText
-        print("Loading Whisper model...")
-        stt = SpeechToText()
-        print("Whisper model loaded!")
-    return stt
+    return stt_model
 
 def get_phonetics():
-    global phonetics
-    if phonetics is None:
-        from phonetics import Phonetics
-        print("Loading phonetics analyzer...")
-        phonetics = Phonetics()
-        print("Phonetics analyzer loaded!")
-    return phonetics
+    return phonetics_model
 
 # Serve React app at root
 @app.route('/')
 def serve_react_app():
-    return send_from_directory('static', 'index.html')
+    return static_files.send('index.html', request.accept_encodings) or ("Frontend not built", 404)
 
-# Serve React static files (JS, CSS, images) - Fixed routing
+# Serve React static files (JS, CSS, images) and public files (manifest, favicon, etc.);
+# unknown paths get index.html for client-side routing
 @app.route('/static/<path:filename>')
-def serve_react_static(filename):
-    # Serve directly from the static directory
-    return send_from_directory('static', filename)
-
-# Serve React public files (manifest, favicon, etc.)
 @app.route('/<path:filename>')
 def serve_react_public(filename):
     # Skip API routes
     if filename.startswith('api/'):
         return jsonify({"error": "API endpoint not found"}), 404
-
-    try:
-        # Try to serve from static directory first
-        return send_from_directory('static', filename)
-    except:
-        # If not found and not an API route, serve React app for client-side routing
-        return send_from_directory('static', 'index.html')
+    return static_files.send(filename, request.accept_encodings) or ("Frontend not built", 404)
 
 # Health check for Cloud Run
 @app.route('/health')
@@ -71,6 +125,31 @@ def serve_react_public(filename):
 def health_check():
     return jsonify({"status": "healthy", "message": "Bar Mitzvah API is running"})
 
+# Readiness for the Cloud Run startup probe: 503 until libraries and models are loaded, with per-step timings
+@app.route('/api/ready')
+def readiness_check():
+    report = warmup.report()
+    return jsonify(report), 200 if report["ready"] else 503
+
+# Stage latency histograms (p50/p99 per stage), queue depth and model slots for Prometheus
+@app.route('/api/metrics')
+def prometheus_metrics():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+# Sampling profiler: collapsed stacks of every thread for ?seconds= (PROFILER_ENABLED=1 only)
+@app.route('/api/profile')
+def sampling_profile():
+    if not PROFILER_ENABLED:
+        return jsonify({"error": "Profiler disabled (PROFILER_ENABLED=1)"}), 404
+    seconds = request.args.get('seconds', 10, type=float)
+    return sample_stacks(seconds), 200, {"Content-Type": "text/plain; charset=utf-8"}
+
+# Model slot usage, for sizing Cloud Run concurrency
+@app.route('/api/models')
+def model_slots():
+    return jsonify({"models": models.stats(), "pending_comparisons": compare_jobs.pending(),
+                    "stages": metrics.snapshot()})
+
 @app.route('/api/rabbi-audio', methods=['GET'])
 def get_rabbi_audio():
     pasuk_id = request.args.get('pasuk_id')
@@ -78,8 +157,8 @@ def get_rabbi_audio():
         return jsonify({"error": "Pasuk ID is required"}), 400
 
     try:
-        rabbi_file = os.path.join('audio', f'{pasuk_id}.m4a')
-        if not os.path.exists(rabbi_file):
+        rabbi_file = find_rabbi_file(pasuk_id)
+        if rabbi_file is None:
             return jsonify({"error": "Rabbi audio file not found"}), 404
 
     except FileNotFoundError:
@@ -88,18 +167,24 @@ def get_rabbi_audio():
 @app.route('/api/upload-recording', methods=['POST'])
 def upload_recording():
     try:
-        if 'audio' not in request.files:
-            return jsonify({"error": "No audio file provided"}), 400
+        if request.mimetype.startswith('audio/') or request.mimetype == 'application/octet-stream':
+            # Raw audio body - decoded while it streams in
+            upload_stream = request.stream
+        else:
+            if 'audio' not in request.files:
+                return jsonify({"error": "No audio file provided"}), 400
 
-        audio_file = request.files['audio']
-        if audio_file.filename == '':
-            return jsonify({"error": "No file selected"}), 400
+            audio_file = request.files['audio']
+            if audio_file.filename == '':
+                return jsonify({"error": "No file selected"}), 400
+            upload_stream = audio_file.stream
 
         session_id = str(uuid.uuid4())
-        filename = f"user_recording_{session_id}.wav"
+        filename = f"user_recording_{session_id}.npy"
         filepath = os.path.join(temp_dir, filename)
 
-        audio_file.save(filepath)
+        # Decode once to 16 kHz mono; ASR and pitch both read this buffer
+        save_buffer(filepath, decode_stream(upload_stream))
 
         return jsonify({
             "success": True,
@@ -107,9 +192,47 @@ def upload_recording():
             "message": "Recording uploaded successfully"
         })
 
+    except DecodeError:
+        return jsonify({"error": "Could not decode audio"}), 400
     except Exception as e:
         return jsonify({"error": f"Upload failed: {str(e)}"}), 500
 
+def run_comparison(user_file, rabbi_file, session_id, verse, progress):
+    verse_text = verse_phonemes = verse_words = None
+    if verse is not None:
+        verse_text = torah_text.plain_text(verse)
+        verse_phonemes = torah_text.phonemes(verse, get_phonetics())
+        verse_words = torah_text.words(verse)
+    results = compare_recordings(load_buffer(user_file), rabbi_file, session_id, get_stt(), get_phonetics(),
+                                 reference_cache, verse_text=verse_text,
+                                 verse_phonemes=verse_phonemes, verse_words=verse_words, progress=progress)
+    return results
+
+def run_batch_comparison(user_file, psukim, session_id, progress):
+    references = []
+    for pasuk in psukim:
+        reference = {"pasuk_id": pasuk["pasuk_id"], "rabbi_file": pasuk["rabbi_file"]}
+        if pasuk["verse"] is not None:
+            reference["verse_text"] = torah_text.plain_text(pasuk["verse"])
+            reference["verse_phonemes"] = torah_text.phonemes(pasuk["verse"], get_phonetics())
+            reference["verse_words"] = torah_text.words(pasuk["verse"])
+        references.append(reference)
+    results = compare_batch(load_buffer(user_file), references, session_id, get_stt(), get_phonetics(),
+                            reference_cache, progress=progress)
+    return results
+
+def run_word_comparison(user_file, rabbi_file, word_index, session_id, verse, progress):
+    verse_words = torah_text.words(verse) if verse is not None else None
+    results = compare_word(load_buffer(user_file), rabbi_file, word_index, session_id, get_stt(), get_phonetics(),
+                           reference_cache, verse_words=verse_words, progress=progress)
+    return results
+
+# The rabbi's recording of a pasuk, by <chapter>_<pasuk> or by torah.json id (as the verse cards send)
+def find_rabbi_file(pasuk_id):
+    name = torah_text.recording_name(pasuk_id)
+    rabbi_file = os.path.join('audio', f"{name}.m4a") if name else None
+    return rabbi_file if rabbi_file and os.path.exists(rabbi_file) else None
+
 @app.route('/api/compare-audio', methods=['POST'])
 def compare_audio():
     try:
@@ -120,63 +243,116 @@ def compare_audio():
         if not session_id:
             return jsonify({"error": "Session ID required"}), 400
 
-        user_file = os.path.join(temp_dir, f"user_recording_{session_id}.wav")
+        user_file = os.path.join(temp_dir, f"user_recording_{session_id}.npy")
         if not pasuk_id:
             return jsonify({"error": "Pasuk ID required"}), 400
 
-        rabbi_file = 'old/b1.mp3'
-        rabbi_file = os.path.join('audio', f'{pasuk_id}.m4a')
+        rabbi_file = find_rabbi_file(pasuk_id)
         if not os.path.exists(user_file):
             return jsonify({"error": "User recording not found"}), 404
 
-        if not os.path.exists(rabbi_file):
+        if rabbi_file is None:
             return jsonify({"error": "Rabbi recording not found"}), 404
 
-        from prosody import extract_pitch_contour, compare_pitch, plot_pitch
-        from rapidfuzz import fuzz
+        verse = None
+        if data.get('reference', SCORING_REFERENCE) == 'text':
+            verse = torah_text.lookup(pasuk_id, data.get('book'))
 
-        stt_model = get_stt()
-        phonetics_model = get_phonetics()
+        # A retry of the same request while it is still being processed just gets its status back;
+        # anything else (another pasuk, reference mode, a finished job) is compared again
+        job = compare_jobs.submit_request(
+            session_id, {"endpoint": "compare-audio", "pasuk_id": pasuk_id, "book": data.get('book'),
+                         "reference": data.get('reference', SCORING_REFERENCE)},
+            run_comparison, user_file, rabbi_file, session_id, verse)
 
-        print("Transcribing rabbi's audio...")
-        rabbi_text = stt_model.transcribe(rabbi_file, language="he")
+        return jsonify(job_status(job)), 202
 
-        print("Transcribing user's audio...")
-        user_text = stt_model.transcribe(user_file, language="he")
+    except AmbiguousVerse as e:
+        return jsonify({"error": f"Ambiguous pasuk: {e}", "books": e.books}), 400
+    except QueueFull:
+        return jsonify({"error": "Server busy, try again later"}), 503, {"Retry-After": "5"}
+    except Exception as e:
+        return jsonify({"error": f"Comparison failed: {str(e)}"}), 500
 
-        try:
-            rabbi_phones = phonetics_model.text_to_phones(rabbi_text)
-            user_phones = phonetics_model.text_to_phones(user_text)
-            phonetic_score = fuzz.ratio(rabbi_phones, user_phones)
-        except Exception as e:
-            print(f"Phonetic analysis warning: {e}")
-            phonetic_score = fuzz.ratio(rabbi_text, user_text)
+# One recording spanning several psukim (GroupedVerseCard)
+@app.route('/api/compare-audio/batch', methods=['POST'])
+def compare_audio_batch():
+    try:
+        data = request.get_json()
+        session_id = data.get('session_id')
+        pasuk_ids = data.get('pasuk_ids') or []
 
-        print("Extracting pitch contours...")
-        rabbi_pitch = extract_pitch_contour(rabbi_file)
-        user_pitch = extract_pitch_contour(user_file)
-        prosody_score = compare_pitch(rabbi_pitch, user_pitch)
+        if not session_id:
+            return jsonify({"error": "Session ID required"}), 400
+        if not isinstance(pasuk_ids, list) or not pasuk_ids or len(pasuk_ids) > MAX_BATCH_PSUKIM:
+            return jsonify({"error": f"1 to {MAX_BATCH_PSUKIM} pasuk IDs required"}), 400
 
-        overall_score = (phonetic_score * 0.6) + (prosody_score * 0.4)
+        user_file = os.path.join(temp_dir, f"user_recording_{session_id}.npy")
+        if not os.path.exists(user_file):
+            return jsonify({"error": "User recording not found"}), 404
 
-        plot_filename = f"comparison_{session_id}.png"
-        plot_path = os.path.join(temp_dir, plot_filename)
-        plot_pitch(rabbi_pitch, user_pitch, save_path=plot_path)
+        text_reference = data.get('reference', SCORING_REFERENCE) == 'text'
+        psukim = []
+        for pasuk_id in pasuk_ids:
+            rabbi_file = find_rabbi_file(pasuk_id)
+            if rabbi_file is None:
+                return jsonify({"error": f"Rabbi recording not found for pasuk {pasuk_id}"}), 404
+            verse = torah_text.lookup(pasuk_id, data.get('book')) if text_reference else None
+            psukim.append({"pasuk_id": pasuk_id, "rabbi_file": rabbi_file, "verse": verse})
+
+        job = compare_jobs.submit_request(
+            session_id, {"endpoint": "batch", "pasuk_ids": pasuk_ids, "book": data.get('book'),
+                         "reference": data.get('reference', SCORING_REFERENCE)},
+            run_batch_comparison, user_file, psukim, session_id)
+
+        return jsonify(job_status(job)), 202
+
+    except AmbiguousVerse as e:
+        return jsonify({"error": f"Ambiguous pasuk: {e}", "books": e.books}), 400
+    except QueueFull:
+        return jsonify({"error": "Server busy, try again later"}), 503, {"Retry-After": "5"}
+    except Exception as e:
+        return jsonify({"error": f"Comparison failed: {str(e)}"}), 500
 
-        results = {
-            "session_id": session_id,
-            "timestamp": datetime.now().isoformat(),
-            "rabbi_text": rabbi_text,
-            "user_text": user_text,
-            "phonetic_score": round(phonetic_score, 2),
-            "prosody_score": round(prosody_score, 2),
-            "overall_score": round(overall_score, 2),
-            "plot_available": True
-        }
-
-        results_store[session_id] = results
-        return jsonify(results)
+# Retry of a single word - word_index as in the "words" of a comparison
+@app.route('/api/compare-word', methods=['POST'])
+def compare_word_audio():
+    try:
+        data = request.get_json()
+        session_id = data.get('session_id')
+        pasuk_id = data.get('pasuk_id')
+        word_index = data.get('word_index')
+
+        if not session_id or not pasuk_id:
+            return jsonify({"error": "Session ID and pasuk ID required"}), 400
+        if not isinstance(word_index, int) or word_index < 0:
+            return jsonify({"error": "Word index required"}), 400
+
+        user_file = os.path.join(temp_dir, f"user_recording_{session_id}.npy")
+        if not os.path.exists(user_file):
+            return jsonify({"error": "User recording not found"}), 404
+
+        rabbi_file = find_rabbi_file(pasuk_id)
+        if rabbi_file is None:
+            return jsonify({"error": "Rabbi recording not found"}), 404
 
+        verse = None
+        if data.get('reference', SCORING_REFERENCE) == 'text':
+            verse = torah_text.lookup(pasuk_id, data.get('book'))
+            if verse is not None and word_index >= len(torah_text.words(verse)):
+                return jsonify({"error": "Word index out of range"}), 400
+
+        job = compare_jobs.submit_request(
+            session_id, {"endpoint": "compare-word", "pasuk_id": pasuk_id, "word_index": word_index,
+                         "book": data.get('book'), "reference": data.get('reference', SCORING_REFERENCE)},
+            run_word_comparison, user_file, rabbi_file, word_index, session_id, verse)
+
+        return jsonify(job_status(job)), 202
+
+    except AmbiguousVerse as e:
+        return jsonify({"error": f"Ambiguous pasuk: {e}", "books": e.books}), 400
+    except QueueFull:
+        return jsonify({"error": "Server busy, try again later"}), 503, {"Retry-After": "5"}
     except Exception as e:
         return jsonify({"error": f"Comparison failed: {str(e)}"}), 500
 
@@ -184,54 +360,75 @@ def compare_audio():
 def get_comparison_plot(session_id):
     try:
         plot_path = os.path.join(temp_dir, f"comparison_{session_id}.png")
-        if os.path.exists(plot_path):
-            return send_file(plot_path, mimetype='image/png')
-        else:
-            return jsonify({"error": "Plot not found"}), 404
+        if not os.path.exists(plot_path):
+            # Rendered on first request from the stored contours, then served from temp_dir
+            results = results_store.get(session_id)
+            if results is None or "contours" not in results:
+                return jsonify({"error": "Plot not found"}), 404
+            render_plot(results, plot_path)
+        return send_file(plot_path, mimetype='image/png')
     except Exception as e:
         return jsonify({"error": f"Failed to serve plot: {str(e)}"}), 500
 
+@app.route('/api/results/<session_id>')
+def get_results(session_id):
+    job = compare_jobs.get(session_id)
+    if job is not None:
+        return jsonify(job_status(job))
+    results = results_store.get(session_id)
+    if results is not None:
+        return jsonify({**results, "status": DONE})
+    return jsonify({"error": "Results not found"}), 404
+
 
 
+# Live pitch feedback while the student sings (WebSocket, needs flask-sock)
+register_stream_endpoint(app, reference_cache, find_rabbi_file)
+
 @app.route('/api/audio/<int:chapter>_<int:pasuk>', methods=['GET'])
 def get_audio_file(chapter, pasuk):
-    """Serve the audio file for the given chapter and pasuk."""
-    print(f"Audio file request for chapter {chapter}, pasuk {pasuk}", flush=True)
+    """Serve the audio file for the given chapter and pasuk (ETag, Range, Opus when the client accepts it)."""
+    response = audio_index.send(f"{chapter}_{pasuk}", request.accept_mimetypes)
+    if response is None:
+        return jsonify({"error": "Audio file not found"}), 404
+    return response
 
-    # Ensure the audio folder path is correct
-    audio_folder = os.path.abspath(os.path.join(os.path.dirname(__file__), 'audio'))
-    print(f"Resolved audio folder path: {audio_folder}", flush=True)
 
-    filename = f"{chapter}_{pasuk}.m4a"
-    filepath = os.path.join(audio_folder, filename)
 
-    print(f"Looking for audio file at: {filepath}", flush=True)
 
-    if os.path.exists(filepath):
-        print(f"Serving audio file: {filepath}", flush=True)
-        return send_file(filepath, as_attachment=False, mimetype='audio/mpeg')
+@app.route('/api/audio/group', methods=['GET', 'POST'])
+def get_group_audio():
+    """Serve concatenated audio for a group of psukim: ?ids=25_19,25_20, or POST {"psukim": [{chapter, pasuk}]}."""
+    if request.method == 'POST':
+        names = group_names(psukim=(request.get_json() or {}).get('psukim', []))
     else:
-        print(f"Audio file not found: {filepath}", flush=True)
-        return jsonify({"error": "Audio file not found"}), 404
+        names = group_names(ids=request.args.get('ids', ''))
+    if names is None:
+        return jsonify({"error": "A list of <chapter>_<pasuk> ids is required"}), 400
+
+    audio_files = []
+    for name in names:
+        filepath = audio_index.path(name)
+        if filepath is None:
+            chapter, pasuk_num = name.split('_')
+            return jsonify({"error": f"Audio file not found for chapter {chapter}, pasuk {pasuk_num}"}), 404
+        audio_files.append(filepath)
 
+    try:
+        path, key = group_audio.get(audio_files)
+    except ConcatError:
+        return jsonify({"error": "Could not build group audio"}), 500
 
+    # Content-addressed: the ETag changes only if a recording in the group does; Range is handled by send_file
+    return send_file(path, mimetype='audio/mp4', conditional=True, etag=key, max_age=86400)
 
 
-@app.route('/api/pasuk-info')
-def get_pasuk_info():
-    pasuk_info = {
-        "id": 1,
-        "book": "בראשית",
-        "chapter": 1,
-        "verse": 1,
-        "hebrew": "בְּרֵאשִׁית בָּרָא אֱלֹהִים אֵת הַשָּׁמַיִם וְאֵת הָאָרֶץ",
-        "transliteration": "B'reishit bara Elohim et hashamayim v'et ha'aretz",
-        "translation": "In the beginning God created the heavens and the earth",
-        "reference": "Genesis 1:1"
-    }
-    return jsonify(pasuk_info)
+# Verse text by chapter/pasuk and by parasha, paginated and cacheable (ETag)
+register_torah_endpoints(app, torah_text)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
     print(f"Starting Bar Mitzvah production server on port {port}...")
+    print("Single process - use gunicorn --config gunicorn.conf.py production_server:app for multiple workers")
+    start_background_threads()
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -5,21 +5,317 @@ prosody.py
 
 import librosa
 import numpy as np
-import matplotlib
-matplotlib.use('Agg')  # Use non-GUI backend to prevent threading issues
-import matplotlib.pyplot as plt
 
+# ננסה לייבא numba - ליבת DTW מקומפלת (אחרת NumPy)
+NUMBA_AVAILABLE = False
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
 
-def extract_pitch_contour(audio_file: str, sr: int = 16000) -> np.ndarray:
-    y, sr = librosa.load(audio_file, sr=sr)
-    f0 = librosa.yin(y, fmin=50, fmax=400, sr=sr)
-    target_len = 200
-    f0_interp = np.interp(
+# YIN settings, shared with the live tracker in streaming_pitch.py
+YIN_FMIN = 50
+YIN_FMAX = 400
+YIN_FRAME_LENGTH = 2048
+YIN_HOP_LENGTH = YIN_FRAME_LENGTH // 4
+CONTOUR_LENGTH = 200
+
+# A frame is voiced when its energy is above this fraction of the loudest frame,
+# YIN did not run into the edge of its search range, and it is part of a run of at least
+# VOICING_MIN_RUN frames whose pitch moves by less than VOICING_MAX_STEP semitones per frame -
+# sung pitch is smooth, while on noise YIN returns a random f0 inside the range
+VOICING_RMS_RATIO = 0.1
+VOICING_MAX_STEP = 1.0
+VOICING_MIN_RUN = 5
+# Bumped whenever the voicing decision changes, so cached frame-level f0 is recomputed
+PITCH_FRAMES_VERSION = 2
+# DTW: Sakoe-Chiba band as a fraction of the longer contour, costs in semitones
+DTW_BAND = 0.15
+DTW_UNVOICED_PENALTY = 2.0
+DTW_MAX_COST = 12.0
+DTW_TOLERANCE = 3.0
+# Full melody credit needs at least this fraction of the reference's share of voiced frames
+DTW_MIN_COVERAGE = 0.5
+
+_DIAGONAL, _UP, _LEFT = 0, 1, 2
+
+
+def pitch_track(audio, sr: int = 16000):
+    """
+    Frame-level YIN f0 and voicing of a recording.
+
+    audio: a file path, or a mono float32 buffer already at `sr` (see audio_io).
+    Returns (f0, voiced) - one entry per hop of YIN_HOP_LENGTH samples.
+    """
+    if isinstance(audio, np.ndarray):
+        y = np.asarray(audio, dtype=np.float32)
+    else:
+        y, sr = librosa.load(audio, sr=sr)
+    f0 = librosa.yin(y, fmin=YIN_FMIN, fmax=YIN_FMAX, sr=sr,
+                     frame_length=YIN_FRAME_LENGTH, hop_length=YIN_HOP_LENGTH)
+    rms = librosa.feature.rms(y=y, frame_length=YIN_FRAME_LENGTH, hop_length=YIN_HOP_LENGTH)[0][:len(f0)]
+    return f0, _voicing(f0, rms)
+
+
+def resample_contour(f0: np.ndarray, target_len: int = CONTOUR_LENGTH) -> np.ndarray:
+    return np.interp(
         np.linspace(0, len(f0), target_len),
         np.arange(len(f0)),
         f0
     )
-    return f0_interp
+
+
+def extract_pitch_contour(audio, sr: int = 16000) -> np.ndarray:
+    """audio: a file path, or a mono float32 buffer already at `sr` (see audio_io)."""
+    f0, _voiced = pitch_track(audio, sr)
+    return resample_contour(f0)
+
+
+def _voicing(f0: np.ndarray, rms: np.ndarray) -> np.ndarray:
+    voiced = (rms > VOICING_RMS_RATIO * rms.max()) if rms.size and rms.max() > 0 else np.zeros(len(f0), dtype=bool)
+    voiced &= (f0 > YIN_FMIN * 1.02) & (f0 < YIN_FMAX * 0.98)
+    if len(f0) < 2:
+        return voiced & (VOICING_MIN_RUN <= 1)
+    # Runs of voiced frames joined by small pitch steps; keep only the long enough ones
+    semitones = 12.0 * np.log2(np.maximum(f0, 1e-6))
+    linked = voiced[:-1] & voiced[1:] & (np.abs(np.diff(semitones)) < VOICING_MAX_STEP)
+    run_ids = np.concatenate(([0], np.cumsum(~linked)))
+    return voiced & (np.bincount(run_ids)[run_ids] >= VOICING_MIN_RUN)
+
+
+def _pitch_track_padded(clips: list, sr: int):
+    """YIN and RMS over the clips zero-padded into one (n_clips, samples) array, cut back to each clip's frames."""
+    padded = np.zeros((len(clips), max(len(y) for y in clips)), dtype=np.float32)
+    for row, y in enumerate(clips):
+        padded[row, :len(y)] = y
+    # librosa frames every leading axis at once; the padding is the same silence a single clip is centered in
+    f0 = librosa.yin(padded, fmin=YIN_FMIN, fmax=YIN_FMAX, sr=sr,
+                     frame_length=YIN_FRAME_LENGTH, hop_length=YIN_HOP_LENGTH)
+    rms = librosa.feature.rms(y=padded, frame_length=YIN_FRAME_LENGTH, hop_length=YIN_HOP_LENGTH)[:, 0]
+    tracks = []
+    for row, y in enumerate(clips):
+        n_frames = 1 + len(y) // YIN_HOP_LENGTH
+        tracks.append((f0[row, :n_frames], _voicing(f0[row, :n_frames], rms[row, :n_frames])))
+    return tracks
+
+
+def pitch_track_batch(clips: list, sr: int = 16000, batch_size: int = 16, workers: int = 1) -> list:
+    """
+    pitch_track for many decoded clips: [(f0, voiced)] in the order given, same values as one call per clip.
+
+    Clips are sorted by length and tracked `batch_size` at a time as one padded 2-D array,
+    which bounds both the padding and the (batch, frame_length, frames) YIN buffers.
+    With workers > 1 the batches run on a thread pool - the FFTs release the GIL.
+    """
+    clips = [np.asarray(y, dtype=np.float32) for y in clips]
+    order = sorted(range(len(clips)), key=lambda k: len(clips[k]))
+    batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+    def track(batch):
+        return _pitch_track_padded([clips[k] for k in batch], sr)
+
+    if workers > 1 and len(batches) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(track, batches))
+    else:
+        results = [track(batch) for batch in batches]
+
+    tracks = [None] * len(clips)
+    for batch, batch_tracks in zip(batches, results):
+        for k, result in zip(batch, batch_tracks):
+            tracks[k] = result
+    return tracks
+
+
+def resample_contours(f0s: list, target_len: int = CONTOUR_LENGTH) -> np.ndarray:
+    """resample_contour for many f0 tracks at once - one (len(f0s), target_len) array, without a per-track np.interp."""
+    if not f0s:
+        return np.zeros((0, target_len))
+    lengths = np.array([len(f0) for f0 in f0s])
+    padded = np.zeros((len(f0s), lengths.max()))
+    for row, f0 in enumerate(f0s):
+        padded[row, :len(f0)] = f0
+    # Same sample points as resample_contour; past the last frame np.interp holds the last value
+    x = np.linspace(0, 1, target_len)[None, :] * lengths[:, None]
+    last = (lengths - 1)[:, None]
+    left = np.minimum(np.floor(x).astype(int), last)
+    right = np.minimum(left + 1, last)
+    weight = np.clip(x - left, 0.0, 1.0)
+    rows = np.arange(len(f0s))[:, None]
+    return padded[rows, left] * (1 - weight) + padded[rows, right] * weight
+
+
+def extract_pitch_contours(clips: list, sr: int = 16000, target_len: int = CONTOUR_LENGTH,
+                           batch_size: int = 16, workers: int = 1) -> np.ndarray:
+    """
+    extract_pitch_contour for many decoded clips (mono float32 at `sr`): one (len(clips), target_len) array.
+    The kernel for building the reference cache and re-scoring stored recordings in bulk.
+    """
+    tracks = pitch_track_batch(clips, sr, batch_size=batch_size, workers=workers)
+    return resample_contours([f0 for f0, _voiced in tracks], target_len)
+
+
+def extract_pitch_frames(audio, sr: int = 16000) -> np.ndarray:
+    """Frame-level f0 with NaN on unvoiced frames - the input of compare_pitch_dtw."""
+    f0, voiced = pitch_track(audio, sr)
+    return np.where(voiced, f0, np.nan)
+
+
+def to_semitones(f0: np.ndarray) -> np.ndarray:
+    """Semitones relative to the speaker's median voiced pitch, so a boy and the rabbi compare in any key."""
+    f0 = np.asarray(f0, dtype=np.float64)
+    voiced = ~np.isnan(f0)
+    semitones = np.full(len(f0), np.nan)
+    if voiced.any():
+        semitones[voiced] = 12.0 * np.log2(f0[voiced] / np.median(f0[voiced]))
+    return semitones
+
+
+def _band(n: int, m: int, band: float):
+    """First and last column of every row inside a Sakoe-Chiba band around the (scaled) diagonal."""
+    slope = (m - 1) / max(n - 1, 1)
+    radius = max(int(np.ceil(band * max(n, m))), int(np.ceil(slope)) + 1)
+    center = np.arange(n) * slope
+    lo = np.clip(np.floor(center - radius), 0, m - 1).astype(np.int64)
+    hi = np.clip(np.ceil(center + radius), 0, m - 1).astype(np.int64)
+    return lo, hi
+
+
+def _local_cost(ref_row: float, user: np.ndarray) -> np.ndarray:
+    if np.isnan(ref_row):
+        return np.where(np.isnan(user), 0.0, DTW_UNVOICED_PENALTY)
+    return np.where(np.isnan(user), DTW_UNVOICED_PENALTY, np.minimum(np.abs(user - ref_row), DTW_MAX_COST))
+
+
+def _dtw_steps_numpy(ref: np.ndarray, user: np.ndarray, lo: np.ndarray, hi: np.ndarray):
+    """
+    Banded DTW, one vectorized pass per row.
+
+    Within a row D[j] = min(t[j], c[j] + D[j-1]), where t is the better of the diagonal
+    and vertical moves. With S = cumsum(c) that is S[j] + min over k <= j of (t[k] - S[k]),
+    a running minimum.
+    """
+    n, m = len(ref), len(user)
+    steps = np.zeros((n, int((hi - lo).max()) + 1), dtype=np.int8)
+    # Previous row over all columns, shifted by one: prev[j + 1] = D[i - 1, j], prev[0] the virtual start
+    prev = np.full(m + 1, np.inf)
+    prev[0] = 0.0
+    for i in range(n):
+        cost = _local_cost(ref[i], user[lo[i]:hi[i] + 1])
+        diagonal = prev[lo[i]:hi[i] + 1]
+        up = prev[lo[i] + 1:hi[i] + 2]
+        t = cost + np.minimum(diagonal, up)
+        row_steps = np.where(up < diagonal, _UP, _DIAGONAL).astype(np.int8)
+
+        running = np.cumsum(cost)
+        offset = t - running
+        best = np.minimum.accumulate(offset)
+        left = best < offset
+        row = np.where(left, running + best, t)
+        row_steps[left] = _LEFT
+
+        if i == 0:
+            prev[0] = np.inf
+        else:
+            prev[lo[i - 1] + 1:hi[i - 1] + 2] = np.inf
+        prev[lo[i] + 1:hi[i] + 2] = row
+        steps[i, :len(row)] = row_steps
+    return steps, prev[m]
+
+
+if NUMBA_AVAILABLE:
+    @njit(cache=True)
+    def _dtw_steps_compiled(ref, user, lo, hi, unvoiced_penalty, max_cost):
+        n, m = len(ref), len(user)
+        steps = np.zeros((n, (hi - lo).max() + 1), dtype=np.int8)
+        prev = np.full(m + 1, np.inf)
+        row = np.full(m + 1, np.inf)
+        prev[0] = 0.0
+        for i in range(n):
+            row[:] = np.inf
+            for j in range(lo[i], hi[i] + 1):
+                a, b = ref[i], user[j]
+                if np.isnan(a) and np.isnan(b):
+                    cost = 0.0
+                elif np.isnan(a) or np.isnan(b):
+                    cost = unvoiced_penalty
+                else:
+                    cost = min(abs(b - a), max_cost)
+                best, step = prev[j], _DIAGONAL
+                if prev[j + 1] < best:
+                    best, step = prev[j + 1], _UP
+                if row[j] < best:
+                    best, step = row[j], _LEFT
+                row[j + 1] = cost + best
+                steps[i, j - lo[i]] = step
+            prev, row = row, prev
+        return steps, prev[m]
+
+
+def _backtrack(steps: np.ndarray, lo: np.ndarray, m: int) -> np.ndarray:
+    i, j = len(lo) - 1, m - 1
+    path = [(i, j)]
+    while i > 0 or j > 0:
+        step = steps[i, j - lo[i]]
+        if step == _DIAGONAL:
+            i, j = i - 1, j - 1
+        elif step == _UP:
+            i -= 1
+        else:
+            j -= 1
+        path.append((i, j))
+    return np.array(path[::-1], dtype=np.int64)
+
+
+def dtw_align(ref_semitones: np.ndarray, user_semitones: np.ndarray, band: float = DTW_BAND):
+    """
+    Time-align two semitone contours (NaN = unvoiced) inside a Sakoe-Chiba band.
+
+    Returns (mean cost along the path in semitones, path) where path is an (L, 2)
+    array of (reference frame, user frame) pairs from the first frames to the last.
+    """
+    ref = np.ascontiguousarray(ref_semitones, dtype=np.float64)
+    user = np.ascontiguousarray(user_semitones, dtype=np.float64)
+    lo, hi = _band(len(ref), len(user), band)
+    if NUMBA_AVAILABLE:
+        steps, total = _dtw_steps_compiled(ref, user, lo, hi, DTW_UNVOICED_PENALTY, DTW_MAX_COST)
+    else:
+        steps, total = _dtw_steps_numpy(ref, user, lo, hi)
+    path = _backtrack(steps, lo, len(user))
+    return float(total) / len(path), path
+
+
+def _scored_cost(ref: np.ndarray, user: np.ndarray, path: np.ndarray) -> float:
+    """
+    Mean cost along an alignment over the reference's voiced frames only, where a voiced frame
+    matched to an unvoiced one costs the full tolerance - silence cannot earn partial credit.
+    """
+    ref_steps, user_steps = ref[path[:, 0]], user[path[:, 1]]
+    voiced_ref = ~np.isnan(ref_steps)
+    if not voiced_ref.any():
+        return DTW_TOLERANCE
+    cost = np.where(np.isnan(user_steps), DTW_TOLERANCE, np.minimum(np.abs(user_steps - ref_steps), DTW_MAX_COST))
+    return float(cost[voiced_ref].mean())
+
+
+def compare_pitch_dtw(ref_frames: np.ndarray, user_frames: np.ndarray, band: float = DTW_BAND):
+    """
+    Melody similarity (0-100) that tolerates a different tempo, and the alignment behind it.
+
+    Both inputs are frame-level f0 with NaN on unvoiced frames (extract_pitch_frames).
+    A recording with no voiced frame scores 0, with an empty alignment; one voiced over
+    less than DTW_MIN_COVERAGE of the reference's share of frames is scaled down.
+    """
+    ref, user = to_semitones(ref_frames), to_semitones(user_frames)
+    ref_voiced, user_voiced = np.mean(~np.isnan(ref)) if len(ref) else 0.0, np.mean(~np.isnan(user)) if len(user) else 0.0
+    if not ref_voiced or not user_voiced:
+        return 0.0, np.zeros((0, 2), dtype=np.int64)
+    _mean_cost, path = dtw_align(ref, user, band)
+    # A few stray voiced frames can be warped onto the whole reference: scale by how much was sung
+    coverage = min(1.0, user_voiced / (ref_voiced * DTW_MIN_COVERAGE))
+    return float(max(0.0, 1.0 - _scored_cost(ref, user, path) / DTW_TOLERANCE) * coverage * 100), path
 
 
 def compare_pitch(pitch_ref: np.ndarray, pitch_child: np.ndarray) -> float:
@@ -32,13 +328,17 @@ def compare_pitch(pitch_ref: np.ndarray, pitch_child: np.ndarray) -> float:
 
 
 def plot_pitch(pitch_ref: np.ndarray, pitch_child: np.ndarray, save_path: str = "pitch_comparison.png"):
-    plt.figure(figsize=(10, 4))
-    plt.plot(pitch_ref, label="רב (Reference)", color="blue")
-    plt.plot(pitch_child, label="ילד (Child)", color="orange")
-    plt.title("השוואת מלודיה (Pitch Contour)")
-    plt.xlabel("זמן (מדדים נורמליים)")
-    plt.ylabel("גובה קול (Hz)")
-    plt.legend()
-    plt.tight_layout()
-    plt.savefig(save_path)
-    plt.close()
+    # matplotlib takes hundreds of ms to import: only pay for it when a plot is actually drawn.
+    # A bare Figure (no pyplot) is safe to draw from several request threads at once.
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(10, 4))
+    ax = fig.add_subplot()
+    ax.plot(pitch_ref, label="רב (Reference)", color="blue")
+    ax.plot(pitch_child, label="ילד (Child)", color="orange")
+    ax.set_title("השוואת מלודיה (Pitch Contour)")
+    ax.set_xlabel("זמן (מדדים נורמליים)")
+    ax.set_ylabel("גובה קול (Hz)")
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(save_path, format="png")
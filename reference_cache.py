@@ -0,0 +1,230 @@
+"""
+reference_cache.py
+מטמון קבוע לניתוח הקלטות הרב (טקסט, פונמות, מלודיה), לפי hash של תוכן הקובץ.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from audio_io import load_audio
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "REFERENCE_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "reference"),
+)
+# Written by precompute_references.py: <path>.npz (contours, frame-level f0) + <path>.json (index)
+DEFAULT_BUNDLE_PATH = os.environ.get(
+    "REFERENCE_BUNDLE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "reference_bundle"),
+)
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ReferenceCache:
+    """
+    Transcript, phonemes and pitch contour of each reference recording.
+
+    Pitch contours (the fixed-length one for plots and the frame-level one for
+    DTW) are keyed by the file's content hash, transcripts by the hash
+    and the ASR model id, so a re-recorded pasuk or a model change simply misses
+    and gets recomputed.
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, bundle_path: str = DEFAULT_BUNDLE_PATH):
+        self.cache_dir = cache_dir
+        self._pitch = {}
+        self._pitch_frames = {}
+        self._transcripts = {}
+        self._segments = {}
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if bundle_path and os.path.exists(bundle_path + ".npz") and os.path.exists(bundle_path + ".json"):
+            self.load_bundle(bundle_path)
+
+    def load_bundle(self, bundle_path: str) -> int:
+        from prosody import PITCH_FRAMES_VERSION
+
+        with open(bundle_path + ".json", "r", encoding="utf-8") as f:
+            index = json.load(f)
+        with np.load(bundle_path + ".npz") as data:
+            pitch = data["pitch"]
+            # Bundles written before the frame-level f0 was added, or with another voicing, have only usable contours
+            if "pitch_frames" in data.files and int(data.get("pitch_frames_version", 1)) == PITCH_FRAMES_VERSION:
+                pitch_frames, offsets = data["pitch_frames"].astype(np.float64), data["pitch_frame_offsets"]
+            else:
+                pitch_frames, offsets = None, None
+        for i, (row, contour) in enumerate(zip(index, pitch)):
+            self._pitch[row["sha256"]] = contour.astype(np.float64)
+            if pitch_frames is not None:
+                self._pitch_frames[row["sha256"]] = pitch_frames[offsets[i]:offsets[i + 1]]
+            self._transcripts[f"{row['sha256']}-{row['model']}"] = {
+                "text": row["text"],
+                "phonemes": row["phonemes"],
+                "words": row.get("words"),
+            }
+        print(f"Loaded {len(index)} precomputed references from {bundle_path}")
+        return len(index)
+
+    def digest(self, audio_file: str) -> str:
+        stat = os.stat(audio_file)
+        stamp = (os.path.abspath(audio_file), stat.st_size, stat.st_mtime_ns)
+        digest = self._hashes.get(stamp)
+        if digest is None:
+            digest = file_sha256(audio_file)
+            self._hashes[stamp] = digest
+        return digest
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _write_atomic(self, path: str, write):
+        # Write to a temp file and rename, so a concurrent reader never sees half an entry
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+
+    def _cached_array(self, store: dict, audio_file: str, suffix: str, compute) -> np.ndarray:
+        digest = self.digest(audio_file)
+        array = store.get(digest)
+        if array is not None:
+            return array
+
+        key = digest + suffix
+        with self._key_lock(key):
+            array = store.get(digest)
+            if array is not None:
+                return array
+            array_path = os.path.join(self.cache_dir, f"{key}.npy")
+            if os.path.exists(array_path):
+                array = np.load(array_path)
+            else:
+                array = np.asarray(compute(load_audio(audio_file)))
+                self._write_atomic(array_path, lambda f: np.save(f, array))
+            store[digest] = array
+            return array
+
+    def pitch(self, audio_file: str) -> np.ndarray:
+        """Pitch contour of a reference recording - independent of the ASR model."""
+        from prosody import extract_pitch_contour
+
+        return self._cached_array(self._pitch, audio_file, "", extract_pitch_contour)
+
+    def pitch_frames(self, audio_file: str) -> np.ndarray:
+        """Frame-level f0 of a reference recording, NaN where unvoiced (for DTW)."""
+        from prosody import PITCH_FRAMES_VERSION, extract_pitch_frames
+
+        return self._cached_array(self._pitch_frames, audio_file, f"-f0v{PITCH_FRAMES_VERSION}", extract_pitch_frames)
+
+    def cached_transcript(self, audio_file: str, stt) -> dict:
+        """The transcript of a reference recording if it is already known (bundle or cache), without running the ASR."""
+        key = f"{self.digest(audio_file)}-{stt.model_id}"
+        entry = self._transcripts.get(key)
+        if entry is not None and entry["words"] is not None:
+            return entry
+        meta_path = os.path.join(self.cache_dir, f"{key}.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        # Entries from before word timings were kept are recomputed
+        if meta.get("words") is None:
+            return None
+        entry = {"text": meta["text"], "phonemes": meta["phonemes"], "words": meta["words"]}
+        self._transcripts[key] = entry
+        return entry
+
+    def transcript(self, audio_file: str, stt, phonetics, language: str = "he") -> dict:
+        """{"text", "phonemes", "words"} of a reference recording as heard by the given ASR model."""
+        entry = self.cached_transcript(audio_file, stt)
+        if entry is not None:
+            return entry
+
+        key = f"{self.digest(audio_file)}-{stt.model_id}"
+        with self._key_lock(key):
+            entry = self.cached_transcript(audio_file, stt)
+            if entry is not None:
+                return entry
+            result = stt.transcribe_words(load_audio(audio_file), language=language)
+            text = result["text"]
+            try:
+                phonemes = phonetics.text_to_phones(text)
+            except Exception as e:
+                print(f"Phonetic analysis warning: {e}")
+                phonemes = text
+            entry = {"text": text, "phonemes": phonemes, "words": result["words"]}
+            meta = {"source": os.path.basename(audio_file), "model": stt.model_id, **entry}
+            meta_path = os.path.join(self.cache_dir, f"{key}.json")
+            self._write_atomic(meta_path, lambda f: f.write(json.dumps(meta, ensure_ascii=False).encode("utf-8")))
+            self._transcripts[key] = entry
+            return entry
+
+    def word_segments(self, audio_file: str, reference_words: list, stt) -> list:
+        """
+        Where each reference word is in the rabbi's recording: {"span": (start, end), "frames": pitch frames},
+        or None for a word the ASR did not hear. Kept per recording, model and word list, so a
+        retry of one word is scored against its segment without touching the rest of the verse.
+
+        The spans come from the recording's transcript only when it is already known; the
+        verse text alone (text scoring) does not bring the ASR back for the rabbi's recording -
+        without a transcript the words are spread over the voiced stretch by their length.
+        """
+        from word_scoring import frame_slice, proportional_spans, word_spans
+
+        entry = self.cached_transcript(audio_file, stt)
+        words = [w["word"] for w in reference_words]
+        key = (self.digest(audio_file), stt.model_id, tuple(words), entry is not None)
+        segments = self._segments.get(key)
+        if segments is None:
+            frames = self.pitch_frames(audio_file)
+            spans = word_spans(words, entry["words"]) if entry is not None else proportional_spans(words, frames)
+            segments = [None if span is None else {"span": span, "frames": frame_slice(frames, span)} for span in spans]
+            self._segments[key] = segments
+        return segments
+
+    def get_or_compute(self, audio_file: str, stt, phonetics, language: str = "he") -> dict:
+        return {**self.transcript(audio_file, stt, phonetics, language),
+                "pitch": self.pitch(audio_file), "pitch_frames": self.pitch_frames(audio_file)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Warm the reference cache for every pasuk recording")
+    parser.add_argument("--audio-dir", default="audio", help="תיקיית הקלטות הרב")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--model", default="medium", help="Whisper model (tiny, base, small, medium, large)")
+    parser.add_argument("--backend", default=None, help="ASR backend (whisper, faster-whisper); default: ASR_BACKEND")
+    parser.add_argument("--lang", default="he", help="שפה (ברירת מחדל: עברית)")
+    args = parser.parse_args()
+
+    from speech_to_text import SpeechToText
+    from phonetics import Phonetics
+
+    cache = ReferenceCache(args.cache_dir)
+    stt = SpeechToText(model_name=args.model, backend=args.backend)
+    phon = Phonetics()
+
+    audio_files = sorted(glob.glob(os.path.join(args.audio_dir, "*.m4a")))
+    for audio_file in audio_files:
+        cache.get_or_compute(audio_file, stt, phon, language=args.lang)
+        print(f"Cached: {audio_file}")
+    print(f"{len(audio_files)} reference recordings cached in {args.cache_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+results_store.py
+תוצאות ההשוואה לכל session: מוגבלות בזמן (TTL) ובמספר (LRU), בזיכרון או ב-SQLite משותף לכל התהליכים.
+וגם מנקה ברקע שמוחק הקלטות וגרפים ישנים מתיקיית הקבצים הזמניים.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL = int(os.environ.get("RESULTS_TTL", 6 * 3600))
+DEFAULT_MAX_ENTRIES = int(os.environ.get("RESULTS_MAX", 1000))
+
+
+class MemoryResultStore:
+    """Results in an OrderedDict, least recently read evicted first - the default, single-process store."""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl: float = DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, session_id: str, result: dict):
+        with self._lock:
+            self._results[session_id] = (time.time(), result)
+            self._results.move_to_end(session_id)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+    def get(self, session_id: str):
+        with self._lock:
+            entry = self._results.get(session_id)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > self.ttl:
+                del self._results[session_id]
+                return None
+            self._results.move_to_end(session_id)
+            return entry[1]
+
+    def purge(self) -> int:
+        """Drop expired results; returns how many."""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [session_id for session_id, (created, _) in self._results.items() if created < cutoff]
+            for session_id in expired:
+                del self._results[session_id]
+        return len(expired)
+
+    def __len__(self):
+        return len(self._results)
+
+
+class SQLiteResultStore:
+    """Results in a local SQLite file - they survive a restart and are shared by every worker process on the node."""
+
+    def __init__(self, path: str, max_entries: int = DEFAULT_MAX_ENTRIES, ttl: float = DEFAULT_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS results (id TEXT PRIMARY KEY, result TEXT, created REAL, accessed REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def put(self, session_id: str, result: dict):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO results (id, result, created, accessed) VALUES (?, ?, ?, ?)",
+                         (session_id, json.dumps(result), now, now))
+            conn.execute("DELETE FROM results WHERE id IN (SELECT id FROM results ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                         (self.max_entries,))
+
+    def get(self, session_id: str):
+        conn = self._connect()
+        row = conn.execute("SELECT result, created FROM results WHERE id = ?", (session_id,)).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        with conn:
+            conn.execute("UPDATE results SET accessed = ? WHERE id = ?", (time.time(), session_id))
+        return json.loads(row[0])
+
+    def purge(self) -> int:
+        with self._connect() as conn:
+            return conn.execute("DELETE FROM results WHERE created < ?", (time.time() - self.ttl,)).rowcount
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+
+def create_results_store():
+    """Build the store from RESULTS_BACKEND (memory / sqlite), RESULTS_DB, RESULTS_MAX and RESULTS_TTL."""
+    if os.environ.get("RESULTS_BACKEND", "memory") == "sqlite":
+        return SQLiteResultStore(os.environ.get("RESULTS_DB", os.path.join("cache", "results.sqlite3")))
+    return MemoryResultStore()
+
+
+class TempFileSweeper:
+    """
+    Every `interval` seconds: delete files in `directory` older than `ttl` (uploads,
+    plots) and let the stores and the job queue drop what expired.
+    """
+
+    def __init__(self, directory: str, ttl: float = None, interval: float = None, stores: tuple = ()):
+        self.directory = directory
+        self.ttl = ttl if ttl is not None else float(os.environ.get("TEMP_FILE_TTL", DEFAULT_TTL))
+        self.interval = interval if interval is not None else float(os.environ.get("SWEEP_INTERVAL", 300))
+        self.stores = stores
+        self._stop_event = threading.Event()
+        self._pid = None
+
+    def sweep(self) -> int:
+        cutoff = time.time() - self.ttl
+        removed = 0
+        with os.scandir(self.directory) as listing:
+            for entry in listing:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        for store in self.stores:
+            store.purge()
+        return removed
+
+    def _run(self, stop_event: threading.Event):
+        while not stop_event.wait(self.interval):
+            try:
+                removed = self.sweep()
+                if removed:
+                    print(f"Temp sweeper removed {removed} files from {self.directory}")
+            except Exception as e:
+                print(f"Temp sweeper failed: {e}")
+
+    def start(self):
+        """Start sweeping in this process (once per process - threads do not survive a fork)."""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._stop_event = threading.Event()
+        threading.Thread(target=self._run, args=(self._stop_event,), name="temp-sweeper", daemon=True).start()
+
+    def stop(self):
+        self._stop_event.set()
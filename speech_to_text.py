@@ -1,30 +1,291 @@
 """
 speech_to_text.py
-מודול לטרנסקריפציה באמצעות Whisper (קוד פתוח).
+מודול לטרנסקריפציה, עם מנועים מתחלפים:
+- whisper: openai-whisper (ברירת מחדל). המשקלות נשמרים פעם אחת בתיקיית מטמון בפורמט שנטען ב-mmap,
+  עם manifest של גרסה ו-checksum.
+- faster-whisper: מנוע CTranslate2 עם int8 על CPU - מהיר יותר, מעט פחות מדויק.
+הבחירה נעשית לפי ASR_BACKEND (או הפרמטר backend).
 """
 
-import whisper
-import pickle
+import argparse
+import hashlib
+import json
+import os
+import time
 
-class SpeechToText:
-    def __init__(self, model_name: str = "medium"):
+import numpy as np
+
+# ננסה לייבא את המנועים - כל אחד מהם אופציונלי
+WHISPER_AVAILABLE = False
+try:
+    import torch
+    import whisper
+    from whisper.model import AudioEncoder, ModelDimensions, TextDecoder, Whisper
+    WHISPER_AVAILABLE = True
+except ImportError:
+    WHISPER_AVAILABLE = False
+
+FASTER_WHISPER_AVAILABLE = False
+try:
+    from faster_whisper import WhisperModel
+    FASTER_WHISPER_AVAILABLE = True
+except ImportError:
+    FASTER_WHISPER_AVAILABLE = False
+
+CACHE_FORMAT = 1
+DEFAULT_CACHE_DIR = os.environ.get(
+    "WHISPER_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "whisper"),
+)
+
+
+def _sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def quantize_int8(model):
+    """
+    Dynamic int8 quantization of Whisper's Linear layers - faster CPU inference, slightly less accurate.
+
+    quantize_dynamic only swaps modules whose type is exactly torch.nn.Linear, and Whisper's
+    layers are its own subclass (which only casts the weights to the input dtype, a no-op in fp32),
+    so they are turned back into plain torch.nn.Linear first.
+    """
+    from whisper.model import Linear as WhisperLinear
+
+    for module in model.modules():
+        if type(module) is WhisperLinear:
+            module.__class__ = torch.nn.Linear
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class WhisperBackend:
+    name = "whisper"
+
+    def __init__(self, model_name: str = "medium", cache_dir: str = DEFAULT_CACHE_DIR, quantize: str = None):
+        if not WHISPER_AVAILABLE:
+            raise ImportError("openai-whisper is not installed")
         self.model_name = model_name
+        self.cache_dir = cache_dir
+        self.quantize = os.environ.get("WHISPER_QUANTIZE", "") if quantize is None else quantize
+        self.variant = self.variant_for(quantize=self.quantize)
         self.model = self._load_or_initialize_model()
 
+    @classmethod
+    def variant_for(cls, quantize: str = None, **_options) -> str:
+        """The variant these options load, without loading it."""
+        quantize = os.environ.get("WHISPER_QUANTIZE", "") if quantize is None else quantize
+        return f"{cls.name}-{quantize}" if quantize else cls.name
+
+    @property
+    def _model_dir(self) -> str:
+        return os.path.join(self.cache_dir, self.model_name)
+
     def _load_or_initialize_model(self):
-        model_cache_path = f"{self.model_name}_model.pkl"
-        try:
-            with open(model_cache_path, "rb") as f:
-                print(f"Loading cached model: {self.model_name}")
-                return pickle.load(f)
-        except FileNotFoundError:
+        started = time.time()
+        model = self._load_cached_weights()
+        if model is None:
             print(f"{self.model_name} loading...")
-            model = whisper.load_model(self.model_name)
-            with open(model_cache_path, "wb") as f:
-                pickle.dump(model, f)
-            print(f"Model cached: {self.model_name}")
-            return model
-
-    def transcribe(self, audio_file: str, language: str = "he") -> str:
-        result = self.model.transcribe(audio_file, language=language)
+            model = whisper.load_model(self.model_name, device="cpu")
+            self._export_weights(model)
+        print(f"Model {self.model_name} ready in {time.time() - started:.1f}s")
+
+        if self.quantize == "int8":
+            model = quantize_int8(model)
+            print(f"Model {self.model_name} quantized to int8")
+        return model
+
+    def _load_cached_weights(self):
+        manifest_path = os.path.join(self._model_dir, "manifest.json")
+        weights_path = os.path.join(self._model_dir, "weights.pt")
+        if not (os.path.exists(manifest_path) and os.path.exists(weights_path)):
+            return None
+
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        # Exported by another whisper/torch: the state dict layout may differ, so export again
+        if manifest.get("format") != CACHE_FORMAT or manifest.get("size") != os.path.getsize(weights_path) \
+                or manifest.get("whisper_version") != whisper.__version__ \
+                or manifest.get("torch_version") != torch.__version__:
+            print(f"Cached weights for {self.model_name} are stale, reloading")
+            return None
+
+        print(f"Loading cached model: {self.model_name}")
+        # mmap keeps the weights in the page cache, shared by every process on the machine
+        state_dict = torch.load(weights_path, map_location="cpu", mmap=True, weights_only=True)
+
+        # Build the skeleton on the meta device (no allocation, no random init), then adopt the mmap'd tensors
+        dims = ModelDimensions(**manifest["dims"])
+        model = Whisper.__new__(Whisper)
+        torch.nn.Module.__init__(model)
+        model.dims = dims
+        with torch.device("meta"):
+            model.encoder = AudioEncoder(dims.n_mels, dims.n_audio_ctx, dims.n_audio_state,
+                                         dims.n_audio_head, dims.n_audio_layer)
+            model.decoder = TextDecoder(dims.n_vocab, dims.n_text_ctx, dims.n_text_state,
+                                        dims.n_text_head, dims.n_text_layer)
+        model.load_state_dict(state_dict, assign=True)
+
+        # Non-persistent buffers are not in the state dict - rebuild them off the meta device
+        n_ctx = model.dims.n_text_ctx
+        mask = torch.empty(n_ctx, n_ctx).fill_(-float("inf")).triu_(1)
+        model.decoder.register_buffer("mask", mask, persistent=False)
+        if manifest.get("alignment_heads"):
+            model.set_alignment_heads(manifest["alignment_heads"].encode())
+        else:
+            heads = torch.zeros(model.dims.n_text_layer, model.dims.n_text_head, dtype=torch.bool)
+            heads[model.dims.n_text_layer // 2:] = True
+            model.register_buffer("alignment_heads", heads.to_sparse(), persistent=False)
+        if any(tensor.is_meta for tensor in model.state_dict(keep_vars=True).values()) or \
+                any(buffer.is_meta for buffer in model.buffers()):
+            print(f"Cached weights for {self.model_name} are incomplete, reloading")
+            return None
+        return model.eval()
+
+    def _export_weights(self, model):
+        os.makedirs(self._model_dir, exist_ok=True)
+        weights_path = os.path.join(self._model_dir, "weights.pt")
+        torch.save(model.state_dict(), weights_path + ".tmp")
+        os.replace(weights_path + ".tmp", weights_path)
+
+        alignment_heads = whisper._ALIGNMENT_HEADS.get(self.model_name)
+        manifest = {
+            "format": CACHE_FORMAT,
+            "model_name": self.model_name,
+            "dims": model.dims.__dict__,
+            "alignment_heads": alignment_heads.decode() if alignment_heads else None,
+            "whisper_version": whisper.__version__,
+            "torch_version": torch.__version__,
+            "size": os.path.getsize(weights_path),
+            "sha256": _sha256(weights_path),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        with open(os.path.join(self._model_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1)
+        print(f"Model cached: {self.model_name} -> {weights_path}")
+
+    def verify(self) -> bool:
+        """Full checksum of the cached weights against the manifest (slow - for build time)."""
+        with open(os.path.join(self._model_dir, "manifest.json"), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        return _sha256(os.path.join(self._model_dir, "weights.pt")) == manifest["sha256"]
+
+    def transcribe(self, audio, language: str = "he") -> str:
+        result = self.model.transcribe(audio, language=language, fp16=False)
         return result["text"].strip()
+
+    def transcribe_words(self, audio, language: str = "he") -> dict:
+        result = self.model.transcribe(audio, language=language, fp16=False, word_timestamps=True)
+        words = [
+            {"word": word["word"].strip(), "start": float(word["start"]), "end": float(word["end"])}
+            for segment in result["segments"] for word in segment.get("words", [])
+        ]
+        return {"text": result["text"].strip(), "words": words}
+
+
+class FasterWhisperBackend:
+    name = "faster-whisper"
+
+    def __init__(self, model_name: str = "medium", cache_dir: str = DEFAULT_CACHE_DIR, compute_type: str = None):
+        if not FASTER_WHISPER_AVAILABLE:
+            raise ImportError("faster-whisper is not installed")
+        self.model_name = model_name
+        self.compute_type = compute_type or os.environ.get("ASR_COMPUTE_TYPE", "int8")
+        self.variant = self.variant_for(compute_type=self.compute_type)
+        started = time.time()
+        print(f"{self.model_name} loading ({self.name}, {self.compute_type})...")
+        self.model = WhisperModel(
+            model_name,
+            device="cpu",
+            compute_type=self.compute_type,
+            cpu_threads=int(os.environ.get("ASR_CPU_THREADS", 0)),
+            download_root=os.path.join(cache_dir, self.name),
+        )
+        print(f"Model {self.model_name} ready in {time.time() - started:.1f}s")
+
+    @classmethod
+    def variant_for(cls, compute_type: str = None, **_options) -> str:
+        return f"{cls.name}-{compute_type or os.environ.get('ASR_COMPUTE_TYPE', 'int8')}"
+
+    def verify(self) -> bool:
+        return True
+
+    def transcribe(self, audio, language: str = "he") -> str:
+        segments, _info = self.model.transcribe(audio, language=language)
+        return "".join(segment.text for segment in segments).strip()
+
+    def transcribe_words(self, audio, language: str = "he") -> dict:
+        segments, _info = self.model.transcribe(audio, language=language, word_timestamps=True)
+        segments = list(segments)
+        words = [
+            {"word": word.word.strip(), "start": float(word.start), "end": float(word.end)}
+            for segment in segments for word in (segment.words or [])
+        ]
+        return {"text": "".join(segment.text for segment in segments).strip(), "words": words}
+
+
+BACKENDS = {
+    WhisperBackend.name: WhisperBackend,
+    FasterWhisperBackend.name: FasterWhisperBackend,
+}
+
+
+class SpeechToText:
+    def __init__(self, model_name: str = "medium", backend: str = None, **backend_options):
+        description = self.describe(model_name, backend, **backend_options)
+        self.model_name = model_name
+        self.variant = description["variant"]
+        # Identifies what produced a transcript - cached transcripts are keyed by it
+        self.model_id = description["model_id"]
+        self.backend = BACKENDS[description["backend"]](model_name=model_name, **backend_options)
+
+    @staticmethod
+    def describe(model_name: str = "medium", backend: str = None, **backend_options) -> dict:
+        """model_name, backend, variant and model_id of the model these arguments load, without loading it."""
+        backend = backend or os.environ.get("ASR_BACKEND", WhisperBackend.name)
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown ASR backend '{backend}', expected one of: {', '.join(BACKENDS)}")
+        variant = BACKENDS[backend].variant_for(**backend_options)
+        return {"model_name": model_name, "backend": backend, "variant": variant, "model_id": f"{variant}-{model_name}"}
+
+    def verify(self) -> bool:
+        return self.backend.verify()
+
+    @staticmethod
+    def _engine_input(audio):
+        if isinstance(audio, np.ndarray):
+            # Both engines want a writable in-memory array, not a read-only memory map
+            return np.array(audio, dtype=np.float32)
+        return audio
+
+    def transcribe(self, audio, language: str = "he") -> str:
+        """audio: a file path, or a 16 kHz mono float32 buffer (see audio_io)."""
+        return self.backend.transcribe(self._engine_input(audio), language=language)
+
+    def transcribe_words(self, audio, language: str = "he") -> dict:
+        """{"text", "words": [{"word", "start", "end"}, ...]} - times in seconds from the start of audio."""
+        return self.backend.transcribe_words(self._engine_input(audio), language=language)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download and cache ASR weights (run at image build time)")
+    parser.add_argument("--model", default=os.environ.get("WHISPER_MODEL", "medium"),
+                        help="Whisper model (tiny, base, small, medium, large)")
+    parser.add_argument("--backend", default=os.environ.get("ASR_BACKEND", WhisperBackend.name),
+                        choices=sorted(BACKENDS))
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--verify", action="store_true", help="בדיקת checksum מלאה של המשקלות")
+    args = parser.parse_args()
+
+    options = {"quantize": ""} if args.backend == WhisperBackend.name else {}
+    stt = SpeechToText(model_name=args.model, backend=args.backend, cache_dir=args.cache_dir, **options)
+    if args.verify and not stt.verify():
+        raise SystemExit(f"Checksum mismatch for {args.model} in {args.cache_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+static_files.py
+הגשת קבצי ה-React הבנויים: אינדקס של תיקיית static/ בעלייה, כולל עותקי gzip/brotli שנדחסו מראש
+(static_files.py --compress), כך שכל בקשה היא חיפוש במילון בלי ניסיון-וכישלון על הדיסק.
+"""
+
+import argparse
+import gzip
+import mimetypes
+import os
+import re
+
+from flask import send_file
+
+BROTLI_AVAILABLE = False
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    pass
+
+# Precompressed siblings, in order of preference
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+COMPRESSIBLE = (".html", ".js", ".css", ".json", ".svg", ".txt", ".map", ".ico")
+MIN_COMPRESS_BYTES = 1024
+
+# create-react-app puts a content hash in the names under static/js and static/css
+HASHED_NAME_RE = re.compile(r"\.[0-9a-f]{8,}\.(chunk\.)?(js|css)(\.map)?$")
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+class StaticFiles:
+    def __init__(self, static_dir: str, index: str = "index.html"):
+        self.static_dir = static_dir
+        self.index = index
+        self._files = {}
+        self.scan()
+
+    def scan(self) -> int:
+        """Index every file: relative path -> (path, {encoding: path of the precompressed copy})."""
+        files = {}
+        for root, _dirs, names in os.walk(self.static_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                if name.endswith((".br", ".gz")):
+                    continue
+                encoded = {}
+                for encoding, suffix in ENCODINGS:
+                    if os.path.exists(path + suffix):
+                        encoded[encoding] = path + suffix
+                files[os.path.relpath(path, self.static_dir).replace(os.sep, "/")] = (path, encoded)
+        self._files = files
+        return len(files)
+
+    def send(self, filename: str, accept_encodings):
+        """The file, precompressed if the client accepts it; index.html for unknown paths (client-side routes)."""
+        entry = self._files.get(filename)
+        if entry is None:
+            filename = self.index
+            entry = self._files.get(filename)
+            if entry is None:
+                return None
+        path, encoded = entry
+
+        encoding = next((e for e, _ in ENCODINGS if e in encoded and accept_encodings[e]), None)
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        hashed = HASHED_NAME_RE.search(filename) is not None
+        response = send_file(encoded[encoding] if encoding else path, mimetype=mimetype, conditional=True,
+                             download_name=os.path.basename(path), max_age=IMMUTABLE_MAX_AGE if hashed else 0)
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        if encoded:
+            response.vary.add("Accept-Encoding")
+        if hashed:
+            response.cache_control.immutable = True
+        else:
+            # index.html and the unhashed public files must be revalidated, or a deploy is not picked up
+            response.cache_control.no_cache = True
+        return response
+
+
+def compress(static_dir: str) -> int:
+    """Write .gz (and .br when brotli is installed) next to every text asset worth compressing."""
+    count = 0
+    for root, _dirs, names in os.walk(static_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            if not name.endswith(COMPRESSIBLE) or os.path.getsize(path) < MIN_COMPRESS_BYTES:
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            with open(path + ".gz", "wb") as f:
+                f.write(gzip.compress(data, compresslevel=9, mtime=0))
+            if BROTLI_AVAILABLE:
+                with open(path + ".br", "wb") as f:
+                    f.write(brotli.compress(data, quality=11))
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prepare the React build for serving")
+    parser.add_argument("static_dir", nargs="?", default="static", help="תיקיית ה-build של React")
+    parser.add_argument("--compress", action="store_true", help="דחיסה מראש ל-gzip ול-brotli")
+    args = parser.parse_args()
+
+    if args.compress:
+        print(f"{compress(args.static_dir)} files precompressed"
+              + ("" if BROTLI_AVAILABLE else " (gzip only - brotli is not installed)"))
+    print(f"{StaticFiles(args.static_dir).scan()} static files indexed in {args.static_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+streaming_pitch.py
+משוב מלודיה בזמן אמת: התלמיד שולח פריימים של אודיו תוך כדי קריאה (WebSocket),
+והשרת מחזיר את גובה הקול לכל פריים ודמיון מצטבר למלודיה של הרב.
+"""
+
+import json
+import logging
+
+import numpy as np
+
+from audio_io import SAMPLE_RATE
+
+# ננסה לייבא flask-sock (WebSocket)
+FLASK_SOCK_AVAILABLE = False
+try:
+    from flask_sock import Sock
+    FLASK_SOCK_AVAILABLE = True
+except ImportError:
+    FLASK_SOCK_AVAILABLE = False
+
+
+# Live similarity looks at the last few seconds only, so every message costs the same DTW
+WINDOW_SECONDS = 8.0
+
+
+class StreamingPitchTracker:
+    """
+    Incremental YIN over a sliding window, with the same settings and framing as
+    prosody.pitch_track: the stream starts with the same half frame of silence a
+    centered frame is padded with, so frame k covers the same samples in both.
+
+    feed() takes any number of new samples and returns the pitch of every frame
+    that became complete, plus the similarity of the last WINDOW_SECONDS against
+    the same stretch of the reference's frames - scored with DTW, as the
+    comparison at the end of the recording is.
+    """
+
+    def __init__(self, reference_frames: np.ndarray, sr: int = SAMPLE_RATE):
+        from prosody import YIN_FRAME_LENGTH, YIN_HOP_LENGTH
+
+        self.reference_frames = np.asarray(reference_frames, dtype=np.float64)
+        self.sr = sr
+        self.frame_length = YIN_FRAME_LENGTH
+        self.hop_length = YIN_HOP_LENGTH
+        self.reference_seconds = max(len(self.reference_frames) * self.hop_length / sr, 1e-3)
+        self.window_frames = int(WINDOW_SECONDS * sr / self.hop_length)
+        self._buffer = np.zeros(self.frame_length // 2, dtype=np.float32)
+        self._f0 = []
+        self._rms = []
+        self.samples_received = 0
+
+    @property
+    def seconds(self) -> float:
+        return self.samples_received / self.sr
+
+    def feed(self, samples: np.ndarray) -> dict:
+        import librosa
+        from prosody import YIN_FMIN, YIN_FMAX
+
+        samples = np.asarray(samples, dtype=np.float32)
+        self.samples_received += len(samples)
+        self._buffer = np.concatenate([self._buffer, samples])
+
+        new_f0 = np.zeros(0)
+        if len(self._buffer) >= self.frame_length:
+            frames = 1 + (len(self._buffer) - self.frame_length) // self.hop_length
+            window = self._buffer[:self.frame_length + (frames - 1) * self.hop_length]
+            new_f0 = librosa.yin(window, fmin=YIN_FMIN, fmax=YIN_FMAX, sr=self.sr,
+                                 frame_length=self.frame_length, hop_length=self.hop_length, center=False)
+            new_rms = librosa.feature.rms(y=window, frame_length=self.frame_length, hop_length=self.hop_length,
+                                          center=False)[0][:len(new_f0)]
+            # Keep what the next frame still overlaps
+            self._buffer = self._buffer[frames * self.hop_length:]
+            self._f0.extend(new_f0.tolist())
+            self._rms.extend(new_rms.tolist())
+
+        return {
+            "time": round(self.seconds, 3),
+            "pitch": [round(float(f), 1) for f in new_f0],
+            "similarity": self.similarity(),
+        }
+
+    def similarity(self, whole: bool = False):
+        """
+        Similarity of the last WINDOW_SECONDS (or of everything so far, with whole) to the part of
+        the reference they should match, or None when too short.
+        """
+        from prosody import _voicing, compare_pitch_dtw
+
+        progress = min(1.0, self.seconds / self.reference_seconds)
+        n_ref = int(round(len(self.reference_frames) * progress))
+        if n_ref < 4 or len(self._f0) < 4:
+            return None
+        f0 = np.asarray(self._f0)
+        # Voicing against the loudest frame so far, as pitch_track decides it over a whole recording
+        user_frames = np.where(_voicing(f0, np.asarray(self._rms)), f0, np.nan)
+        if whole:
+            score, _path = compare_pitch_dtw(self.reference_frames[:n_ref], user_frames)
+            return round(score, 2)
+        # The window's share of the recording so far, of both sides
+        ref_start = max(0, n_ref - int(round(self.window_frames * n_ref / len(user_frames))))
+        user_start = max(0, len(user_frames) - self.window_frames)
+        score, _path = compare_pitch_dtw(self.reference_frames[ref_start:n_ref], user_frames[user_start:])
+        return round(score, 2)
+
+
+def register_stream_endpoint(app, reference_cache, resolve_rabbi_file):
+    """
+    Add the /api/stream-pitch WebSocket to a server, if flask-sock is installed.
+
+    Protocol: connect with ?pasuk_id=<chapter>_<pasuk> or a torah.json id, send binary messages of
+    16 kHz mono float32 little-endian PCM, and {"type": "end"} when done. Each
+    audio message is answered with {"time", "pitch", "similarity"} (over the last
+    WINDOW_SECONDS); "end" with the similarity of the whole recording.
+    """
+    if not FLASK_SOCK_AVAILABLE:
+        logging.warning("flask-sock is not installed - /api/stream-pitch is disabled")
+        return None
+
+    from flask import request
+
+    sock = Sock(app)
+
+    @sock.route('/api/stream-pitch')
+    def stream_pitch(ws):
+        pasuk_id = request.args.get('pasuk_id')
+        rabbi_file = resolve_rabbi_file(pasuk_id) if pasuk_id else None
+        if rabbi_file is None:
+            ws.send(json.dumps({"error": "Rabbi recording not found"}))
+            return
+
+        tracker = StreamingPitchTracker(reference_cache.pitch_frames(rabbi_file))
+        while True:
+            message = ws.receive()
+            if message is None:
+                break
+            if isinstance(message, str):
+                try:
+                    control = json.loads(message)
+                except ValueError as e:
+                    ws.send(json.dumps({"error": f"Invalid control message: {e}"}))
+                    continue
+                if isinstance(control, dict) and control.get("type") == "end":
+                    ws.send(json.dumps({"type": "end", "time": round(tracker.seconds, 3),
+                                        "similarity": tracker.similarity(whole=True)}))
+                    break
+                continue
+            usable = len(message) - len(message) % 4
+            ws.send(json.dumps(tracker.feed(np.frombuffer(message[:usable], dtype="<f4"))))
+
+    return sock
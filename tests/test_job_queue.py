@@ -0,0 +1,56 @@
+import threading
+
+import pytest
+
+from job_queue import JobQueue, MemoryJobBackend, SQLiteJobBackend, DONE, RUNNING
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return MemoryJobBackend()
+    return SQLiteJobBackend(str(tmp_path / "jobs.sqlite3"))
+
+
+def wait_done(jobs, job_id):
+    for _ in range(500):
+        job = jobs.get(job_id)
+        if job["status"] == DONE:
+            return job
+        threading.Event().wait(0.01)
+    raise AssertionError(f"{job_id} did not finish: {job}")
+
+
+def test_finished_job_is_not_returned_for_another_request(backend):
+    stored = {}
+    jobs = JobQueue(workers=1, backend=backend, on_result=stored.__setitem__)
+
+    jobs.submit_request("s1", {"endpoint": "compare-audio", "reference": "audio"}, lambda progress: {"mode": "audio"})
+    assert wait_done(jobs, "s1")["result"] == {"mode": "audio"}
+
+    jobs.submit_request("s1", {"endpoint": "compare-audio", "reference": "text"}, lambda progress: {"mode": "text"})
+    assert wait_done(jobs, "s1")["result"] == {"mode": "text"}
+    assert stored["s1"] == {"mode": "text"}
+
+
+def test_in_flight_request_is_deduplicated_and_superseded_job_dropped(backend):
+    release = threading.Event()
+    stored = {}
+    jobs = JobQueue(workers=2, backend=backend, on_result=stored.__setitem__)
+
+    def slow(progress):
+        release.wait(5)
+        return {"mode": "audio"}
+
+    first = jobs.submit_request("s1", {"endpoint": "compare-audio", "reference": "audio"}, slow)
+    retry = jobs.submit_request("s1", {"endpoint": "compare-audio", "reference": "audio"}, slow)
+    assert retry["token"] == first["token"]
+
+    # Another reference mode while the first is still running replaces it
+    jobs.submit_request("s1", {"endpoint": "compare-audio", "reference": "text"}, lambda progress: {"mode": "text"})
+    assert wait_done(jobs, "s1")["result"] == {"mode": "text"}
+    release.set()
+    jobs.shutdown(5)
+    job = jobs.get("s1")
+    assert job["status"] != RUNNING and job["result"] == {"mode": "text"}
+    assert stored["s1"] == {"mode": "text"}
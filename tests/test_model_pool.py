@@ -0,0 +1,31 @@
+from model_pool import ModelPool, PooledModel
+from speech_to_text import SpeechToText
+
+
+class FakeModel:
+    model_id = "loaded"
+
+    def transcribe(self, audio):
+        return "text"
+
+
+def test_described_attributes_do_not_load_the_model():
+    loads = []
+    pool = ModelPool("stt", lambda: loads.append(1) or FakeModel(), slots=2,
+                     describe=lambda: {"model_id": "whisper-int8-medium", "variant": "whisper-int8"})
+    model = PooledModel(pool)
+
+    assert model.model_id == "whisper-int8-medium"
+    assert model.variant == "whisper-int8"
+    assert loads == []
+
+    assert model.transcribe(None) == "text"
+    assert loads == [1]
+
+
+def test_speech_to_text_description_matches_loaded_model(monkeypatch):
+    monkeypatch.setenv("WHISPER_QUANTIZE", "int8")
+    description = SpeechToText.describe("tiny", backend="whisper")
+    assert description["variant"] == "whisper-int8"
+    assert description["model_id"] == "whisper-int8-tiny"
+    assert SpeechToText.describe("tiny", backend="whisper", quantize="")["model_id"] == "whisper-tiny"
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("librosa")
+
+from prosody import compare_pitch_dtw, extract_pitch_frames
+
+SR = 16000
+
+
+def _chant(seconds: float = 3.0, base: float = 140.0) -> np.ndarray:
+    """A gliding fundamental with two harmonics and syllable-rate gaps."""
+    t = np.arange(int(seconds * SR)) / SR
+    f0 = base * (1 + 0.15 * np.sin(2 * np.pi * 0.4 * t))
+    phase = 2 * np.pi * np.cumsum(f0) / SR
+    voice = np.sin(phase) + 0.5 * np.sin(2 * phase) + 0.25 * np.sin(3 * phase)
+    envelope = (np.sin(2 * np.pi * 2.0 * t) > -0.6).astype(np.float64)
+    return (0.2 * voice * envelope).astype(np.float32)
+
+
+@pytest.fixture(scope="module")
+def reference_frames():
+    return extract_pitch_frames(_chant())
+
+
+def test_identical_melody_scores_full(reference_frames):
+    score, path = compare_pitch_dtw(reference_frames, reference_frames)
+    assert score == pytest.approx(100.0)
+    assert len(path) > 0
+
+
+def test_same_melody_in_another_key_scores_high(reference_frames):
+    score, _path = compare_pitch_dtw(reference_frames, extract_pitch_frames(_chant(base=200.0)))
+    assert score > 80
+
+
+def test_silence_scores_zero(reference_frames):
+    score, path = compare_pitch_dtw(reference_frames, extract_pitch_frames(np.zeros(3 * SR, dtype=np.float32)))
+    assert score == 0.0
+    assert len(path) == 0
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("level", [0.003, 0.1])
+def test_noise_earns_no_melody_credit(reference_frames, seed, level):
+    noise = (level * np.random.default_rng(seed).standard_normal(3 * SR)).astype(np.float32)
+    score, _path = compare_pitch_dtw(reference_frames, extract_pitch_frames(noise))
+    assert score < 20
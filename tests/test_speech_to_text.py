@@ -0,0 +1,41 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+whisper_model = pytest.importorskip("whisper.model")
+
+from speech_to_text import quantize_int8
+
+
+def _tiny_whisper():
+    dims = whisper_model.ModelDimensions(
+        n_mels=80, n_audio_ctx=16, n_audio_state=32, n_audio_head=2, n_audio_layer=1,
+        n_vocab=100, n_text_ctx=8, n_text_state=32, n_text_head=2, n_text_layer=1,
+    )
+    torch.manual_seed(0)
+    model = whisper_model.Whisper(dims).eval()
+    # Left uninitialized (torch.empty) by Whisper, filled from the checkpoint when loading one
+    torch.nn.init.normal_(model.decoder.positional_embedding, std=0.02)
+    return model
+
+
+def test_quantize_int8_replaces_every_linear_layer():
+    model = _tiny_whisper()
+    linear_count = sum(isinstance(m, torch.nn.Linear) for m in model.modules())
+    assert linear_count > 0
+
+    quantized = quantize_int8(model)
+
+    dynamic_linear = torch.ao.nn.quantized.dynamic.Linear
+    assert sum(type(m) is dynamic_linear for m in quantized.modules()) == linear_count
+    assert not any(isinstance(m, torch.nn.Linear) for m in quantized.modules())
+
+
+def test_quantized_model_still_runs():
+    model = _tiny_whisper()
+    mel, tokens = torch.randn(1, 80, 32), torch.tensor([[1, 2, 3]])
+    expected = model(mel, tokens)
+
+    logits = quantize_int8(model)(mel, tokens)
+
+    assert logits.shape == expected.shape
+    assert torch.allclose(logits, expected, atol=0.5)
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("librosa")
+
+from prosody import pitch_track
+from streaming_pitch import StreamingPitchTracker
+
+SR = 16000
+
+
+def _chant(seconds: float, base: float = 140.0) -> np.ndarray:
+    t = np.arange(int(seconds * SR)) / SR
+    f0 = base * (1 + 0.15 * np.sin(2 * np.pi * 0.4 * t))
+    phase = 2 * np.pi * np.cumsum(f0) / SR
+    voice = np.sin(phase) + 0.5 * np.sin(2 * phase) + 0.25 * np.sin(3 * phase)
+    envelope = (np.sin(2 * np.pi * 2.0 * t) > -0.6).astype(np.float64)
+    return (0.2 * voice * envelope).astype(np.float32)
+
+
+def _stream(tracker, audio, chunk=1600):
+    return [tracker.feed(audio[i:i + chunk]) for i in range(0, len(audio), chunk)]
+
+
+def test_streamed_frames_match_pitch_track():
+    audio = _chant(4.0)
+    f0, voiced = pitch_track(audio)
+    tracker = StreamingPitchTracker(np.where(voiced, f0, np.nan))
+    _stream(tracker, audio, chunk=1234)
+    streamed = np.asarray(tracker._f0)
+    assert len(streamed) >= len(f0) - 4
+    np.testing.assert_allclose(streamed, f0[:len(streamed)], rtol=1e-4)
+
+
+def test_live_similarity_uses_a_trailing_window():
+    audio = _chant(20.0)
+    f0, voiced = pitch_track(audio)
+    tracker = StreamingPitchTracker(np.where(voiced, f0, np.nan))
+    updates = _stream(tracker, audio)
+    assert updates[-1]["similarity"] > 90
+    assert tracker.similarity(whole=True) > 90
+    assert len(tracker._f0) > 2 * tracker.window_frames
@@ -0,0 +1,230 @@
+"""
+torah_text.py
+טקסט התורה מתוך torah.json, טעון פעם אחת לאינדקס בזיכרון לפי ספר, פרק ופסוק ולפי פרשה.
+משמש כטקסט הייחוס להשוואה הפונטית (בלי ניקוד וטעמים), במקום תמלול הקלטת הרב,
+ומוגש ללקוח בעמודים עם ETag (/api/pasuk-info, /api/parasha/<name>) במקום להיארז בתוך ה-JS.
+"""
+
+import json
+import os
+import re
+import threading
+import unicodedata
+
+DEFAULT_TORAH_JSON = os.environ.get(
+    "TORAH_JSON",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "client", "src", "data", "torah.json"),
+)
+
+# Ketiv followed by its qere in brackets - the reader reads the qere
+KETIV_QERE_RE = re.compile(r"\S+\s+\[([^\]]+)\]")
+# Open/closed section markers: (פ), (ס), (׆)
+SECTION_MARK_RE = re.compile(r"\([^)]*\)")
+# Ta'amim (cantillation marks)
+TROPE_RE = re.compile("[\u0591-\u05AF]")
+TORAH_MAX_AGE = int(os.environ.get("TORAH_MAX_AGE", 24 * 3600))
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Ta'amim (0591-05AF), nikud and the other points (05B0-05C7) and ZWJ - all but maqaf (05BE)
+POINTS_RE = re.compile("[\u0591-\u05BD\u05BF-\u05C7\u200D]")
+
+
+class AmbiguousVerse(Exception):
+    """chapter:pasuk exists in more than one book and no book was given."""
+
+    def __init__(self, chapter: int, pasuk: int, books: list):
+        super().__init__(f"{chapter}:{pasuk} is in {', '.join(books)} - pass book")
+        self.books = books
+
+
+def _pointed_words(hebrew: str) -> list:
+    text = KETIV_QERE_RE.sub(r"\1", hebrew)
+    text = SECTION_MARK_RE.sub(" ", text)
+    text = text.replace("\u05BE", " ")  # maqaf
+    return text.split()
+
+
+def strip_points(hebrew: str) -> str:
+    """Pointed verse text -> plain words, the way Whisper writes Hebrew."""
+    return " ".join(filter(None, (POINTS_RE.sub("", word) for word in _pointed_words(hebrew))))
+
+
+# Spellings of client/src/parasha_map.json that differ from torah.json's
+PARASHA_ALIASES = {"vaeira": "vaera", "vzot haberachah": "vezot haberachah"}
+
+
+def parasha_key(name: str) -> str:
+    """"Chayei Sara" / "chayei sara" / "Va'eira" -> one key, so both name lists resolve to the same parasha."""
+    key = name.lower().replace("'", "").strip()
+    return PARASHA_ALIASES.get(key, key)
+
+
+def trope_name(mark: str) -> str:
+    """"\u0596" -> "tipeha" """
+    return unicodedata.name(mark, "").replace("HEBREW ACCENT ", "").lower().replace(" ", "-")
+
+
+class TorahText:
+    """The corpus, indexed by id, (chapter, pasuk), (book, chapter, pasuk) and parasha; read from disk on first use."""
+
+    def __init__(self, path: str = DEFAULT_TORAH_JSON):
+        self.path = path
+        self._loaded = False
+        self._plain = {}
+        self._words = {}
+        self._phonemes = {}
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            with open(self.path, "r", encoding="utf-8") as f:
+                verses = json.load(f)
+            self._by_id = {}
+            self._by_ref = {}
+            self._by_book_ref = {}
+            self._by_parasha = {}
+            for verse in verses:
+                self._by_id[verse["id"]] = verse
+                self._by_ref.setdefault((verse["chapter"], verse["pasuk"]), []).append(verse)
+                self._by_book_ref[(verse["book"].lower(), verse["chapter"], verse["pasuk"])] = verse
+                self._by_parasha.setdefault(parasha_key(verse["parasha"]), []).append(verse)
+            self._loaded = True
+
+    def verse(self, chapter: int, pasuk: int, book: str = None):
+        """
+        The verse at chapter:pasuk. Chapter numbers repeat across books: without book, a
+        chapter:pasuk found in several books raises AmbiguousVerse.
+        """
+        self._load()
+        if book:
+            return self._by_book_ref.get((book.lower(), int(chapter), int(pasuk)))
+        candidates = self._by_ref.get((int(chapter), int(pasuk)), [])
+        if len(candidates) > 1:
+            raise AmbiguousVerse(int(chapter), int(pasuk), [verse["book"] for verse in candidates])
+        return candidates[0] if candidates else None
+
+    def parasha(self, name: str) -> list:
+        """The verses of a parasha in order, or None for an unknown name."""
+        self._load()
+        return self._by_parasha.get(parasha_key(name))
+
+    def lookup(self, pasuk_id, book: str = None):
+        """
+        Resolve a pasuk id as used by the API: "<chapter>_<pasuk>" (the audio file name, which
+        needs book where the chapter repeats - see verse) or a torah.json id.
+        """
+        pasuk_id = str(pasuk_id)
+        if "_" in pasuk_id:
+            chapter, _, pasuk = pasuk_id.partition("_")
+            if chapter.isdigit() and pasuk.isdigit():
+                return self.verse(int(chapter), int(pasuk), book)
+            return None
+        if pasuk_id.isdigit():
+            self._load()
+            return self._by_id.get(int(pasuk_id))
+        return None
+
+    def recording_name(self, pasuk_id) -> str:
+        """
+        The "<chapter>_<pasuk>" name the rabbi's recording of a pasuk id is saved under - the id
+        itself, or the torah.json verse's chapter and pasuk for a numeric id; None for anything else.
+        """
+        pasuk_id = str(pasuk_id)
+        chapter, _, pasuk = pasuk_id.partition("_")
+        if chapter.isdigit() and pasuk.isdigit():
+            return f"{int(chapter)}_{int(pasuk)}"
+        if pasuk_id.isdigit():
+            self._load()
+            verse = self._by_id.get(int(pasuk_id))
+            return f"{verse['chapter']}_{verse['pasuk']}" if verse is not None else None
+        return None
+
+    def plain_text(self, verse: dict) -> str:
+        text = self._plain.get(verse["id"])
+        if text is None:
+            text = strip_points(verse["hebrew"])
+            self._plain[verse["id"]] = text
+        return text
+
+    def words(self, verse: dict) -> list:
+        """The verse word by word: [{"word": plain word, "trope": [trope names]}, ...] - same words as plain_text."""
+        words = self._words.get(verse["id"])
+        if words is None:
+            words = []
+            pointed_words = [w for w in _pointed_words(verse["hebrew"]) if POINTS_RE.sub("", w)]
+            for position, pointed in enumerate(pointed_words):
+                trope = [trope_name(mark) for mark in TROPE_RE.findall(pointed)]
+                # Silluq is written with the meteg sign, on the last word only
+                if not trope and position == len(pointed_words) - 1 and "\u05BD" in pointed:
+                    trope = ["silluq"]
+                words.append({"word": POINTS_RE.sub("", pointed), "trope": trope})
+            self._words[verse["id"]] = words
+        return words
+
+    def phonemes(self, verse: dict, phonetics) -> str:
+        """Phonetic reference for a verse, computed once per verse."""
+        phones = self._phonemes.get(verse["id"])
+        if phones is None:
+            with self._lock:
+                phones = self._phonemes.get(verse["id"])
+                if phones is None:
+                    phones = phonetics.text_to_phones(self.plain_text(verse))
+                    self._phonemes[verse["id"]] = phones
+        return phones
+
+
+def _page(verses: list, page: int, per_page: int) -> dict:
+    pages = max(1, -(-len(verses) // per_page))
+    start = (page - 1) * per_page
+    return {"total": len(verses), "page": page, "per_page": per_page, "pages": pages,
+            "verses": verses[start:start + per_page]}
+
+
+def register_torah_endpoints(app, torah_text: TorahText):
+    """
+    Add the verse lookups to a server. Responses are public, cacheable for TORAH_MAX_AGE
+    seconds and carry an ETag, so a client revalidating an unchanged page gets a 304.
+    """
+    from flask import request, jsonify
+
+    def cacheable(payload):
+        response = jsonify(payload)
+        response.add_etag()
+        response.cache_control.public = True
+        response.cache_control.max_age = TORAH_MAX_AGE
+        return response.make_conditional(request)
+
+    def page_args():
+        page = request.args.get('page', 1, type=int)
+        per_page = request.args.get('per_page', DEFAULT_PAGE_SIZE, type=int)
+        return max(1, page), min(max(1, per_page), MAX_PAGE_SIZE)
+
+    @app.route('/api/pasuk-info', methods=['GET'])
+    def get_pasuk_info():
+        """One verse by ?chapter=&pasuk= (and &book= where chapter numbers repeat), or by ?pasuk_id="""
+        try:
+            if request.args.get('pasuk_id'):
+                verse = torah_text.lookup(request.args['pasuk_id'], request.args.get('book'))
+            else:
+                chapter = request.args.get('chapter', 1, type=int)
+                pasuk = request.args.get('pasuk', 1, type=int)
+                verse = torah_text.verse(chapter, pasuk, request.args.get('book') or None)
+        except AmbiguousVerse as e:
+            return jsonify({"error": f"Ambiguous pasuk: {e}", "books": e.books}), 400
+        if verse is None:
+            return jsonify({"error": "Pasuk not found"}), 404
+        return cacheable({**verse, "reference": f"{verse['book']} {verse['chapter']}:{verse['pasuk']}"})
+
+    @app.route('/api/parasha/<name>', methods=['GET'])
+    def get_parasha(name):
+        """The verses of a parasha, ?page= and ?per_page= (up to MAX_PAGE_SIZE)"""
+        verses = torah_text.parasha(name)
+        if verses is None:
+            return jsonify({"error": f"Unknown parasha '{name}'"}), 404
+        page, per_page = page_args()
+        return cacheable({"parasha": verses[0]["parasha"], **_page(verses, page, per_page)})
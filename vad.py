@@ -0,0 +1,102 @@
+"""
+vad.py
+זיהוי קטעי דיבור לפי אנרגיה בהקלטת התלמיד: חיתוך השקט בהתחלה ובסוף וקיצור הפסקות ארוכות לפני התמלול וניתוח המלודיה,
+כך ש-Whisper ו-YIN לא עובדים על שקט ורעש מיקרופון והמלודיה לא נמתחת עליהם. מחזיר גם את הקטעים שנשמרו (בזמני ההקלטה המקורית).
+"""
+
+import os
+
+import numpy as np
+
+from audio_io import SAMPLE_RATE
+
+VAD_ENABLED = os.environ.get("VAD", "1") == "1"
+
+FRAME_SECONDS = 0.03
+HOP_SECONDS = 0.01
+# A frame is speech when it is VAD_MARGIN_DB above the noise floor (the quietest frames)
+# and within VAD_RANGE_DB of the loudest frame
+VAD_MARGIN_DB = float(os.environ.get("VAD_MARGIN_DB", 10))
+VAD_RANGE_DB = 40.0
+NOISE_PERCENTILE = 10
+# Shorter bursts are clicks and bumps, not speech
+MIN_SPEECH_SECONDS = 0.1
+# Pauses up to this long stay in - breaths between words and phrases are part of the reading
+MAX_PAUSE_SECONDS = float(os.environ.get("VAD_MAX_PAUSE", 0.75))
+# Kept around every span, so soft onsets and word endings are not clipped
+PAD_SECONDS = 0.15
+
+
+def frame_energy_db(audio: np.ndarray, frame: int, hop: int) -> np.ndarray:
+    """Mean power of every frame, in dB."""
+    windows = np.lib.stride_tricks.sliding_window_view(audio, frame)[::hop]
+    power = np.einsum("ij,ij->i", windows, windows, dtype=np.float64) / frame
+    return 10 * np.log10(power + 1e-12)
+
+
+def speech_spans(audio: np.ndarray, sr: int = SAMPLE_RATE, max_pause: float = MAX_PAUSE_SECONDS) -> list:
+    """
+    [(start, end), ...] in samples of the speech in a recording, padded and merged across short pauses.
+
+    A recording without contrast between its quietest and loudest frames (all speech,
+    all silence, or too short to tell) is returned whole.
+    """
+    audio = np.asarray(audio, dtype=np.float32)
+    frame, hop = int(FRAME_SECONDS * sr), int(HOP_SECONDS * sr)
+    whole = [(0, len(audio))] if len(audio) else []
+    if len(audio) < frame:
+        return whole
+    energy = frame_energy_db(audio, frame, hop)
+    floor, peak = np.percentile(energy, NOISE_PERCENTILE), energy.max()
+    if peak - floor < VAD_MARGIN_DB:
+        return whole
+    active = energy > max(floor + VAD_MARGIN_DB, peak - VAD_RANGE_DB)
+
+    # Runs of active frames -> sample ranges
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], active.astype(np.int8), [0]))))
+    pad = int(PAD_SECONDS * sr)
+    spans = []
+    for first, last in zip(edges[::2], edges[1::2]):
+        start, end = first * hop, (last - 1) * hop + frame
+        if end - start < MIN_SPEECH_SECONDS * sr:
+            continue
+        start, end = max(0, start - pad), min(len(audio), end + pad)
+        if spans and start - spans[-1][1] <= max_pause * sr:
+            spans[-1] = (spans[-1][0], end)
+        else:
+            spans.append((start, end))
+    return [(int(start), int(end)) for start, end in spans] or whole
+
+
+class TrimmedAudio:
+    """A recording with only its speech spans kept, back to back, and the way back to the original's times."""
+
+    def __init__(self, audio: np.ndarray, spans: list, sr: int = SAMPLE_RATE):
+        self.sr = sr
+        self.spans = spans
+        self.original_samples = len(audio)
+        if spans == [(0, len(audio))]:
+            self.audio = audio
+        else:
+            self.audio = np.concatenate([audio[start:end] for start, end in spans]) if spans else audio[:0]
+        # Where every span starts in the trimmed buffer
+        self._offsets = np.cumsum([0] + [end - start for start, end in spans])
+
+    def original_time(self, seconds: float) -> float:
+        """A time in the trimmed audio (a word's start, a pasuk boundary) -> the same moment in the upload."""
+        if not self.spans:
+            return seconds
+        sample = seconds * self.sr
+        k = min(max(int(np.searchsorted(self._offsets, sample, side="right")) - 1, 0), len(self.spans) - 1)
+        return (self.spans[k][0] + sample - self._offsets[k]) / self.sr
+
+    def report(self) -> dict:
+        return {
+            "spans": [[round(start / self.sr, 2), round(end / self.sr, 2)] for start, end in self.spans],
+            "original_seconds": round(self.original_samples / self.sr, 2),
+            "kept_seconds": round(len(self.audio) / self.sr, 2),
+        }
+
+
+def trim(audio: np.ndarray, sr: int = SAMPLE_RATE, max_pause: float = MAX_PAUSE_SECONDS) -> TrimmedAudio:
+    return TrimmedAudio(audio, speech_spans(audio, sr, max_pause), sr)
@@ -0,0 +1,116 @@
+"""
+warmup.py
+חימום בעליית השרת: טעינת הספריות הכבדות (librosa, numba) והמודלים ברקע, עם מדידת זמנים לכל שלב,
+כדי שבדיקת ה-readiness תכניס תנועה רק למופע שמסוגל להריץ השוואה מיד.
+"""
+
+import importlib
+import os
+import threading
+import time
+import traceback
+
+import numpy as np
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Imported by the comparison on first use; ordered so each timing excludes the ones before it
+HEAVY_MODULES = ("numpy", "scipy.signal", "numba", "librosa", "rapidfuzz", "prosody", "word_scoring")
+
+WARMUP_ENABLED = os.environ.get("WARMUP", "1") == "1"
+
+
+def import_modules(modules=HEAVY_MODULES) -> dict:
+    """Import each module, returning {module: seconds}."""
+    timings = {}
+    for module in modules:
+        started = time.perf_counter()
+        importlib.import_module(module)
+        timings[module] = round(time.perf_counter() - started, 3)
+    return timings
+
+
+def warm_kernels():
+    """Run YIN and the DTW kernel once on a short tone, so the first comparison does not pay for JIT compilation."""
+    from prosody import pitch_track, compare_pitch_dtw
+
+    t = np.arange(16000, dtype=np.float32) / 16000
+    f0, voiced = pitch_track((0.3 * np.sin(2 * np.pi * 150 * t)).astype(np.float32))
+    frames = np.where(voiced, f0, np.nan)
+    compare_pitch_dtw(frames, frames)
+
+
+class Warmup:
+    """
+    Named startup steps run in order on a background thread; ready once every step is done.
+
+    A step that already ran - in gunicorn's master, before the fork - is not run again
+    in the workers, which inherit its result.
+    """
+
+    def __init__(self, steps: list, enabled: bool = WARMUP_ENABLED):
+        self.steps = steps
+        # Disabled: everything loads on first use, as before, and the instance counts as ready at once
+        self.enabled = enabled
+        self._status = {name: {"status": PENDING} for name, _ in steps}
+        self._lock = threading.Lock()
+        self._pid = None
+        self.started = time.time()
+
+    def _set(self, name: str, **fields):
+        with self._lock:
+            self._status[name] = {**self._status[name], **fields}
+
+    def run(self):
+        """Run the steps that have not succeeded yet, in this thread."""
+        for name, step in self.steps:
+            if self._status[name]["status"] == DONE:
+                continue
+            self._set(name, status=RUNNING)
+            started = time.perf_counter()
+            try:
+                detail = step()
+            except Exception as e:
+                traceback.print_exc()
+                self._set(name, status=FAILED, error=str(e), seconds=round(time.perf_counter() - started, 3))
+                continue
+            fields = {"status": DONE, "seconds": round(time.perf_counter() - started, 3)}
+            if detail:
+                fields["detail"] = detail
+            self._set(name, **fields)
+            print(f"Warm-up: {name} ready in {fields['seconds']}s")
+
+    def start(self):
+        """Run the steps in the background (once per process)."""
+        if not self.enabled or self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self.run, name="warmup", daemon=True).start()
+
+    @property
+    def ready(self) -> bool:
+        with self._lock:
+            return not self.enabled or all(step["status"] == DONE for step in self._status.values())
+
+    def report(self) -> dict:
+        with self._lock:
+            steps = {name: dict(status) for name, status in self._status.items()}
+        return {
+            "ready": not self.enabled or all(step["status"] == DONE for step in steps.values()),
+            "warmup": self.enabled,
+            "uptime_seconds": round(time.time() - self.started, 1),
+            "steps": steps,
+        }
+
+
+def create_warmup(models) -> Warmup:
+    """Imports, the pitch/DTW kernels, then one instance of each model of the ModelManager."""
+    return Warmup([
+        ("imports", import_modules),
+        ("kernels", warm_kernels),
+        ("stt", lambda: models.preload(["stt"])),
+        ("phonetics", lambda: models.preload(["phonetics"])),
+    ])
@@ -0,0 +1,174 @@
+"""
+word_scoring.py
+ציון לכל מילה בפסוק: יישור מילות התמלול (עם חותמות זמן) למילות הייחוס,
+והשוואת הפונמות והמלודיה של כל מילה בנפרד - כדי שהתלמיד יחזור רק על המילה שטעה בה.
+"""
+
+import re
+
+import numpy as np
+
+from audio_io import SAMPLE_RATE
+
+# Minimum fuzz.ratio for a heard word to count as an attempt at a reference word
+WORD_MATCH_THRESHOLD = 50
+# Consecutive exactly heard words taken as aligned without scoring the words around them
+EXACT_RUN_ANCHOR = 2
+
+PUNCTUATION_RE = re.compile(r"[^\w\s֐-׿]")
+
+
+def normalize_word(word: str) -> str:
+    from torah_text import strip_points
+
+    return PUNCTUATION_RE.sub("", strip_points(word)).strip()
+
+
+def align_words(reference_words: list, heard_words: list, threshold: int = WORD_MATCH_THRESHOLD) -> list:
+    """
+    For every reference word, the index of the heard word aligned to it, or None.
+
+    Monotonic alignment maximizing the total similarity of the matched pairs, so a
+    skipped or inserted word only costs itself. Runs of words heard exactly, from the
+    word-level edit script (rapidfuzz), are taken as they are; only the stretches
+    between them are paired by similarity.
+    """
+    from rapidfuzz import fuzz, process
+    from rapidfuzz.distance import Levenshtein
+
+    reference = [normalize_word(w) for w in reference_words]
+    heard = [normalize_word(w) for w in heard_words]
+    aligned = [None] * len(reference)
+    # A single exact match may be a common word in the wrong place - it stays in the stretch around it
+    stretches, open_stretch = [], None
+    for tag, i1, i2, j1, j2 in Levenshtein.opcodes(reference, heard):
+        if tag == "equal" and i2 - i1 >= EXACT_RUN_ANCHOR:
+            aligned[i1:i2] = range(j1, j2)
+            if open_stretch:
+                stretches.append(open_stretch)
+            open_stretch = None
+        else:
+            open_stretch = (open_stretch[0], i2, open_stretch[2], j2) if open_stretch else (i1, i2, j1, j2)
+    if open_stretch:
+        stretches.append(open_stretch)
+
+    for i1, i2, j1, j2 in stretches:
+        if i1 == i2 or j1 == j2:
+            continue
+        similarity = process.cdist(reference[i1:i2], heard[j1:j2], scorer=fuzz.ratio)
+        for k, j in enumerate(_align_block(np.where(similarity >= threshold, similarity, -np.inf))):
+            aligned[i1 + k] = None if j is None else j1 + j
+    return aligned
+
+
+def _align_block(similarity: np.ndarray) -> list:
+    """Monotonic pairing of the rows and columns of a similarity matrix with the largest total."""
+    n, m = similarity.shape
+    total = np.zeros((n + 1, m + 1))
+    for i in range(1, n + 1):
+        # total[i, j] = max(total[i - 1, j], total[i, j - 1], total[i - 1, j - 1] + similarity[i - 1, j - 1]),
+        # where the total[i, j - 1] term is a running maximum along the row
+        step = np.maximum(total[i - 1, 1:], total[i - 1, :-1] + similarity[i - 1])
+        total[i, 1:] = np.maximum.accumulate(step)
+
+    aligned = [None] * n
+    i, j = n, m
+    while i > 0 and j > 0:
+        if total[i, j] == total[i - 1, j]:
+            i -= 1
+        elif total[i, j] == total[i, j - 1]:
+            j -= 1
+        else:
+            aligned[i - 1] = j - 1
+            i, j = i - 1, j - 1
+    return aligned
+
+
+def word_spans(reference_words: list, timed_words: list) -> list:
+    """(start, end) in seconds of every reference word within a transcribed recording, or None if it was not heard."""
+    aligned = align_words(reference_words, [w["word"] for w in timed_words])
+    return [None if j is None else (timed_words[j]["start"], timed_words[j]["end"]) for j in aligned]
+
+
+def proportional_spans(reference_words: list, frames: np.ndarray) -> list:
+    """
+    (start, end) in seconds of every reference word spread over the voiced stretch of a recording's
+    pitch frames in proportion to its length - for a recording without word timings.
+    """
+    from prosody import YIN_HOP_LENGTH
+
+    voiced = np.flatnonzero(~np.isnan(frames))
+    if not len(voiced) or not reference_words:
+        return [None] * len(reference_words)
+    start, end = voiced[0] * YIN_HOP_LENGTH / SAMPLE_RATE, (voiced[-1] + 1) * YIN_HOP_LENGTH / SAMPLE_RATE
+    lengths = np.array([max(len(normalize_word(w)), 1) for w in reference_words], dtype=np.float64)
+    edges = start + (end - start) * np.concatenate(([0.0], np.cumsum(lengths))) / lengths.sum()
+    return [(round(float(a), 3), round(float(b), 3)) for a, b in zip(edges[:-1], edges[1:])]
+
+
+def frame_slice(frames: np.ndarray, span) -> np.ndarray:
+    """The pitch frames (see prosody.extract_pitch_frames) covering a (start, end) span in seconds."""
+    from prosody import YIN_HOP_LENGTH
+
+    first = int(span[0] * SAMPLE_RATE / YIN_HOP_LENGTH)
+    last = max(first + 1, int(np.ceil(span[1] * SAMPLE_RATE / YIN_HOP_LENGTH)))
+    return frames[first:last]
+
+
+def score_word(reference_word: dict, reference_frames: np.ndarray, heard: str, user_frames: np.ndarray,
+               phonetics) -> dict:
+    """
+    Phonetic and melody score of one word.
+
+    reference_word: {"word", "trope"}; reference_frames / user_frames: the word's pitch
+    frames, or None when its timing is unknown.
+    """
+    from prosody import compare_pitch_dtw
+    from rapidfuzz import fuzz
+
+    phonetic_score = 0.0
+    if heard:
+        try:
+            phonetic_score = fuzz.ratio(phonetics.text_to_phones(reference_word["word"]),
+                                        phonetics.text_to_phones(normalize_word(heard)))
+        except Exception:
+            phonetic_score = fuzz.ratio(reference_word["word"], normalize_word(heard))
+
+    prosody_score = None
+    if reference_frames is not None and user_frames is not None and len(reference_frames) and len(user_frames):
+        prosody_score = round(compare_pitch_dtw(reference_frames, user_frames)[0], 2)
+
+    return {
+        "word": reference_word["word"],
+        "trope": reference_word.get("trope", []),
+        "heard": heard,
+        "phonetic_score": round(phonetic_score, 2),
+        "prosody_score": prosody_score,
+    }
+
+
+def score_words(reference_words: list, reference_segments: list, user_words: list, user_frames: np.ndarray,
+                phonetics) -> list:
+    """
+    One entry per reference word, in verse order.
+
+    reference_segments come from ReferenceCache.word_segments; user_words are the ASR
+    words of the student's recording with their times. Each entry records what was
+    heard for the word and where, or None when it was missed.
+    """
+    aligned = align_words([w["word"] for w in reference_words], [w["word"] for w in user_words])
+    scores = []
+    for index, (reference_word, segment, j) in enumerate(zip(reference_words, reference_segments, aligned)):
+        user_word = user_words[j] if j is not None else None
+        entry = score_word(
+            reference_word,
+            segment["frames"] if segment is not None else None,
+            user_word["word"] if user_word else None,
+            frame_slice(user_frames, (user_word["start"], user_word["end"])) if user_word else None,
+            phonetics,
+        )
+        entry["index"] = index
+        entry["start"] = user_word["start"] if user_word else None
+        entry["end"] = user_word["end"] if user_word else None
+        scores.append(entry)
+    return scores